@@ -12,13 +12,170 @@ import re
 import tempfile
 import shutil
 import contextlib
+import functools
 import logging
-
-__all__ = ['build_libear']
+import hashlib
+import platform
+from multiprocessing.pool import ThreadPool
+
+__all__ = ['build_libear', 'build_cached_libear']
+
+# The functions and symbols which are checked before the library is built.
+# (The result goes into the 'config.h' file.)
+FUNCTION_CHECKS = [
+    ('execve', 'HAVE_EXECVE'),
+    ('execv', 'HAVE_EXECV'),
+    ('execvpe', 'HAVE_EXECVPE'),
+    ('execvp', 'HAVE_EXECVP'),
+    ('execvP', 'HAVE_EXECVP2'),
+    ('exect', 'HAVE_EXECT'),
+    ('execl', 'HAVE_EXECL'),
+    ('execlp', 'HAVE_EXECLP'),
+    ('execle', 'HAVE_EXECLE'),
+    ('posix_spawn', 'HAVE_POSIX_SPAWN'),
+    ('posix_spawnp', 'HAVE_POSIX_SPAWNP'),
+    ('clock_gettime', 'HAVE_CLOCK_GETTIME'),
+    ('wait', 'HAVE_WAIT'),
+    ('waitpid', 'HAVE_WAITPID'),
+    ('wait3', 'HAVE_WAIT3'),
+    ('wait4', 'HAVE_WAIT4'),
+    ('waitid', 'HAVE_WAITID'),
+]
+SYMBOL_CHECKS = [
+    ('_NSGetEnviron', 'crt_externs.h', 'HAVE_NSGETENVIRON'),
+]
+
+# Environment variable to override the cache directory. (Set it empty to
+# disable the cache.)
+CACHE_DIR_KEY = 'LIBEAR_CACHE_DIR'
 
 
 def build_libear(compiler, dst_dir):
-    """ Returns the full path to the 'libear' library. """
+    """ Returns the full path to the 'libear' library.
+
+    The library is built once and reused from the cache directory, when the
+    cache is not disabled. Otherwise it's built into the given directory. """
+
+    cache_dir = cache_directory()
+    if cache_dir:
+        library = build_cached_libear(compiler, cache_dir)
+        if library:
+            return library
+    return compile_libear(compiler, dst_dir)
+
+
+def build_cached_libear(compiler, cache_dir):
+    """ Returns the full path to the cached 'libear' library.
+
+    The cache entry is identified by the compiler, the platform and the
+    library sources. When the entry is missing, it builds the library into
+    a private directory and publish it by renaming the directory. (So,
+    concurrent runs are not seeing partial results.) """
+
+    try:
+        src_dir = os.path.dirname(os.path.realpath(__file__))
+        target_dir = os.path.join(cache_dir, cache_key(compiler, src_dir))
+        library = os.path.join(
+            target_dir, make_toolset(src_dir).shared_library_name('ear'))
+        if is_cache_entry_valid(target_dir, library):
+            logging.debug('Using cached interception library %s', library)
+            return library
+
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        work_dir = tempfile.mkdtemp(prefix='.build-', dir=cache_dir)
+        try:
+            if compile_libear(compiler, work_dir):
+                os.chmod(work_dir, 0o755)
+                os.rename(work_dir, target_dir)
+        except OSError:
+            # other process might published the same entry meanwhile.
+            logging.debug('Could not publish %s', target_dir, exc_info=True)
+        finally:
+            if os.path.isdir(work_dir):
+                shutil.rmtree(work_dir)
+
+        return library if is_cache_entry_valid(target_dir, library) else None
+
+    except Exception:
+        logging.info("Could not use interception library cache.",
+                     exc_info=True)
+        return None
+
+
+def cache_directory(name='libear', variable=CACHE_DIR_KEY):
+    """ Returns the cache directory path, or None if caching is disabled.
+
+    :param name:        the name of the cache directory,
+    :param variable:    the environment variable which overrides it. """
+
+    configured = os.getenv(variable)
+    if configured is not None:
+        return configured if configured else None
+
+    base_dir = os.getenv('XDG_CACHE_HOME') or \
+        os.path.join(os.path.expanduser('~'), '.cache')
+    if not os.path.isabs(base_dir):
+        return None
+    return os.path.join(base_dir, 'scan-build', name)
+
+
+def cache_key(compiler, src_dir):
+    """ Creates the cache entry name for the given compiler.
+
+    The key contains the compiler identity (resolved path, size and
+    modification time), the platform, the library sources and the list of
+    configure checks. """
+
+    digest = hashlib.sha1()
+
+    def update(value):
+        digest.update(str(value).encode('utf-8'))
+        digest.update(b'\0')
+
+    executable = find_executable(compiler)
+    update(compiler)
+    update(executable)
+    if executable:
+        stat = os.stat(executable)
+        update(stat.st_size)
+        update(stat.st_mtime)
+    update(sys.platform)
+    update(platform.machine())
+    update(FUNCTION_CHECKS)
+    update(SYMBOL_CHECKS)
+    for name in ['ear.c', 'config.h.in']:
+        with open(os.path.join(src_dir, name), 'rb') as handle:
+            digest.update(handle.read())
+    return digest.hexdigest()[:20]
+
+
+def is_cache_entry_valid(directory, library):
+    """ Cache entry is valid when both the library and the config exist. """
+
+    return os.path.isfile(library) and \
+        os.path.isfile(os.path.join(directory, 'config.h'))
+
+
+def find_executable(name):
+    """ Returns the resolved path of the executable, or None. """
+
+    if os.path.dirname(name):
+        candidates = [name]
+    else:
+        candidates = [os.path.join(directory, name)
+                      for directory in os.getenv('PATH', '').split(os.pathsep)
+                      if directory]
+    for candidate in candidates:
+        if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+            return os.path.realpath(candidate)
+    return None
+
+
+def compile_libear(compiler, dst_dir):
+    """ Builds the 'libear' library into the given directory.
+
+    Returns the full path to the library or None if it failed. """
 
     try:
         src_dir = os.path.dirname(os.path.realpath(__file__))
@@ -28,19 +185,7 @@ def build_libear(compiler, dst_dir):
         toolset.add_definitions(['-D_GNU_SOURCE'])
 
         configure = do_configure(toolset)
-        configure.check_function_exists('execve', 'HAVE_EXECVE')
-        configure.check_function_exists('execv', 'HAVE_EXECV')
-        configure.check_function_exists('execvpe', 'HAVE_EXECVPE')
-        configure.check_function_exists('execvp', 'HAVE_EXECVP')
-        configure.check_function_exists('execvP', 'HAVE_EXECVP2')
-        configure.check_function_exists('exect', 'HAVE_EXECT')
-        configure.check_function_exists('execl', 'HAVE_EXECL')
-        configure.check_function_exists('execlp', 'HAVE_EXECLP')
-        configure.check_function_exists('execle', 'HAVE_EXECLE')
-        configure.check_function_exists('posix_spawn', 'HAVE_POSIX_SPAWN')
-        configure.check_function_exists('posix_spawnp', 'HAVE_POSIX_SPAWNP')
-        configure.check_symbol_exists('_NSGetEnviron', 'crt_externs.h',
-                                      'HAVE_NSGETENVIRON')
+        configure.check_all(FUNCTION_CHECKS, SYMBOL_CHECKS)
         configure.write_by_template(
             os.path.join(src_dir, 'config.h.in'),
             os.path.join(dst_dir, 'config.h'))
@@ -199,6 +344,21 @@ class Configure(object):
                       'found' if found else 'not found')
         self.results.update({name: found})
 
+    def check_all(self, functions, symbols):
+        """ Run the function and symbol checks concurrently. """
+
+        checks = \
+            [functools.partial(self.check_function_exists, function, name)
+             for function, name in functions] + \
+            [functools.partial(self.check_symbol_exists, symbol, include, name)
+             for symbol, include, name in symbols]
+        pool = ThreadPool(len(checks))
+        try:
+            pool.map(lambda check: check(), checks)
+        finally:
+            pool.close()
+            pool.join()
+
     def write_by_template(self, template, output):
         def transform(line, definitions):
 
@@ -16,7 +16,9 @@
  * the job of the dynamic linker.
  *
  * The only input for the log writing is about the destination directory.
- * This is passed as environment variable.
+ * This is passed as environment variable. Optionally a log file name can be
+ * passed too, then all records are appended to that single file. Or a Unix
+ * domain socket name, then the records are sent to a collector process.
  */
 
 #include "config.h"
@@ -27,8 +29,27 @@
 #include <stdio.h>
 #include <string.h>
 #include <unistd.h>
+#include <fcntl.h>
 #include <dlfcn.h>
 #include <pthread.h>
+#include <errno.h>
+#include <limits.h>
+#include <regex.h>
+#include <time.h>
+#include <sys/time.h>
+#include <stdint.h>
+#include <sys/mman.h>
+#include <sys/socket.h>
+#include <sys/stat.h>
+#include <sys/un.h>
+
+#if defined HAVE_WAIT || defined HAVE_WAITPID || defined HAVE_WAIT3 ||      \
+    defined HAVE_WAIT4 || defined HAVE_WAITID
+#include <sys/wait.h>
+#endif
+#if defined HAVE_WAIT3 || defined HAVE_WAIT4
+#include <sys/resource.h>
+#endif
 
 #if defined HAVE_POSIX_SPAWN || defined HAVE_POSIX_SPAWNP
 #include <spawn.h>
@@ -41,15 +62,55 @@ static char **environ;
 extern char **environ;
 #endif
 
+#ifndef O_CLOEXEC
+# define O_CLOEXEC 0
+#endif
+#ifndef SOCK_CLOEXEC
+# define SOCK_CLOEXEC 0
+#endif
+#ifndef PATH_MAX
+# define PATH_MAX 4096
+#endif
+
+// records shorter than this are formatted without heap allocation.
+#define RECORD_BUFFER_SIZE 16384
+// number of slots visited in the exec index, before the record is written.
+#define EXEC_INDEX_PROBES 64
+// the exec index slot flag of the executions which terminated successfully.
+// (the rest of the slot is the fingerprint of the execution.)
+#define EXEC_INDEX_SUCCEEDED (1ULL << 63)
+// the process id table value of the processes without exec index slot.
+#define EXEC_PIDS_NO_SLOT 0x7fffffffU
+// the process id table flag of the processes with repeated executions only.
+#define EXEC_PIDS_REPEATED 0x80000000U
+// the process termination reports are written into this file of the trace
+// directory. (so those can be read without reading the execution reports.)
+#define STATUS_LOG_FILE "exec_status.log"
+
 #define ENV_OUTPUT "INTERCEPT_BUILD_TARGET_DIR"
 #ifdef APPLE
 # define ENV_FLAT    "DYLD_FORCE_FLAT_NAMESPACE"
 # define ENV_PRELOAD "DYLD_INSERT_LIBRARIES"
-# define ENV_SIZE 3
+# define ENV_REQUIRED 3
 #else
 # define ENV_PRELOAD "LD_PRELOAD"
-# define ENV_SIZE 2
+# define ENV_REQUIRED 2
 #endif
+// optional variables follow the required ones. these are propagated to the
+// children processes, but the library is active without them too.
+#define ENV_TRACE_LOG    "INTERCEPT_BUILD_TRACE_LOG"
+#define ENV_TRACE_SOCKET "INTERCEPT_BUILD_TRACE_SOCKET"
+#define ENV_EXEC_FILTER  "INTERCEPT_BUILD_EXEC_FILTER"
+#define ENV_PROFILE      "INTERCEPT_BUILD_PROFILE"
+#define ENV_EXEC_INDEX   "INTERCEPT_BUILD_EXEC_INDEX"
+#define ENV_EXEC_PIDS    "INTERCEPT_BUILD_EXEC_PIDS"
+#define ENV_IDX_TRACE_LOG    (ENV_REQUIRED + 0)
+#define ENV_IDX_TRACE_SOCKET (ENV_REQUIRED + 1)
+#define ENV_IDX_EXEC_FILTER  (ENV_REQUIRED + 2)
+#define ENV_IDX_PROFILE      (ENV_REQUIRED + 3)
+#define ENV_IDX_EXEC_INDEX   (ENV_REQUIRED + 4)
+#define ENV_IDX_EXEC_PIDS    (ENV_REQUIRED + 5)
+#define ENV_SIZE (ENV_REQUIRED + 6)
 
 #define DLSYM(TYPE_, VAR_, SYMBOL_)                                            \
     union {                                                                    \
@@ -65,15 +126,43 @@ extern char **environ;
 
 typedef char const * bear_env_t[ENV_SIZE];
 
+typedef struct {
+    char *data;
+    size_t length;
+    size_t capacity;
+    int allocated;
+} bear_buffer_t;
+
 static int bear_capture_env_t(bear_env_t *env);
 static void bear_release_env_t(bear_env_t *env);
 static char const **bear_update_environment(char *const envp[], bear_env_t *env);
-static char const **bear_update_environ(char const **in, char const *key, char const *value);
+static void bear_release_environment(char const **modified, char *const original[]);
 static void bear_report_call(char const *const argv[]);
-static void bear_write_json_string(char const *word, FILE *stream);
+static uint32_t bear_report_exec(pid_t pid, pid_t ppid, long long start, char const *const argv[]);
+static void bear_report_exit(void);
+static void bear_report_status(pid_t pid, int status);
+static void bear_report_termination(pid_t pid, int code);
+static int bear_is_reported(char const *const argv[]);
+static void bear_compile_filter(void);
+static int bear_is_new_exec(char const *cwd, char const *const argv[],
+                            uint64_t *fingerprint, uint32_t *slot);
+static void bear_map_exec_index(void);
+static void bear_map_exec_pids(void);
+static void bear_mark_pid(pid_t pid, uint32_t value);
+static int bear_take_pid(pid_t pid, uint32_t *slot, int *repeated);
+static void bear_mark_succeeded(uint32_t slot);
+static uint64_t bear_slot_fingerprint(uint32_t slot);
+static void *bear_map_file(char const *filename, size_t *size);
+static int bear_emit_record(bear_buffer_t const *record);
+static int bear_emit_status_record(bear_buffer_t const *record);
+static int bear_write_record(char const *filename, int flags, bear_buffer_t const *record);
+static int bear_write_record_file(char const *out_dir, bear_buffer_t const *record);
+static long long bear_timestamp(void);
+static int bear_send_record(char const *socket_name, bear_buffer_t const *record);
+static void bear_buffer_append(bear_buffer_t *buffer, char const *data, size_t length);
+static void bear_buffer_append_string(bear_buffer_t *buffer, char const *string);
+static void bear_buffer_append_json_string(bear_buffer_t *buffer, char const *word);
 static char const **bear_strings_build(char const *arg, va_list *ap);
-static char const **bear_strings_copy(char const **const in);
-static char const **bear_strings_append(char const **in, char const *e);
 static size_t bear_strings_length(char const *const *in);
 static void bear_strings_release(char const **);
 
@@ -84,6 +173,12 @@ static bear_env_t env_names =
 #ifdef ENV_FLAT
     , ENV_FLAT
 #endif
+    , ENV_TRACE_LOG
+    , ENV_TRACE_SOCKET
+    , ENV_EXEC_FILTER
+    , ENV_PROFILE
+    , ENV_EXEC_INDEX
+    , ENV_EXEC_PIDS
     };
 
 static bear_env_t initial_env =
@@ -92,11 +187,31 @@ static bear_env_t initial_env =
 #ifdef ENV_FLAT
     , 0
 #endif
+    , 0
+    , 0
+    , 0
+    , 0
+    , 0
+    , 0
     };
 
 static int initialized = 0;
 static pthread_mutex_t mutex = PTHREAD_MUTEX_INITIALIZER;
 
+static unsigned long record_counter = 0;
+
+static regex_t filter;
+static int filter_compiled = 0;
+static pthread_once_t filter_once = PTHREAD_ONCE_INIT;
+
+static uint64_t *exec_index = 0;
+static size_t exec_index_size = 0;
+static pthread_once_t exec_index_once = PTHREAD_ONCE_INIT;
+
+static uint32_t *exec_pids = 0;
+static size_t exec_pids_size = 0;
+static pthread_once_t exec_pids_once = PTHREAD_ONCE_INIT;
+
 static void on_load(void) __attribute__((constructor));
 static void on_unload(void) __attribute__((destructor));
 
@@ -134,6 +249,23 @@ static int call_posix_spawnp(pid_t *restrict pid, const char *restrict file,
                              char *const argv[restrict],
                              char *const envp[restrict]);
 #endif
+#ifdef HAVE_WAIT
+static pid_t call_wait(int *status);
+#endif
+#ifdef HAVE_WAITPID
+static pid_t call_waitpid(pid_t pid, int *status, int options);
+#endif
+#ifdef HAVE_WAIT3
+static pid_t call_wait3(int *status, int options, struct rusage *rusage);
+#endif
+#ifdef HAVE_WAIT4
+static pid_t call_wait4(pid_t pid, int *status, int options,
+                        struct rusage *rusage);
+#endif
+#ifdef HAVE_WAITID
+static int call_waitid(idtype_t idtype, id_t id, siginfo_t *infop,
+                       int options);
+#endif
 
 
 /* Initialization method to Captures the relevant environment variables.
@@ -151,6 +283,8 @@ static void on_load(void) {
 
 static void on_unload(void) {
     pthread_mutex_lock(&mutex);
+    if (initialized && initial_env[ENV_IDX_PROFILE])
+        bear_report_exit();
     bear_release_env_t(&initial_env);
     initialized = 0;
     pthread_mutex_unlock(&mutex);
@@ -267,8 +401,26 @@ int posix_spawn(pid_t *restrict pid, const char *restrict path,
                 const posix_spawn_file_actions_t *file_actions,
                 const posix_spawnattr_t *restrict attrp,
                 char *const argv[restrict], char *const envp[restrict]) {
-    bear_report_call((char const *const *)argv);
-    return call_posix_spawn(pid, path, file_actions, attrp, argv, envp);
+    // the child process id is known only after the call. the execution is
+    // reported before the call (like the exec calls do) without the start
+    // time, the termination of the child refers to it by the exec index.
+    // the build profile needs the child process id, it's reported after
+    // the successful call then.
+    int const profile = initialized && initial_env[ENV_IDX_PROFILE];
+    long long const start = bear_timestamp();
+    uint32_t const mark = (profile)
+        ? 0
+        : bear_report_exec(getpid(), getppid(), -1, (char const *const *)argv);
+    pid_t child = 0;
+    int const result =
+        call_posix_spawn(&child, path, file_actions, attrp, argv, envp);
+    if (0 == result)
+        bear_mark_pid(child, (profile)
+            ? bear_report_exec(child, getpid(), start, (char const *const *)argv)
+            : mark);
+    if (pid)
+        *pid = child;
+    return result;
 }
 #endif
 
@@ -277,8 +429,90 @@ int posix_spawnp(pid_t *restrict pid, const char *restrict file,
                  const posix_spawn_file_actions_t *file_actions,
                  const posix_spawnattr_t *restrict attrp,
                  char *const argv[restrict], char *const envp[restrict]) {
-    bear_report_call((char const *const *)argv);
-    return call_posix_spawnp(pid, file, file_actions, attrp, argv, envp);
+    // the child process id is known only after the call. the execution is
+    // reported before the call (like the exec calls do) without the start
+    // time, the termination of the child refers to it by the exec index.
+    // the build profile needs the child process id, it's reported after
+    // the successful call then.
+    int const profile = initialized && initial_env[ENV_IDX_PROFILE];
+    long long const start = bear_timestamp();
+    uint32_t const mark = (profile)
+        ? 0
+        : bear_report_exec(getpid(), getppid(), -1, (char const *const *)argv);
+    pid_t child = 0;
+    int const result =
+        call_posix_spawnp(&child, file, file_actions, attrp, argv, envp);
+    if (0 == result)
+        bear_mark_pid(child, (profile)
+            ? bear_report_exec(child, getpid(), start, (char const *const *)argv)
+            : mark);
+    if (pid)
+        *pid = child;
+    return result;
+}
+#endif
+
+/* The wait methods are hijacked to report the exit status of the children.
+ * (the status is needed even if the caller is not interested in it.)
+ */
+
+#ifdef HAVE_WAIT
+pid_t wait(int *status) {
+    int child_status = 0;
+    pid_t const result = call_wait(&child_status);
+    bear_report_status(result, child_status);
+    if (status)
+        *status = child_status;
+    return result;
+}
+#endif
+
+#ifdef HAVE_WAITPID
+pid_t waitpid(pid_t pid, int *status, int options) {
+    int child_status = 0;
+    pid_t const result = call_waitpid(pid, &child_status, options);
+    bear_report_status(result, child_status);
+    if (status)
+        *status = child_status;
+    return result;
+}
+#endif
+
+#ifdef HAVE_WAIT3
+pid_t wait3(int *status, int options, struct rusage *rusage) {
+    int child_status = 0;
+    pid_t const result = call_wait3(&child_status, options, rusage);
+    bear_report_status(result, child_status);
+    if (status)
+        *status = child_status;
+    return result;
+}
+#endif
+
+#ifdef HAVE_WAIT4
+pid_t wait4(pid_t pid, int *status, int options, struct rusage *rusage) {
+    int child_status = 0;
+    pid_t const result = call_wait4(pid, &child_status, options, rusage);
+    bear_report_status(result, child_status);
+    if (status)
+        *status = child_status;
+    return result;
+}
+#endif
+
+#ifdef HAVE_WAITID
+int waitid(idtype_t idtype, id_t id, siginfo_t *infop, int options) {
+    int const result = call_waitid(idtype, id, infop, options);
+    // the child is reported when it's reaped. (infop is mandatory.)
+    if (0 == result && infop && !(options & WNOWAIT) && infop->si_pid) {
+        int code = 0;
+        if (CLD_EXITED == infop->si_code)
+            code = infop->si_status;
+        else if (CLD_KILLED == infop->si_code || CLD_DUMPED == infop->si_code)
+            code = 128 + infop->si_status;
+        bear_report_termination(infop->si_pid, code);
+    }
+    return result;
 }
 #endif
 
@@ -294,7 +528,7 @@ static int call_execve(const char *path, char *const argv[],
 
     char const **const menvp = bear_update_environment(envp, &initial_env);
     int const result = (*fp)(path, argv, (char *const *)menvp);
-    bear_strings_release(menvp);
+    bear_release_environment(menvp, envp);
     return result;
 }
 #endif
@@ -308,7 +542,7 @@ static int call_execvpe(const char *file, char *const argv[],
 
     char const **const menvp = bear_update_environment(envp, &initial_env);
     int const result = (*fp)(file, argv, (char *const *)menvp);
-    bear_strings_release(menvp);
+    bear_release_environment(menvp, envp);
     return result;
 }
 #endif
@@ -324,7 +558,7 @@ static int call_execvp(const char *file, char *const argv[]) {
     environ = (char **)modified;
     int const result = (*fp)(file, argv);
     environ = original;
-    bear_strings_release(modified);
+    bear_release_environment(modified, original);
 
     return result;
 }
@@ -342,7 +576,7 @@ static int call_execvP(const char *file, const char *search_path,
     environ = (char **)modified;
     int const result = (*fp)(file, search_path, argv);
     environ = original;
-    bear_strings_release(modified);
+    bear_release_environment(modified, original);
 
     return result;
 }
@@ -357,7 +591,7 @@ static int call_exect(const char *path, char *const argv[],
 
     char const **const menvp = bear_update_environment(envp, &initial_env);
     int const result = (*fp)(path, argv, (char *const *)menvp);
-    bear_strings_release(menvp);
+    bear_release_environment(menvp, envp);
     return result;
 }
 #endif
@@ -378,7 +612,7 @@ static int call_posix_spawn(pid_t *restrict pid, const char *restrict path,
     char const **const menvp = bear_update_environment(envp, &initial_env);
     int const result =
         (*fp)(pid, path, file_actions, attrp, argv, (char *const *restrict)menvp);
-    bear_strings_release(menvp);
+    bear_release_environment(menvp, envp);
     return result;
 }
 #endif
@@ -399,91 +633,581 @@ static int call_posix_spawnp(pid_t *restrict pid, const char *restrict file,
     char const **const menvp = bear_update_environment(envp, &initial_env);
     int const result =
         (*fp)(pid, file, file_actions, attrp, argv, (char *const *restrict)menvp);
-    bear_strings_release(menvp);
+    bear_release_environment(menvp, envp);
     return result;
 }
 #endif
 
+#ifdef HAVE_WAIT
+static pid_t call_wait(int *status) {
+    typedef pid_t (*func)(int *);
+
+    DLSYM(func, fp, "wait");
+
+    return (*fp)(status);
+}
+#endif
+
+#ifdef HAVE_WAITPID
+static pid_t call_waitpid(pid_t pid, int *status, int options) {
+    typedef pid_t (*func)(pid_t, int *, int);
+
+    DLSYM(func, fp, "waitpid");
+
+    return (*fp)(pid, status, options);
+}
+#endif
+
+#ifdef HAVE_WAIT3
+static pid_t call_wait3(int *status, int options, struct rusage *rusage) {
+    typedef pid_t (*func)(int *, int, struct rusage *);
+
+    DLSYM(func, fp, "wait3");
+
+    return (*fp)(status, options, rusage);
+}
+#endif
+
+#ifdef HAVE_WAIT4
+static pid_t call_wait4(pid_t pid, int *status, int options,
+                        struct rusage *rusage) {
+    typedef pid_t (*func)(pid_t, int *, int, struct rusage *);
+
+    DLSYM(func, fp, "wait4");
+
+    return (*fp)(pid, status, options, rusage);
+}
+#endif
+
+#ifdef HAVE_WAITID
+static int call_waitid(idtype_t idtype, id_t id, siginfo_t *infop,
+                       int options) {
+    typedef int (*func)(idtype_t, id_t, siginfo_t *, int);
+
+    DLSYM(func, fp, "waitid");
+
+    return (*fp)(idtype, id, infop, options);
+}
+#endif
+
 /* this method is to write log about the process creation. */
 
 static void bear_report_call(char const *const argv[]) {
+    pid_t const pid = getpid();
+    bear_mark_pid(pid, bear_report_exec(pid, getppid(), bear_timestamp(), argv));
+}
 
-    if (!initialized)
-        return;
+/* the start time is not reported when it's negative. returns the value of
+ * the process id table for the process which runs the command. (zero when
+ * it's not reported.) */
 
-    pthread_mutex_lock(&mutex);
-    const char *cwd = getcwd(NULL, 0);
+static uint32_t bear_report_exec(pid_t pid, pid_t ppid, long long start,
+                                 char const *const argv[]) {
+
+    if (!initialized)
+        return 0;
+    if (!bear_is_reported(argv))
+        return 0;
+
+    // the working directory is read into a stack buffer. the heap allocated
+    // variant is used only for extremely long paths.
+    char cwd_storage[PATH_MAX];
+    char const *cwd = getcwd(cwd_storage, sizeof(cwd_storage));
+    if (0 == cwd && ERANGE == errno)
+        cwd = getcwd(NULL, 0);
     if (0 == cwd) {
         perror("bear: getcwd");
         exit(EXIT_FAILURE);
     }
-    char const * const out_dir = initial_env[0];
-    // generate report file path. file name will be "<pid>_<idx>.json"
-    // it needs to append an index field, since pid is not unique. (many
-    // compiler wrapper just exec another file, therefore sharing pid.)
-    size_t const path_max_length = strlen(out_dir) + 32;
+    uint64_t fingerprint = 0;
+    uint32_t slot = EXEC_PIDS_NO_SLOT;
+    int const is_new = bear_is_new_exec(cwd, argv, &fingerprint, &slot);
+    // the repeated execution is not reported. but its successful
+    // termination is noted in the exec index, like the first one's.
+    uint32_t const mark = ((EXEC_PIDS_NO_SLOT == slot) ? slot : slot + 1) |
+                          ((is_new) ? 0 : EXEC_PIDS_REPEATED);
+    if (!is_new) {
+        if (cwd != cwd_storage)
+            free((void *)cwd);
+        return mark;
+    }
+    // dump the content in JSON format. the whole record is formatted into
+    // memory, so it can be emitted by a single write call.
+    char record_storage[RECORD_BUFFER_SIZE];
+    bear_buffer_t record = { record_storage, 0, sizeof(record_storage), 0 };
+    char header[160];
+    int header_length = snprintf(header, sizeof(header),
+                                 "{ \"pid\": %d, \"ppid\": %d, ",
+                                 (int)pid, (int)ppid);
+    if (header_length >= 0 && start >= 0)
+        header_length += snprintf(header + header_length,
+                                  sizeof(header) - header_length,
+                                  "\"start\": %lld, ", start);
+    if (header_length >= 0 && fingerprint)
+        header_length += snprintf(header + header_length,
+                                  sizeof(header) - header_length,
+                                  "\"exec\": \"%016llx\", ",
+                                  (unsigned long long)fingerprint);
+    if (header_length < 0) {
+        perror("bear: snprintf");
+        exit(EXIT_FAILURE);
+    }
+    bear_buffer_append(&record, header, (size_t)header_length);
+    bear_buffer_append_string(&record, "\"cmd\": [");
+    for (char const *const *it = argv; (it) && (*it); ++it) {
+        if (it != argv) {
+            bear_buffer_append(&record, ",", 1);
+        }
+        bear_buffer_append_json_string(&record, *it);
+    }
+    bear_buffer_append_string(&record, "], \"cwd\": ");
+    bear_buffer_append_json_string(&record, cwd);
+    bear_buffer_append_string(&record, "}\n");
+
+    if (!bear_emit_record(&record)) {
+        perror("bear: open");
+        exit(EXIT_FAILURE);
+    }
+    if (record.allocated)
+        free((void *)record.data);
+    if (cwd != cwd_storage)
+        free((void *)cwd);
+    return mark;
+}
+
+/* this method is to write log about the process termination. it's called
+ * from the destructor, which runs when the process exits normally. (the
+ * exec replaces the process image without calling it.) */
+
+static void bear_report_exit(void) {
+    char record_storage[128];
+    int const length =
+        snprintf(record_storage, sizeof(record_storage),
+                 "{ \"pid\": %d, \"ppid\": %d, \"end\": %lld }\n",
+                 (int)getpid(), (int)getppid(), bear_timestamp());
+    if (length < 0)
+        return;
+    bear_buffer_t const record =
+        { record_storage, (size_t)length, sizeof(record_storage), 0 };
+    // failure is ignored here. (the trace directory might not exist, when
+    // a daemon process outlives the build.)
+    bear_emit_record(&record);
+}
+
+/* this method is to write log about the terminated child processes. only
+ * the children with reported execution are reported (those are marked in the
+ * shared process id table), so the status of a reused process id does not
+ * mix up with the reported one. without the table only the failures are
+ * reported, the successful termination is the common case. the successful
+ * termination is noted in the exec index slot of the execution too. */
+
+static void bear_report_status(pid_t pid, int status) {
+    if (pid <= 0)
+        return;
+    if (WIFEXITED(status))
+        bear_report_termination(pid, WEXITSTATUS(status));
+    else if (WIFSIGNALED(status))
+        bear_report_termination(pid, 128 + WTERMSIG(status));
+}
+
+static void bear_report_termination(pid_t pid, int code) {
+    if (!initialized)
+        return;
+    // the caller might check the errno after the wait call.
+    int const saved_errno = errno;
+    uint32_t slot = EXEC_PIDS_NO_SLOT;
+    int repeated = 0;
+    int const reported = bear_take_pid(pid, &slot, &repeated);
+    if (0 < reported && 0 == code)
+        bear_mark_succeeded(slot);
+    // the repeated executions have no report, their status is not written.
+    if (0 == reported || (0 > reported && 0 == code) || repeated) {
+        errno = saved_errno;
+        return;
+    }
+    // the execution is referred by the exec index too. (the spawned
+    // children are reported with the process id of the parent.)
+    uint64_t const fingerprint = bear_slot_fingerprint(slot);
+    char record_storage[160];
+    int const length = (fingerprint)
+        ? snprintf(record_storage, sizeof(record_storage),
+                   "{ \"pid\": %d, \"ppid\": %d, \"end\": %lld, "
+                   "\"status\": %d, \"exec\": \"%016llx\" }\n",
+                   (int)pid, (int)getpid(), bear_timestamp(), code,
+                   (unsigned long long)fingerprint)
+        : snprintf(record_storage, sizeof(record_storage),
+                   "{ \"pid\": %d, \"ppid\": %d, \"end\": %lld, "
+                   "\"status\": %d }\n",
+                   (int)pid, (int)getpid(), bear_timestamp(), code);
+    if (length > 0) {
+        bear_buffer_t const record =
+            { record_storage, (size_t)length, sizeof(record_storage), 0 };
+        // failure is ignored here, the compilation is kept then.
+        bear_emit_status_record(&record);
+    }
+    errno = saved_errno;
+}
+
+/* the executable name filter is compiled only by those processes which are
+ * executing other processes. (not all processes does that, but all of them
+ * loading this library.) */
+
+static int bear_is_reported(char const *const argv[]) {
+    if (0 == initial_env[ENV_IDX_EXEC_FILTER])
+        return 1;
+    pthread_once(&filter_once, bear_compile_filter);
+    if (!filter_compiled)
+        return 1;
+    // empty command is not a compilation
+    if (0 == argv || 0 == argv[0])
+        return 0;
+    char const *const slash = strrchr(argv[0], '/');
+    char const *const name = (slash) ? slash + 1 : argv[0];
+    return (0 == regexec(&filter, name, 0, 0, 0)) ? 1 : 0;
+}
+
+static void bear_compile_filter(void) {
+    char const *const pattern = initial_env[ENV_IDX_EXEC_FILTER];
+    // report every execution, when the filter is not valid
+    if (pattern && 0 == regcomp(&filter, pattern, REG_EXTENDED | REG_NOSUB))
+        filter_compiled = 1;
+}
+
+/* the exec index is a fixed size hash table of the (cwd, argv) fingerprints
+ * of the already reported executions. it's a file in the trace directory,
+ * which is shared by all processes of the build. the slots are claimed by
+ * atomic compare and swap, no lock is taken. when the table is full (or not
+ * available) every execution is reported. the fingerprint and the slot
+ * index are returned when the table is available (the fingerprint is zero
+ * otherwise), the repeated executions refer to the first one by those. */
+
+static int bear_is_new_exec(char const *cwd, char const *const argv[],
+                            uint64_t *fingerprint, uint32_t *slot) {
+    if (0 == initial_env[ENV_IDX_EXEC_INDEX])
+        return 1;
+    pthread_once(&exec_index_once, bear_map_exec_index);
+    if (0 == exec_index)
+        return 1;
+    // FNV-1a hash of the strings, including their terminating zero.
+    uint64_t hash = 14695981039346656037ULL;
+    for (char const *it = cwd; ; ++it) {
+        hash = (hash ^ (unsigned char)*it) * 1099511628211ULL;
+        if (0 == *it)
+            break;
+    }
+    for (char const *const *arg = argv; (arg) && (*arg); ++arg) {
+        for (char const *it = *arg; ; ++it) {
+            hash = (hash ^ (unsigned char)*it) * 1099511628211ULL;
+            if (0 == *it)
+                break;
+        }
+    }
+    // zero marks the empty slot, the highest bit is the status flag.
+    uint64_t const key =
+        (hash & ~EXEC_INDEX_SUCCEEDED) ? (hash & ~EXEC_INDEX_SUCCEEDED) : 1;
+    *fingerprint = key;
+    for (size_t probe = 0; probe < EXEC_INDEX_PROBES; ++probe) {
+        size_t const index = (key + probe) % exec_index_size;
+        uint64_t const current =
+            __sync_val_compare_and_swap(&exec_index[index], (uint64_t)0, key);
+        if (0 == current || key == (current & ~EXEC_INDEX_SUCCEEDED)) {
+            *slot = (uint32_t)index;
+            return (0 == current) ? 1 : 0;
+        }
+    }
+    return 1;
+}
+
+static void bear_mark_succeeded(uint32_t slot) {
+    if (EXEC_PIDS_NO_SLOT == slot)
+        return;
+    pthread_once(&exec_index_once, bear_map_exec_index);
+    if (0 == exec_index || slot >= exec_index_size)
+        return;
+    __sync_fetch_and_or(&exec_index[slot], EXEC_INDEX_SUCCEEDED);
+}
+
+static uint64_t bear_slot_fingerprint(uint32_t slot) {
+    if (EXEC_PIDS_NO_SLOT == slot)
+        return 0;
+    pthread_once(&exec_index_once, bear_map_exec_index);
+    if (0 == exec_index || slot >= exec_index_size)
+        return 0;
+    return exec_index[slot] & ~EXEC_INDEX_SUCCEEDED;
+}
+
+static void bear_map_exec_index(void) {
+    size_t size = 0;
+    void *const address =
+        bear_map_file(initial_env[ENV_IDX_EXEC_INDEX], &size);
+    if (address && size >= sizeof(uint64_t)) {
+        exec_index = (uint64_t *)address;
+        exec_index_size = size / sizeof(uint64_t);
+        // the slot index shall fit into the process id table entry.
+        if (exec_index_size >= EXEC_PIDS_NO_SLOT)
+            exec_index_size = EXEC_PIDS_NO_SLOT - 1;
+    }
+}
+
+/* the process id table has an entry for every process id: the exec index
+ * slot of the process with reported execution (or a marker when it has no
+ * slot), and zero for the others. it's a file in the trace directory (like
+ * the exec index), the entry is set at the exec report and cleared when the
+ * parent reaps the child. the slot index is stored plus one, the highest bit
+ * is set when the process has repeated executions only. (an exec chain
+ * with a reported execution keeps that flag cleared.) */
+
+static void bear_mark_pid(pid_t pid, uint32_t value) {
+    if (0 == initial_env[ENV_IDX_EXEC_PIDS] || pid <= 0 || 0 == value)
+        return;
+    pthread_once(&exec_pids_once, bear_map_exec_pids);
+    if (0 == exec_pids || (size_t)pid >= exec_pids_size)
+        return;
+    uint32_t current = exec_pids[pid];
+    for (;;) {
+        int const keep_reported =
+            (0 != current) && !(current & EXEC_PIDS_REPEATED);
+        uint32_t const next =
+            (keep_reported) ? (value & ~EXEC_PIDS_REPEATED) : value;
+        uint32_t const previous =
+            __sync_val_compare_and_swap(&exec_pids[pid], current, next);
+        if (previous == current)
+            return;
+        current = previous;
+    }
+}
+
+/* returns 1 when the process was marked, 0 when it was not, and -1 when
+ * it's not known. (the table is not available.) the exec index slot and the
+ * repeated flag of the marked process are returned too. */
+
+static int bear_take_pid(pid_t pid, uint32_t *slot, int *repeated) {
+    if (0 == initial_env[ENV_IDX_EXEC_PIDS])
+        return -1;
+    pthread_once(&exec_pids_once, bear_map_exec_pids);
+    if (0 == exec_pids || (size_t)pid >= exec_pids_size)
+        return -1;
+    uint32_t const previous =
+        __sync_lock_test_and_set(&exec_pids[pid], (uint32_t)0);
+    if (0 == previous)
+        return 0;
+    uint32_t const tag = previous & ~EXEC_PIDS_REPEATED;
+    *slot = (EXEC_PIDS_NO_SLOT == tag) ? tag : tag - 1;
+    *repeated = (previous & EXEC_PIDS_REPEATED) ? 1 : 0;
+    return 1;
+}
+
+static void bear_map_exec_pids(void) {
+    size_t size = 0;
+    void *const address = bear_map_file(initial_env[ENV_IDX_EXEC_PIDS], &size);
+    if (address) {
+        exec_pids = (uint32_t *)address;
+        exec_pids_size = size / sizeof(uint32_t);
+    }
+}
+
+/* maps the whole file into memory (shared with the other processes), returns
+ * null when it's not possible. */
+
+static void *bear_map_file(char const *filename, size_t *size) {
+    int const fd = open(filename, O_RDWR | O_CLOEXEC);
+    if (-1 == fd)
+        return 0;
+    void *result = 0;
+    struct stat info;
+    if (0 == fstat(fd, &info) && info.st_size > 0) {
+        void *const address = mmap(0, (size_t)info.st_size,
+                                   PROT_READ | PROT_WRITE, MAP_SHARED, fd, 0);
+        if (MAP_FAILED != address) {
+            result = address;
+            *size = (size_t)info.st_size;
+        }
+    }
+    close(fd);
+    return result;
+}
+
+/* returns false when the record could not be written. */
+
+static int bear_emit_record(bear_buffer_t const *record) {
+    // send the record to the collector process when it's listening. it
+    // falls back to the files, when the record could not be delivered.
+    // (eg.: the record is bigger than the maximum datagram size.)
+    char const * const trace_socket = initial_env[ENV_IDX_TRACE_SOCKET];
+    if (trace_socket && bear_send_record(trace_socket, record))
+        return 1;
+
+    char const * const trace_log = initial_env[ENV_IDX_TRACE_LOG];
+    if (trace_log) {
+        // append the record to the shared log file. O_APPEND makes the
+        // single write atomic against the other processes of the build.
+        return bear_write_record(trace_log, O_APPEND | O_CREAT, record);
+    }
+    return bear_write_record_file(initial_env[0], record);
+}
+
+/* returns false when the record could not be written. */
+
+static int bear_emit_status_record(bear_buffer_t const *record) {
+    char const *const out_dir = initial_env[0];
+    size_t const path_max_length =
+        strlen(out_dir) + sizeof(STATUS_LOG_FILE) + 1;
     char filename[path_max_length];
-    for (int idx = 0; idx < 100; ++idx) {
-        if (-1 == snprintf(filename, path_max_length, "%s/%d_%d.json", out_dir, getpid(), idx)) {
+    if (0 > snprintf(filename, path_max_length, "%s/%s", out_dir,
+                     STATUS_LOG_FILE))
+        return 0;
+    // O_APPEND makes the single write atomic against the other processes.
+    return bear_write_record(filename, O_APPEND | O_CREAT, record);
+}
+
+static int bear_write_record_file(char const *out_dir,
+                                  bear_buffer_t const *record) {
+    // generate report file path. file name will be
+    // "<pid>_<timestamp>_<counter>.json". the pid is not unique, since many
+    // compiler wrapper just exec another file. (the counter does not help
+    // then, the exec resets it.) the timestamp makes it unique across exec.
+    // the O_EXCL flag guards against the unlikely collisions.
+    size_t const path_max_length = strlen(out_dir) + 80;
+    char filename[path_max_length];
+    for (int retry = 0; retry < 100; ++retry) {
+        unsigned long const counter =
+            __sync_fetch_and_add(&record_counter, 1);
+        if (0 > snprintf(filename, path_max_length, "%s/%d_%lld_%lu.json",
+                         out_dir, getpid(), bear_timestamp(), counter)) {
             perror("bear: snprintf");
             exit(EXIT_FAILURE);
         }
-        if (-1 == access(filename, W_OK)) {
+        if (bear_write_record(filename, O_CREAT | O_EXCL, record))
+            return 1;
+        if (EEXIST != errno)
             break;
-        }
     }
-    FILE * fd = fopen(filename, "w+");
-    if (0 == fd) {
-        perror("bear: fopen");
+    return 0;
+}
+
+/* returns nanoseconds from a monotonic clock. (or the wall clock time, when
+ * the monotonic clock is not available.) */
+
+static long long bear_timestamp(void) {
+#ifdef HAVE_CLOCK_GETTIME
+    struct timespec now;
+    if (0 == clock_gettime(CLOCK_MONOTONIC, &now))
+        return (long long)now.tv_sec * 1000000000LL + now.tv_nsec;
+#endif
+    struct timeval wall;
+    gettimeofday(&wall, 0);
+    return (long long)wall.tv_sec * 1000000000LL + wall.tv_usec * 1000LL;
+}
+
+static int bear_send_record(char const *socket_name,
+                            bear_buffer_t const *record) {
+    struct sockaddr_un address;
+    size_t const name_length = strlen(socket_name);
+    if (name_length >= sizeof(address.sun_path))
+        return 0;
+    memset(&address, 0, sizeof(address));
+    address.sun_family = AF_UNIX;
+    memcpy(address.sun_path, socket_name, name_length + 1);
+
+    int const fd = socket(AF_UNIX, SOCK_DGRAM | SOCK_CLOEXEC, 0);
+    if (-1 == fd)
+        return 0;
+    // the collector is not waited, when it's busy the record goes to file.
+    ssize_t sent;
+    do {
+        sent = sendto(fd, record->data, record->length, MSG_DONTWAIT,
+                      (struct sockaddr const *)&address, sizeof(address));
+    } while (-1 == sent && EINTR == errno);
+    close(fd);
+    return (-1 != sent && (size_t)sent == record->length) ? 1 : 0;
+}
+
+/* returns false when the file could not be opened. */
+
+static int bear_write_record(char const *filename, int flags,
+                             bear_buffer_t const *record) {
+    int const fd = open(filename, O_WRONLY | O_CLOEXEC | flags, 0666);
+    if (-1 == fd)
+        return 0;
+    ssize_t const written = write(fd, record->data, record->length);
+    if (-1 == written || (size_t)written != record->length) {
+        perror("bear: write");
         exit(EXIT_FAILURE);
     }
-    // dump the content in JSON format
-    fprintf(fd, "{ \"pid\": %d, \"cmd\": [", getpid());
-    for (char const *const *it = argv; (it) && (*it); ++it) {
-        if (it != argv) {
-            fputc(',', fd);
-        }
-        bear_write_json_string(*it, fd);
-    }
-    fputs("], \"cwd\": ", fd);
-    bear_write_json_string(cwd, fd);
-    fputc('}', fd);
-    if (fclose(fd)) {
-        perror("bear: fclose");
+    if (close(fd)) {
+        perror("bear: close");
         exit(EXIT_FAILURE);
     }
-    free((void *)cwd);
-    pthread_mutex_unlock(&mutex);
+    return 1;
 }
 
-static void bear_write_json_string(char const *word, FILE *fd) {
-    fputc('"', fd);
+static void bear_buffer_append(bear_buffer_t *buffer, char const *data,
+                               size_t length) {
+    if (buffer->length + length > buffer->capacity) {
+        size_t capacity = (buffer->capacity) ? buffer->capacity : 1024;
+        while (buffer->length + length > capacity)
+            capacity *= 2;
+        // the initial storage is not owned by the buffer, copy it.
+        char *const grown = (buffer->allocated)
+            ? realloc(buffer->data, capacity)
+            : malloc(capacity);
+        if (0 == grown) {
+            perror("bear: realloc");
+            exit(EXIT_FAILURE);
+        }
+        if (!buffer->allocated && buffer->length)
+            memcpy(grown, buffer->data, buffer->length);
+        buffer->data = grown;
+        buffer->capacity = capacity;
+        buffer->allocated = 1;
+    }
+    memcpy(buffer->data + buffer->length, data, length);
+    buffer->length += length;
+}
+
+static void bear_buffer_append_string(bear_buffer_t *buffer,
+                                      char const *string) {
+    bear_buffer_append(buffer, string, strlen(string));
+}
+
+static void bear_buffer_append_json_string(bear_buffer_t *buffer,
+                                           char const *word) {
+    bear_buffer_append(buffer, "\"", 1);
+    // copy the characters which need no escaping in chunks.
+    char const *chunk = word;
     for (char const * it = word; *it; ++it) {
-        char const current = *it;
-        switch (current) {
+        char const *escaped = 0;
+        switch (*it) {
         case '\b':
-            fputs("\\b", fd);
+            escaped = "\\b";
             break;
         case '\f':
-            fputs("\\f", fd);
+            escaped = "\\f";
             break;
         case '\n':
-            fputs("\\n", fd);
+            escaped = "\\n";
             break;
         case '\r':
-            fputs("\\r", fd);
+            escaped = "\\r";
             break;
         case '\t':
-            fputs("\\t", fd);
+            escaped = "\\t";
             break;
         case '"':
+            escaped = "\\\"";
+            break;
         case '\\':
-            fputc('\\', fd);
+            escaped = "\\\\";
+            break;
         default:
-            fputc(current, fd);
+            continue;
         }
+        bear_buffer_append(buffer, chunk, (size_t)(it - chunk));
+        bear_buffer_append(buffer, escaped, 2);
+        chunk = it + 1;
     }
-    fputc('"', fd);
+    bear_buffer_append_string(buffer, chunk);
+    bear_buffer_append(buffer, "\"", 1);
 }
 
 /* update environment assure that chilren processes will copy the desired
@@ -495,7 +1219,8 @@ static int bear_capture_env_t(bear_env_t *env) {
         char const * const env_value = getenv(env_names[it]);
         char const * const env_copy = (env_value) ? strdup(env_value) : env_value;
         (*env)[it] = env_copy;
-        status &= (env_copy) ? 1 : 0;
+        if (it < ENV_REQUIRED)
+            status &= (env_copy) ? 1 : 0;
     }
     return status;
 }
@@ -507,41 +1232,77 @@ static void bear_release_env_t(bear_env_t *env) {
     }
 }
 
-static char const **bear_update_environment(char *const envp[], bear_env_t *env) {
-    char const **result = bear_strings_copy((char const **)envp);
-    for (size_t it = 0; it < ENV_SIZE && (*env)[it]; ++it)
-        result = bear_update_environ(result, env_names[it], (*env)[it]);
-    return result;
-}
+/* the environment is passed through untouched, when it contains the desired
+ * variables already. (it's the common case, since the build tools rarely
+ * clean the environment.) otherwise a modified copy is created. the copy is
+ * a single allocation: the pointer array followed by the new entries. the
+ * unchanged entries are shared with the original environment. */
 
-static char const **bear_update_environ(char const *envs[], char const *key, char const * const value) {
-    // find the key if it's there
-    size_t const key_length = strlen(key);
-    char const **it = envs;
-    for (; (it) && (*it); ++it) {
-        if ((0 == strncmp(*it, key, key_length)) &&
-            (strlen(*it) > key_length) && ('=' == (*it)[key_length]))
-            break;
+static char const **bear_update_environment(char *const envp[], bear_env_t *env) {
+    // find the desired variables in the environment
+    size_t position[ENV_SIZE];
+    int changed[ENV_SIZE];
+    size_t const env_count = bear_strings_length((char const *const *)envp);
+    size_t missing = 0;
+    size_t extra_length = 0;
+    for (size_t it = 0; it < ENV_SIZE; ++it) {
+        position[it] = env_count;
+        changed[it] = 0;
+        if (0 == (*env)[it])
+            continue;
+        size_t const key_length = strlen(env_names[it]);
+        for (size_t idx = 0; idx < env_count; ++idx) {
+            if ((0 == strncmp(envp[idx], env_names[it], key_length)) &&
+                ('=' == envp[idx][key_length])) {
+                position[it] = idx;
+                break;
+            }
+        }
+        int const found = (position[it] != env_count);
+        if (found && 0 == strcmp(envp[position[it]] + key_length + 1, (*env)[it]))
+            continue;
+        // this variable needs to be (re)written
+        changed[it] = 1;
+        extra_length += key_length + strlen((*env)[it]) + 2;
+        if (!found)
+            ++missing;
     }
-    // allocate a environment entry
-    size_t const value_length = strlen(value);
-    size_t const env_length = key_length + value_length + 2;
-    char *env = malloc(env_length);
-    if (0 == env) {
+    if (0 == extra_length)
+        return (char const **)envp;
+
+    size_t const pointers_size = (env_count + missing + 1) * sizeof(char const *);
+    char const **const result = malloc(pointers_size + extra_length);
+    if (0 == result) {
         perror("bear: malloc [in env_update]");
         exit(EXIT_FAILURE);
     }
-    if (-1 == snprintf(env, env_length, "%s=%s", key, value)) {
-        perror("bear: snprintf");
-        exit(EXIT_FAILURE);
-    }
-    // replace or append the environment entry
-    if (it && *it) {
-        free((void *)*it);
-        *it = env;
-	return envs;
+    if (env_count)
+        memcpy((void *)result, (void const *)envp, env_count * sizeof(char const *));
+    size_t result_count = env_count;
+    char *storage = (char *)result + pointers_size;
+    for (size_t it = 0; it < ENV_SIZE; ++it) {
+        if (!changed[it])
+            continue;
+        size_t const key_length = strlen(env_names[it]);
+        size_t const value_length = strlen((*env)[it]);
+        memcpy(storage, env_names[it], key_length);
+        storage[key_length] = '=';
+        memcpy(storage + key_length + 1, (*env)[it], value_length + 1);
+        // replace or append the environment entry
+        if (position[it] != env_count)
+            result[position[it]] = storage;
+        else
+            result[result_count++] = storage;
+        storage += key_length + value_length + 2;
     }
-    return bear_strings_append(envs, env);
+    result[result_count] = 0;
+    return result;
+}
+
+static void bear_release_environment(char const **modified,
+                                     char *const original[]) {
+    if ((char const **)original != modified)
+        free((void *)modified);
 }
 
 /* util methods to deal with string arrays. environment and process arguments
@@ -573,41 +1334,6 @@ static char const **bear_strings_build(char const *const arg, va_list *args) {
     return result;
 }
 
-static char const **bear_strings_copy(char const **const in) {
-    size_t const size = bear_strings_length(in);
-
-    char const **const result = malloc((size + 1) * sizeof(char const *));
-    if (0 == result) {
-        perror("bear: malloc");
-        exit(EXIT_FAILURE);
-    }
-
-    char const **out_it = result;
-    for (char const *const *in_it = in; (in_it) && (*in_it);
-         ++in_it, ++out_it) {
-        *out_it = strdup(*in_it);
-        if (0 == *out_it) {
-            perror("bear: strdup");
-            exit(EXIT_FAILURE);
-        }
-    }
-    *out_it = 0;
-    return result;
-}
-
-static char const **bear_strings_append(char const **const in,
-                                        char const *const e) {
-    size_t size = bear_strings_length(in);
-    char const **result = realloc(in, (size + 2) * sizeof(char const *));
-    if (0 == result) {
-        perror("bear: realloc");
-        exit(EXIT_FAILURE);
-    }
-    result[size++] = e;
-    result[size++] = 0;
-    return result;
-}
-
 static size_t bear_strings_length(char const *const *const in) {
     size_t result = 0;
     for (char const *const *it = in; (it) && (*it); ++it)
@@ -11,14 +11,57 @@ import logging
 import os
 import os.path
 import re
-import shlex
 import subprocess
 import sys
+import time
+
+try:
+    from os import scandir
+except ImportError:
+    scandir = None
 
 ENVIRONMENT_KEY = 'INTERCEPT_BUILD'
 
 Execution = collections.namedtuple('Execution', ['pid', 'cwd', 'cmd'])
 
+# the CLOCK_MONOTONIC clock id of Linux (for python 2, where the time module
+# can't read it)
+LINUX_CLOCK_MONOTONIC = 1
+
+
+def monotonic():
+    """ Returns the time of the CLOCK_MONOTONIC clock in nanoseconds.
+
+    The interception library reports the timestamps of the same clock, so
+    those are comparable. (On python 2 the clock is read through `ctypes`
+    on Linux.) It returns None when the clock is not available. """
+
+    if hasattr(time, 'clock_gettime_ns'):
+        return time.clock_gettime_ns(time.CLOCK_MONOTONIC)
+    if hasattr(time, 'clock_gettime'):
+        return int(time.clock_gettime(time.CLOCK_MONOTONIC) * 1e9)
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        import ctypes
+        import ctypes.util
+
+        class Timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+        # older C libraries have it in the real-time library
+        for name in ['c', 'rt']:
+            library = ctypes.util.find_library(name)
+            clock_gettime = getattr(ctypes.CDLL(library), 'clock_gettime',
+                                    None) if library else None
+            now = Timespec()
+            if clock_gettime and clock_gettime(LINUX_CLOCK_MONOTONIC,
+                                               ctypes.byref(now)) == 0:
+                return now.tv_sec * 1000000000 + now.tv_nsec
+    except (ImportError, OSError):
+        pass
+    return None
+
 
 def shell_split(string):
     """ Takes a command string and returns as a list. """
@@ -28,9 +71,66 @@ def shell_split(string):
 
         if len(arg) >= 2 and arg[0] == arg[-1] and arg[0] == '"':
             return re.sub(r'\\(["\\])', r'\1', arg[1:-1])
+        if '\\' not in arg:
+            return arg
         return re.sub(r'\\([\\ $%&\(\)\[\]\{\}\*|<>@?!])', r'\1', arg)
 
-    return [unescape(token) for token in shlex.split(string)]
+    return [unescape(token) for token in shell_tokens(string)]
+
+
+# The quoted strings and the escaped characters of a shell command. (The rest
+# of the command is split by the whitespace characters.)
+SHELL_QUOTED = re.compile(r"""('[^']*'|"[^"\\]*(?:\\.[^"\\]*)*"|\\.)""",
+                          re.DOTALL)
+SHELL_WORD = re.compile(r'[^ \t\r\n]+')
+SHELL_DOUBLE_QUOTED_ESCAPE = re.compile(r'\\([\\"])')
+SHELL_WHITESPACE = ' \t\r\n'
+
+
+def shell_tokens(string):
+    """ Splits the string into words the same way as `shlex.split` does.
+
+    (The `shlex` module parses the string character by character, which is
+    slow for long compiler command lines.) The string is cut into unquoted
+    and quoted parts by a regular expression, the unquoted parts are split
+    by the whitespace characters, and the neighbouring parts are joined.
+
+    :param string: the command string
+    :return: list of words """
+
+    # the most common case: there is nothing to resolve
+    if '\'' not in string and '"' not in string and '\\' not in string:
+        return SHELL_WORD.findall(string)
+
+    result = []
+    current = None  # the last word, which might continue in the next part
+    for index, part in enumerate(SHELL_QUOTED.split(string)):
+        if index % 2:
+            if part[0] == '\\':
+                value = part[1]
+            elif part[0] == '\'':
+                value = part[1:-1]
+            else:
+                value = SHELL_DOUBLE_QUOTED_ESCAPE.sub(r'\1', part[1:-1])
+            current = value if current is None else current + value
+        elif part:
+            if '\'' in part or '"' in part:
+                raise ValueError('No closing quotation')
+            elif '\\' in part:
+                raise ValueError('No escaped character')
+            words = SHELL_WORD.findall(part)
+            if current is not None:
+                if part[0] in SHELL_WHITESPACE:
+                    result.append(current)
+                else:
+                    words[0] = current + words[0]
+                current = None
+            if part[-1] not in SHELL_WHITESPACE:
+                current = words.pop()
+            result.extend(words)
+    if current is not None:
+        result.append(current)
+    return result
 
 
 def tempdir():
@@ -39,6 +139,97 @@ def tempdir():
     return os.getenv('TMPDIR', os.getenv('TEMP', os.getenv('TMP', '/tmp')))
 
 
+# File system caches of a post-processing pass. The source files of a project
+# are checked many times (once per compilation), while the files are not
+# expected to change during one pass. (Call `clear_file_system_caches` at the
+# start and at the end of the pass.)
+DIRECTORY_LISTINGS = dict()
+REAL_PATHS = dict()
+
+
+def clear_file_system_caches():
+    """ Forgets the results of the `is_file` and `real_path` calls. """
+
+    DIRECTORY_LISTINGS.clear()
+    REAL_PATHS.clear()
+
+
+def is_file(path):
+    """ Cached version of `os.path.isfile`.
+
+    Instead of calling `stat` on every file, it lists the parent directory
+    once (with `scandir`) and answers the checks of the files in the same
+    directory from that listing. The entry type comes from the directory
+    listing, a `stat` call is only needed for symbolic links and for the
+    names which are not in the listing. (Those are not cached, the file
+    might be created later.)
+
+    :param path: the file name to check
+    :return: True if the path is an existing regular file """
+
+    directory, name = os.path.split(os.path.abspath(path))
+    if directory not in DIRECTORY_LISTINGS:
+        DIRECTORY_LISTINGS[directory] = list_directory(directory)
+    listing = DIRECTORY_LISTINGS[directory]
+    if listing is None:
+        return False
+    if name not in listing:
+        # the file system might be case-insensitive (the name could still
+        # match an entry with different case), so ask the file system
+        return os.path.isfile(path)
+    entry = listing[name]
+    if not isinstance(entry, bool):
+        entry = listing[name] = _is_file_entry(entry, directory)
+    return entry
+
+
+def list_directory(directory):
+    """ Returns the entries of the directory as dictionary (the name is the
+    key), or None when the directory can't be read.
+
+    The values are `DirEntry` objects, or (when `scandir` is not available)
+    the entry names, which will be resolved on first use. """
+
+    try:
+        if scandir is None:
+            return dict((name, name) for name in os.listdir(directory))
+        return dict((entry.name, entry) for entry in scandir(directory))
+    except OSError:
+        return None
+
+
+def _is_file_entry(entry, directory):
+    """ Resolves a directory entry into a boolean value. """
+
+    if scandir is None:
+        return os.path.isfile(os.path.join(directory, entry))
+    try:
+        return entry.is_file()
+    except OSError:
+        return False
+
+
+def real_path(path):
+    """ Cached version of `os.path.realpath`. """
+
+    try:
+        return REAL_PATHS[path]
+    except KeyError:
+        result = REAL_PATHS[path] = os.path.realpath(path)
+        return result
+
+
+def canonical_path(path):
+    """ Resolves the symbolic links of the directory of the given file.
+
+    Only the directory is resolved (and cached), so the files of the same
+    directory cost one resolution together. (A symbolic link to the file
+    itself is kept as it is.) """
+
+    directory, name = os.path.split(os.path.abspath(path))
+    return os.path.join(real_path(directory), name)
+
+
 def run_build(command, *args, **kwargs):
     """ Run and report build command execution
 
@@ -145,6 +336,8 @@ def wrapper_entry_point(function):
 
     - execution:    the command executed by the wrapper.
     - result:       the exit code of the compilation.
+    - start:        the start time of the compilation (in nanoseconds).
+    - end:          the end time of the compilation (in nanoseconds).
 
     The return value will be the exit code of the compiler call. (The
     decorated method return value is ignored.)
@@ -173,7 +366,10 @@ def wrapper_entry_point(function):
         # execute compilation with the real compiler
         command = real_compiler + sys.argv[1:]
         logging.debug('compilation: %s', command)
+        # the timestamps are None, when the clock is not available
+        start = monotonic()
         result = subprocess.call(command)
+        end = monotonic() if start is not None else None
         logging.debug('compilation exit code: %d', result)
         # call the wrapped method and ignore it's return value ...
         try:
@@ -181,7 +377,7 @@ def wrapper_entry_point(function):
                 pid=os.getpid(),
                 cwd=os.getcwd(),
                 cmd=['ar' if is_ar else ('c++' if is_cxx else 'cc')] + sys.argv[1:])
-            function(execution=call, result=result)
+            function(execution=call, result=result, start=start, end=end)
         except:
             logging.exception('Compiler wrapper failed complete.')
         # ... return the real compiler exit code instead.
@@ -13,24 +13,28 @@ To run the static analyzer against a build is done in multiple steps:
 
 import re
 import os
+import sys
 import os.path
 import json
 import logging
 import multiprocessing
 import tempfile
 import functools
+import itertools
 import subprocess
 import platform
 import contextlib
 import datetime
+import threading
 
+from libear import temporary_directory
 from libscanbuild import command_entry_point, wrapper_entry_point, \
-    wrapper_environment, run_build, run_command
+    wrapper_environment, run_build, run_command, tempdir, real_path
 from libscanbuild.arguments import scan, analyze
 from libscanbuild.intercept import capture
 from libscanbuild.report import document
 from libscanbuild.compilation import Compilation, classify_source, \
-    CompilationDatabase
+    CompilationDatabase, canonicalize
 from libscanbuild.clang import get_version, get_arguments
 
 __all__ = ['scan_build', 'analyze_build', 'analyze_build_wrapper']
@@ -38,6 +42,8 @@ __all__ = ['scan_build', 'analyze_build', 'analyze_build_wrapper']
 COMPILER_WRAPPER_CC = 'analyze-cc'
 COMPILER_WRAPPER_CXX = 'analyze-c++'
 ENVIRONMENT_KEY = 'ANALYZE_BUILD'
+# Number of analyzer tasks per process, which are queued in advance.
+PENDING_TASKS_PER_PROCESS = 4
 
 
 @command_entry_point
@@ -53,10 +59,17 @@ def scan_build():
         # for the Makefile.
         if args.intercept_first:
             # run build command with intercept module
-            exit_code, compilations = capture(args)
-            if need_analyzer(args.build):
-                # run the analyzer against the captured commands
-                run_analyzer_parallel(compilations, args)
+            with temporary_directory(prefix='intercept-',
+                                     dir=tempdir()) as tmp_dir:
+                exit_code, compilations = capture(args, tmp_dir)
+                if need_analyzer(args.build):
+                    # run the analyzer against the captured commands
+                    run_analyzer_parallel(compilations, args)
+                else:
+                    # process the captured commands anyway, to write the
+                    # compiler configuration
+                    for _ in compilations:
+                        pass
         else:
             # run build command and analyzer with compiler wrappers
             environment = setup_environment(args)
@@ -72,10 +85,18 @@ def analyze_build():
     """ Entry point for analyze-build command. """
 
     args = analyze()
+    if args.diff:
+        delta = CompilationDatabase.diff(args.diff, args.cdb, args.shards)
+        json.dump(delta, sys.stdout, sort_keys=True, indent=4)
+        sys.stdout.write('\n')
+        return 0
     # will re-assign the report directory as new output
     with report_directory(args.output, args.keep_empty) as args.output:
         # run the analyzer against a compilation db
-        compilations = CompilationDatabase.load(args.cdb)
+        compilations = itertools.chain.from_iterable(
+            CompilationDatabase.load(filename, args.trust_cdb,
+                                     indexed=args.index_cdb)
+            for filename in CompilationDatabase.files(args.cdb, args.shards))
         run_analyzer_parallel(compilations, args)
         # cover report generation and bug counting
         number_of_bugs = document(args)
@@ -164,11 +185,25 @@ def run_analyzer_parallel(compilations, args):
 
     logging.debug('run analyzer against compilation database')
     consts = analyze_parameters(args)
+    if args.canonicalize_paths:
+        compilations = canonicalize(compilations)
     parameters = (dict(compilation.to_analyzer(), **consts)
                   for compilation in compilations)
     # when verbose output requested execute sequentially
-    pool = multiprocessing.Pool(1 if args.verbose > 2 else None)
-    for current in pool.imap_unordered(run, parameters):
+    processes = 1 if args.verbose > 2 else multiprocessing.cpu_count()
+    # The pool would consume the compilations as fast as it can. Limiting
+    # the number of pending tasks keeps the memory use bounded, and the
+    # compilations are read only when the analyzer is ready for them.
+    pending = threading.Semaphore(processes * PENDING_TASKS_PER_PROCESS)
+
+    def throttled(iterable):
+        for item in iterable:
+            pending.acquire()
+            yield item
+
+    pool = multiprocessing.Pool(processes)
+    for current in pool.imap_unordered(run, throttled(parameters)):
+        pending.release()
         logging_analyzer_output(current)
     pool.close()
     pool.join()
@@ -526,7 +561,8 @@ def classify_parameters(opts, continuation=arch_check):
 @require(['source', 'excludes'])
 def exclude(opts, continuation=classify_parameters):
     """ Analysis might be skipped, when one of the requested excluded
-    directory contains the file. """
+    directory contains the file. (Symbolic links of the file and the
+    directories are resolved too.) """
 
     def contains(directory, entry):
         # When a directory contains a file, then the relative path to the
@@ -534,7 +570,12 @@ def exclude(opts, continuation=classify_parameters):
         relative = os.path.relpath(entry, directory).split(os.sep)
         return len(relative) and relative[0] != os.pardir
 
-    if any(contains(dir, opts['source']) for dir in opts['excludes']):
+    source = opts['source']
+    candidates = set([source, real_path(source)])
+    directories = set(opts['excludes'])
+    directories.update(real_path(directory) for directory in opts['excludes'])
+    if any(contains(directory, entry)
+           for directory in directories for entry in candidates):
         logging.debug('skip analysis, file requested to exclude')
         return None
     else:
@@ -14,11 +14,13 @@ Validations are mostly calling specific help methods, or mangling values.
 """
 
 import os
+import re
 import sys
 import argparse
 import logging
 from libscanbuild import reconfigure_logging, tempdir
 from libscanbuild.clang import get_checkers
+from libscanbuild.compilation import CompilationDatabase, entry_filter
 
 __all__ = ['intercept', 'analyze', 'scan']
 
@@ -35,6 +37,18 @@ def intercept():
     # short validation logic
     if not args.build:
         parser.error(message='missing build command')
+    if args.shard_map:
+        if args.append:
+            parser.error(message='--shard-map is not allowed with --append')
+        args.shards = True
+    try:
+        args.entry_filter = entry_filter(args.include_paths,
+                                         args.exclude_paths,
+                                         args.include_patterns,
+                                         args.exclude_patterns,
+                                         args.exclude_kinds)
+    except re.error as error:
+        parser.error(message='invalid regular expression: {0}'.format(error))
 
     logging.debug('Parsed arguments: %s', args)
     return args
@@ -87,6 +101,16 @@ def analyze_validate(parser, args, from_build_command):
         parser.error(message='missing build command')
     elif not from_build_command and not os.path.exists(args.cdb):
         parser.error(message='compilation database is missing')
+    elif not from_build_command and args.diff and \
+            not os.path.exists(args.diff):
+        parser.error(message='compared compilation database is missing')
+    elif not from_build_command:
+        try:
+            CompilationDatabase.files(args.cdb, args.shards)
+            if args.diff:
+                CompilationDatabase.files(args.diff, args.shards)
+        except ValueError as error:
+            parser.error(message=str(error))
 
     # Make exclude directory list unique and absolute
     uniq_excludes = set(os.path.abspath(entry) for entry in args.excludes)
@@ -100,6 +124,10 @@ def analyze_validate(parser, args, from_build_command):
     if from_build_command:
         # add cdb parameter invisibly to make report module working
         args.cdb = 'compile_commands.json'
+        # the build profile is available only for the intercept command
+        args.build_profile = None
+        args.shards = None
+        args.diff = None
 
 
 def intercept_parser():
@@ -110,6 +138,8 @@ def intercept_parser():
 
     parser_add_prefer_wrapper(parser)
     parser_add_compilers(parser)
+    parser_add_trace_mode(parser)
+    parser_add_trace_jobs(parser)
 
     advanced = parser.add_argument_group('advanced options')
     group = advanced.add_mutually_exclusive_group()
@@ -117,9 +147,87 @@ def intercept_parser():
         '--append',
         action='store_true',
         help="""Extend existing compilation database with new entries.
-        Duplicate entries are detected and not present in the final output.
-        The output is not continuously updated, it's done when the build
-        command finished. """)
+        The new entries replace the existing ones which compile the same
+        source file into the same output file in the same directory. The
+        output is not continuously updated, it's done when the build
+        command finished (and only when the content was changed). Multiple
+        instances can extend the same file at the same time. """)
+    group.add_argument(
+        '--shards',
+        action='store_true',
+        help="""Split the compilation database into multiple files (shards)
+        by the top level directory of the source files (relative to the
+        current directory). The file given by '--cdb' will be the manifest
+        of the shards, the shards are written next to it.""")
+    advanced.add_argument(
+        '--shard-map',
+        metavar='<file>',
+        dest='shard_map',
+        help="""Split the compilation database by the given mapping (implies
+        '--shards'). The mapping is a JSON object, which maps the shard names
+        to lists of directories.""")
+    advanced.add_argument(
+        '--compact',
+        action='store_true',
+        help="""Write the compilation database entries one per line, without
+        indentation. (The output is about half the size.)""")
+    advanced.add_argument(
+        '--sorted',
+        action='store_true',
+        help="""Write the compilation database entries in a deterministic
+        order (by directory, file and command), so the same set of
+        compilations always gives the same output file. (The entries are
+        kept in memory till the output is written.)""")
+    advanced.add_argument(
+        '--build-profile',
+        metavar='<file>',
+        dest='build_profile',
+        help="""Record the start and end time of the build processes, and
+        write a profile of the build into the given JSON file. The profile
+        contains the duration of every compilation and the critical path of
+        the build. (Recording all processes makes the build slower.)""")
+
+    filters = parser.add_argument_group('filter options')
+    filters.add_argument(
+        '--include-path',
+        metavar='<glob>',
+        dest='include_paths',
+        action='append',
+        help="""Record only the compilations of the source files which match
+        this path pattern. (Relative patterns are taken relative to the
+        current directory.) Can be given multiple times.""")
+    filters.add_argument(
+        '--exclude-path',
+        metavar='<glob>',
+        dest='exclude_paths',
+        action='append',
+        help="""Do not record the compilations of the source files which
+        match this path pattern. (Like third party or generated sources.)
+        Can be given multiple times.""")
+    filters.add_argument(
+        '--include-regex',
+        metavar='<regex>',
+        dest='include_patterns',
+        action='append',
+        help="""Record only the compilations of the source files which
+        (absolute) name matches this regular expression. Can be given
+        multiple times.""")
+    filters.add_argument(
+        '--exclude-regex',
+        metavar='<regex>',
+        dest='exclude_patterns',
+        action='append',
+        help="""Do not record the compilations of the source files which
+        (absolute) name matches this regular expression. Can be given
+        multiple times.""")
+    filters.add_argument(
+        '--exclude-kind',
+        dest='exclude_kinds',
+        action='append',
+        choices=['c', 'c++', 'ar', 'ld'],
+        help="""Do not record this kind of entries: C or C++ compilations,
+        archiver ('ar') or linker ('ld') calls. Can be given multiple
+        times.""")
 
     parser.add_argument(
         dest='build', nargs=argparse.REMAINDER, help="""Command to run.""")
@@ -134,6 +242,8 @@ def analyze_parser(from_build_command):
     if from_build_command:
         parser_add_prefer_wrapper(parser)
         parser_add_compilers(parser)
+        parser_add_trace_mode(parser)
+        parser_add_trace_jobs(parser)
 
         parser.add_argument(
             '--intercept-first',
@@ -145,6 +255,39 @@ def analyze_parser(from_build_command):
             not run the analyzer till the build is finished.""")
     else:
         parser_add_cdb(parser)
+        parser.add_argument(
+            '--shard',
+            metavar='<name>',
+            dest='shards',
+            action='append',
+            help="""Analyze only the given shard of a sharded compilation
+            database. (The '--cdb' is the manifest of the shards then.) Can
+            be given multiple times.""")
+        parser.add_argument(
+            '--trust-cdb',
+            dest='trust_cdb',
+            action='store_true',
+            help="""Take the compilation database entries as they are. The
+            commands are not classified again and the existence of the
+            source files is not checked. (Faster for big databases, which
+            were produced by a trusted tool.)""")
+        parser.add_argument(
+            '--index-cdb',
+            dest='index_cdb',
+            action='store_true',
+            help="""Keep a binary index file next to the compilation database
+            ('<cdb>.index'). It's written on the first run and read on the
+            next runs instead of the JSON file, while the database is not
+            changed. (Faster for big databases, which are analyzed many
+            times.)""")
+        parser.add_argument(
+            '--diff',
+            metavar='<file>',
+            dest='diff',
+            help="""Compare the '--cdb' to the given (older) compilation
+            database instead of running the analyzer. The added, removed
+            and changed translation units are written to the standard
+            output as JSON.""")
 
     parser.add_argument(
         '--status-bugs',
@@ -161,6 +304,15 @@ def analyze_parser(from_build_command):
         help="""Do not run static analyzer against files found in this
         directory. (You can specify this option multiple times.)
         Could be useful when project contains 3rd party libraries.""")
+    parser.add_argument(
+        '--canonicalize-paths',
+        dest='canonicalize_paths',
+        action='store_true',
+        help="""Resolve the symbolic links of the source and build
+        directories, and make the include paths absolute before running the
+        analyzer. Compilations which are the same this way are analyzed only
+        once. (Useful when the source tree is reachable via symbolic links
+        or bind mounts.)""")
 
     output = parser.add_argument_group('output control options')
     output.add_argument(
@@ -347,6 +499,32 @@ def parser_add_prefer_wrapper(parser):
         intercept methods are available.""")
 
 
+def parser_add_trace_mode(parser):
+    parser.add_argument(
+        '--trace-mode',
+        choices=['files', 'log', 'socket'],
+        default='files',
+        help="""How the intercepted executions are recorded during the build.
+        With 'files' every execution is written into a separate file. With
+        'log' every execution is appended to a single log file, which keeps
+        the trace directory small on builds with many processes. With
+        'socket' every execution is sent to '%(prog)s' over a Unix domain
+        socket, which turns them into compilation entries while the build
+        is running. (The build processes do not write the trace files then.
+        Only the failed compilations are filtered when the build finished.)""")
+
+
+def parser_add_trace_jobs(parser):
+    parser.add_argument(
+        '--trace-jobs',
+        metavar='<number>',
+        type=int,
+        default=None,
+        help="""Number of worker processes to read and classify the
+        intercepted executions after the build finished. (Defaults to the
+        number of CPUs. Small builds are processed without workers.)""")
+
+
 def parser_add_compilers(parser):
     parser.add_argument(
         '--use-cc',
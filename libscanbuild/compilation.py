@@ -8,11 +8,24 @@
 import re
 import os
 import collections
+import fnmatch
+import contextlib
+import hashlib
+import io
+import itertools
 import logging
 import json
-from libscanbuild import Execution, shell_split
+import marshal
+import mmap
+import struct
+import sys
+import tempfile
+import zlib
+from libscanbuild import Execution, is_file, shell_split, real_path, \
+    canonical_path
 
-__all__ = ['classify_source', 'Compilation', 'CompilationDatabase']
+__all__ = ['classify_source', 'exec_filter', 'entry_filter', 'unique', 'merge',
+           'diff', 'canonicalize', 'Compilation', 'CompilationDatabase']
 
 # Ignored compiler options map for compilation database creation.
 # The map is used in `_split_command` method. (Which does ignore and classify
@@ -51,24 +64,50 @@ IGNORED_FLAGS = {
     '-Xlinker': 1
 }
 
+# Flags which mean that the compilation pass is not involved.
+COMPILATION_STOP_FLAGS = frozenset(['-E', '-S', '-cc1', '-M', '-MM', '-###'])
+
+# Flags which are taken as compile option together with their argument.
+# (The argument could look like a filename.)
+FLAGS_WITH_ARGUMENT = frozenset(['-D', '-I'])
+
+# Flags which take an include directory (or file) argument. These are made
+# absolute by the path canonicalization. The first ones can be written
+# together with their argument too. (Order matters, the longest first.)
+INCLUDE_DIRECTORY_FLAGS = ('-isystem', '-iquote', '-idirafter', '-I')
+INCLUDE_FILE_FLAGS = frozenset(['-include', '-imacros'])
+
+# Dispatch table of the compiler flags which are not simple compile options.
+# (Built from the sets above.) Values are the number of following arguments
+# to consume and whether to keep the flag, or None when the command is not a
+# compilation.
+FLAG_ACTIONS = dict(
+    [(flag, None) for flag in COMPILATION_STOP_FLAGS] +
+    [(flag, (False, count)) for flag, count in IGNORED_FLAGS.items()] +
+    [(flag, (True, 1)) for flag in FLAGS_WITH_ARGUMENT])
+
+# The executable name patterns below are also passed to the interception
+# library (see `exec_filter`), therefore these shall be valid POSIX extended
+# regular expressions too.
+
 # Known C/C++ compiler wrapper name patterns
 COMPILER_PATTERN_WRAPPER = re.compile(r'^(distcc|ccache)$')
 
 # Known C compiler executable name patterns
 COMPILER_PATTERNS_CC = frozenset([
-    re.compile(r'^(|i|mpi)cc$'),
-    re.compile(r'^([^-]*-)*[mg]cc(-\d+(\.\d+){0,2})?$'),
-    re.compile(r'^([^-]*-)*clang(-\d+(\.\d+){0,2})?$'),
-    re.compile(r'^(g|)xlc$'),
+    re.compile(r'^(i|mpi)?cc$'),
+    re.compile(r'^([^-]*-)*[mg]cc(-[0-9]+(\.[0-9]+){0,2})?$'),
+    re.compile(r'^([^-]*-)*clang(-[0-9]+(\.[0-9]+){0,2})?$'),
+    re.compile(r'^g?xlc$'),
 ])
 
 # Known C++ compiler executable name patterns
 COMPILER_PATTERNS_CXX = frozenset([
     re.compile(r'^(c\+\+|cxx|CC)$'),
-    re.compile(r'^([^-]*-)*[mg]\+\+(-\d+(\.\d+){0,2})?$'),
-    re.compile(r'^([^-]*-)*clang\+\+(-\d+(\.\d+){0,2})?$'),
+    re.compile(r'^([^-]*-)*[mg]\+\+(-[0-9]+(\.[0-9]+){0,2})?$'),
+    re.compile(r'^([^-]*-)*clang\+\+(-[0-9]+(\.[0-9]+){0,2})?$'),
     re.compile(r'^(icpc|mpiCC|mpicxx|mpic\+\+)$'),
-    re.compile(r'^(g|)xl(C|c\+\+)$'),
+    re.compile(r'^g?xl(C|c\+\+)$'),
 ])
 
 AR_PATTERNS = frozenset([
@@ -79,6 +118,49 @@ AR_RFLAG_PATTERNS = frozenset([
     re.compile(r'^((r|q|c|[sS]|d|[tT])[a-zA-Z]{0,3})$'),
 ])
 
+
+def _alternation(patterns):
+    """ Joins the regular expressions into a single one. """
+
+    ordered = sorted(patterns, key=lambda pattern: pattern.pattern)
+    return re.compile('|'.join('(?:' + pattern.pattern + ')'
+                               for pattern in ordered))
+
+
+# The same patterns as above, one expression per family. The executable name
+# is checked against a single regular expression instead of a set of them.
+COMPILER_PATTERN_CC = _alternation(COMPILER_PATTERNS_CC)
+COMPILER_PATTERN_CXX = _alternation(COMPILER_PATTERNS_CXX)
+AR_PATTERN = _alternation(AR_PATTERNS)
+AR_RFLAG_PATTERN = _alternation(AR_RFLAG_PATTERNS)
+
+LINK_FLAG_PATTERN = re.compile(r'-Wl,.+')
+OBJECT_FILE_PATTERN = re.compile(r'^[^-].*\.o')
+
+# Memo of the executable name classification. (The number of different
+# executable names in a build is small, the limit is only a safety net.)
+EXECUTABLE_KINDS = dict()
+EXECUTABLE_KINDS_LIMIT = 4096
+
+# The compilation database is read in pieces of this size.
+JSON_READ_SIZE = 1 << 16
+JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+# The sidecar index of the compilation database. (See `DatabaseIndex`.)
+DATABASE_INDEX_SUFFIX = '.index'
+DATABASE_MANIFEST_VERSION = 1
+DATABASE_INDEX_MAGIC = b'SCBINDEX'
+DATABASE_INDEX_PYTHON = tuple(sys.version_info[:2])
+DATABASE_INDEX_HEADER = struct.Struct('<8sBBQdQQ20s')
+DATABASE_INDEX_RECORD = struct.Struct('<I')
+DATABASE_INDEX_POSITION = struct.Struct('<Q')
+DATABASE_INDEX_RANGE = struct.Struct('<QQ')
+DATABASE_INDEX_BUCKET_SIZE = 16
+DatabaseIndexHeader = collections.namedtuple(
+    'DatabaseIndexHeader',
+    ['magic', 'python_major', 'python_minor', 'size', 'mtime', 'count',
+     'index', 'digest'])
+
 CompilationCommand = collections.namedtuple(
     'CompilationCommand', ['compiler', 'flags', 'files'])
 
@@ -122,6 +204,28 @@ class Compilation:
         return isinstance(other, Compilation) and \
             self._hash_str() == other._hash_str()
 
+    def fingerprint(self):
+        """ Fixed size digest of the unique hash string.
+
+        It's used to detect duplicate entries without keeping the entries
+        in memory. (See comment for _hash_str method.) """
+
+        return hashlib.sha1(self._hash_str().encode('utf-8')).digest()
+
+    def canonical(self):
+        """ Returns the compilation with canonical paths.
+
+        The symbolic links of the directory and the source file are resolved
+        and the relative include paths of the flags are made absolute. This
+        way the same compilation, which was reached via different paths,
+        has the same hash. """
+
+        directory = real_path(self.directory)
+        return Compilation(compiler=self.compiler,
+                           flags=canonical_flags(self.flags, self.directory),
+                           source=canonical_path(self.source),
+                           directory=directory)
+
     def to_analyzer(self):
         """ This method dumps the object attributes into a dictionary. """
 
@@ -144,7 +248,7 @@ class Compilation:
         }
 
     @staticmethod
-    def from_call(execution, cc='cc', cxx='c++'):
+    def from_call(execution, cc='cc', cxx='c++', check_source=True):
         """ Generator method for compilation entries.
 
         From a single compiler call it can generate zero or more entries.
@@ -152,6 +256,7 @@ class Compilation:
         :param execution:   executed command and working directory
         :param cc:          user specified C compiler name
         :param cxx:         user specified C++ compiler name
+        :param check_source: generate entries only for existing source files
         :return: stream of CompilationDbEntry objects """
 
         candidate = Compilation._split_command(execution.cmd, cc, cxx)
@@ -160,24 +265,65 @@ class Compilation:
                                  source=source,
                                  compiler=candidate.compiler,
                                  flags=candidate.flags)
-            if os.path.isfile(result.source):
+            if not check_source or is_file(result.source):
                 yield result
 
     @staticmethod
-    def from_db(entry):
+    def from_db(entry, trusted=False):
         """ Factory method for compilation entry.
 
         From compilation database entry it creates the compilation object.
+        The command is classified the same way as the intercepted ones are,
+        unless the entry is trusted. Trusted entries are taken as they are:
+        the compiler flags are filtered later by the analyzer.
 
         :param entry:   the compilation database entry
-        :return: a single compilation object """
+        :param trusted: take the entry without classification
+        :return: a single compilation object, or None if the entry is not
+                 a compilation of the given file """
 
         command = shell_split(entry['command']) if 'command' in entry else \
             entry['arguments']
+        if trusted:
+            return Compilation._from_trusted(command, entry)
+
         execution = Execution(cmd=command, cwd=entry['directory'], pid=0)
-        entries = list(Compilation.from_call(execution))
-        assert len(entries) == 1
-        return entries[0]
+        source = Compilation(compiler=None, flags=[], source=entry['file'],
+                             directory=entry['directory']).source
+        # a command might compile multiple files, but the entry is about one
+        return next((candidate
+                     for candidate in Compilation.from_call(execution)
+                     if candidate.source == source), None)
+
+    @staticmethod
+    def _from_trusted(command, entry):
+        """ Creates the compilation object from a trusted database entry.
+
+        Only the compiler name is classified (to know the language), and the
+        source file is taken out from the arguments. Entries of unknown
+        executables, linker and archiver calls are skipped. """
+
+        compiler_and_arguments = Compilation._split_compiler(command, 'cc',
+                                                             'c++')
+        if compiler_and_arguments is None:
+            return None
+        compiler, arguments = compiler_and_arguments
+        if compiler not in {'c', 'c++'}:
+            return None
+        result = Compilation(compiler=compiler, flags=[],
+                             source=entry['file'],
+                             directory=entry['directory'])
+
+        def is_source(arg):
+            return arg == entry['file'] or \
+                (not arg.startswith('-') and result.source ==
+                 os.path.normpath(os.path.join(result.directory, arg)))
+
+        result.flags = list(arguments)
+        position = source_position(arguments, is_source)
+        if position is not None:
+            del result.flags[position]
+        return result
 
     @staticmethod
     def _split_compiler(command, cc, cxx):
@@ -189,37 +335,24 @@ class Compilation:
         :return: None if the command is not a compilation, or a tuple
                 (compiler_language, rest of the command) otherwise """
 
-        logging.debug('Command received by _split_compiler: {0:s}'.format(str(command)))
-
-        def is_wrapper(cmd):
-            return True if COMPILER_PATTERN_WRAPPER.match(cmd) else False
-
-        def is_c_compiler(cmd):
-            return os.path.basename(cc) == cmd or \
-                any(pattern.match(cmd) for pattern in COMPILER_PATTERNS_CC)
-
-        def is_cxx_compiler(cmd):
-            return os.path.basename(cxx) == cmd or \
-                any(pattern.match(cmd) for pattern in COMPILER_PATTERNS_CXX)
-
-        def is_ar(cmd):
-            return 'ar' == cmd or any(pattern.match(cmd) for pattern in AR_PATTERNS)
+        logging.debug('Command received by _split_compiler: %s', command)
 
         if command:  # not empty list will allow to index '0' and '1:'
             executable = os.path.basename(command[0])
             parameters = command[1:]
+            kind = executable_kind(executable)
             # 'wrapper' 'parameters' and
             # 'wrapper' 'compiler' 'parameters' are valid.
             # plus, a wrapper can wrap wrapper too.
-            if is_wrapper(executable):
+            if kind == 'wrapper':
                 result = Compilation._split_compiler(parameters, cc, cxx)
                 return ('c', parameters) if result is None else result
             # and 'compiler' 'parameters' is valid.
-            elif is_c_compiler(executable):
+            elif kind == 'c' or executable == os.path.basename(cc):
                 return 'c', parameters
-            elif is_cxx_compiler(executable):
+            elif kind == 'c++' or executable == os.path.basename(cxx):
                 return 'c++', parameters
-            elif is_ar(executable):
+            elif kind == 'ar':
                 return 'ar', parameters
         return None
 
@@ -247,29 +380,32 @@ class Compilation:
         args = iter(compiler_and_arguments[1])
         if is_ar:
             for arg in args:
-                if any(pattern.match(arg) for pattern in AR_RFLAG_PATTERNS):
+                if AR_RFLAG_PATTERN.match(arg):
                     result.files.append(next(args))
                 else:
                     result.flags.append(arg)
         else:
             for arg in args:
+                action = FLAG_ACTIONS.get(arg, False)
+                # parameter which looks source file is taken...
+                if action is False:
+                    if len(arg) > 1 and arg[0] != '-' and \
+                            classify_source(arg):
+                        result.files.append(arg)
+                    # and consider everything else as compile option.
+                    else:
+                        result.flags.append(arg)
                 # quit when compilation pass is not involved
-                if arg in {'-E', '-S', '-cc1', '-M', '-MM', '-###'}:
+                elif action is None:
                     return None
-                # ignore some flags
-                elif arg in IGNORED_FLAGS:
-                    count = IGNORED_FLAGS[arg]
-                    for _ in range(count):
-                        next(args)
-                # some parameters could look like filename, take as compile option
-                elif arg in {'-D', '-I'}:
-                    result.flags.extend([arg, next(args)])
-                # parameter which looks source file is taken...
-                elif re.match(r'^[^-].+', arg) and classify_source(arg):
-                    result.files.append(arg)
-                # and consider everything else as compile option.
+                # some parameters could look like filename, take as compile
+                # option. and ignore some flags.
                 else:
-                    result.flags.append(arg)
+                    keep, count = action
+                    values = [next(args) for _ in range(count)]
+                    if keep:
+                        result.flags.append(arg)
+                        result.flags.extend(values)
         if not result.files and not is_ar:
             # see whether we missed a link command line
             args = iter(compiler_and_arguments[1])
@@ -278,7 +414,8 @@ class Compilation:
             for arg in args:
                 if arg in {'-o'}:
                     filesTmp.append(next(args))
-                elif re.match(r'-Wl,.+', arg) or re.match(r'^[^-].*\.o', arg):
+                elif LINK_FLAG_PATTERN.match(arg) or \
+                        OBJECT_FILE_PATTERN.match(arg):
                     isLinkCmd = True
             if isLinkCmd:
                 logging.debug('Link command line encountered')
@@ -292,16 +429,961 @@ class Compilation:
 
 class CompilationDatabase:
     @staticmethod
-    def save(filename, iterator):
-        entries = [entry.to_db() for entry in iterator]
-        with open(filename, 'w+') as handle:
-            json.dump(entries, handle, sort_keys=True, indent=4)
+    def save(filename, iterator, compact=False, ordered=False):
+        """ Writes the compilations into the file one by one. """
+
+        CompilationDatabase.save_entries(
+            filename, (entry.to_db() for entry in iterator), compact, ordered)
+
+    @staticmethod
+    def save_entries(filename, iterator, compact=False, ordered=False):
+        """ Writes the compilation database entries into the file one by one.
+
+        The output is the same as dumping the entries as a JSON array, but
+        the entries are not collected into memory. The content is written
+        into a temporary file first, because the entries might be read from
+        the file which is being replaced.
+
+        :param filename:    the output file name,
+        :param iterator:    iterable of compilation database entries,
+        :param compact:     write one entry per line without indentation,
+        :param ordered:     sort the entries by their directory, file and
+                            command. (The output is byte-identical for the
+                            same set of entries, but the serialized entries
+                            are kept in memory till the end.) """
+
+        writer = DatabaseWriter(filename, compact, ordered)
+        try:
+            for entry in iterator:
+                writer.write(entry)
+        except BaseException:
+            writer.abort()
+            raise
+        writer.commit()
+
+    @staticmethod
+    def save_shards(filename, iterator, shard_of, compact=False,
+                    ordered=False):
+        """ Writes the compilations into multiple database files (shards).
+
+        The shard files are written next to the given file, which will be
+        the manifest of the shards. (See `read_manifest` for its format.)
+
+        :param filename:    the manifest file name,
+        :param iterator:    iterable of Compilation objects,
+        :param shard_of:    function which returns the shard name of a
+                            compilation,
+        :param compact:     write the shards without indentation,
+        :param ordered:     write the entries of the shards sorted. """
+
+        writers = collections.OrderedDict()
+        counts = collections.defaultdict(int)
+        try:
+            for compilation in iterator:
+                name = shard_of(compilation)
+                if name not in writers:
+                    writers[name] = DatabaseWriter(
+                        shard_filename(filename, name), compact, ordered)
+                writers[name].write(compilation.to_db())
+                counts[name] += 1
+        except BaseException:
+            for writer in writers.values():
+                writer.abort()
+            raise
+        for writer in writers.values():
+            writer.commit()
+
+        manifest = {
+            'version': DATABASE_MANIFEST_VERSION,
+            'shards': [{
+                'name': name,
+                'file': os.path.basename(shard_filename(filename, name)),
+                'entries': counts[name]
+            } for name in sorted(writers)]
+        }
+        writer = AtomicFileWriter(filename)
+        try:
+            json.dump(manifest, writer.handle, sort_keys=True, indent=4)
+        except BaseException:
+            writer.abort()
+            raise
+        writer.commit()
+
+    @staticmethod
+    def load(filename, trusted=False, indexed=False):
+        """ Generator of the compilations from the database file.
+
+        :param filename:    the compilation database file name,
+        :param trusted:     take the entries without classification,
+        :param indexed:     read (and maintain) the sidecar index file,
+        :return: stream of Compilation objects. """
+
+        for entry in CompilationDatabase.iter_entries(filename, indexed):
+            compilation = Compilation.from_db(entry, trusted)
+            if compilation is None:
+                logging.debug('skip entry, not a compilation: %s', entry)
+            else:
+                yield compilation
+
+    @staticmethod
+    def files(filename, shards=None):
+        """ Returns the compilation database files of the given file.
+
+        :param filename:    a compilation database or a shard manifest,
+        :param shards:      the names of the requested shards (all shards
+                            when not given),
+        :return: list of compilation database file names. """
+
+        manifest = read_manifest(filename)
+        if manifest is None:
+            if shards:
+                raise ValueError('{0} is not a manifest'.format(filename))
+            return [filename]
+        directory = os.path.dirname(filename)
+        available = collections.OrderedDict(
+            (shard['name'], os.path.join(directory, shard['file']))
+            for shard in manifest['shards'])
+        unknown = sorted(set(shards or []) - set(available))
+        if unknown:
+            raise ValueError('unknown shards: {0}'.format(', '.join(unknown)))
+        return [name for shard, name in available.items()
+                if not shards or shard in shards]
+
+    @staticmethod
+    def load_entries(filename):
+        """ Reads the compilation database entries (dictionaries) as they
+        are, without the classification of the commands. """
+
+        return list(CompilationDatabase.iter_entries(filename))
+
+    @staticmethod
+    def iter_entries(filename, indexed=False):
+        """ Generator of the compilation database entries (dictionaries).
+
+        The file is parsed incrementally, only the current entry is kept in
+        memory. When the index is requested, the entries are read from the
+        index file. (It's created while the database is parsed, if it was
+        missing or outdated.) """
+
+        index = DatabaseIndex.open(filename) if indexed else None
+        if index is not None:
+            with contextlib.closing(index):
+                for entry in index.entries():
+                    yield entry
+        elif indexed:
+            for entry in DatabaseIndex.create(filename):
+                yield entry
+        else:
+            with open(filename, 'r') as handle:
+                for entry in json_array_items(handle):
+                    yield entry
 
     @staticmethod
-    def load(filename):
-        with open(filename, 'r') as handle:
-            for entry in json.load(handle):
-                yield Compilation.from_db(entry)
+    def diff(previous, current, shards=None):
+        """ Compares two compilation databases.
+
+        :param previous:    the old compilation database (or manifest),
+        :param current:     the new compilation database (or manifest),
+        :param shards:      the names of the compared shards (all shards
+                            when not given),
+        :return: the added, removed and changed translation units. """
+
+        def entries(filename):
+            return itertools.chain.from_iterable(
+                CompilationDatabase.iter_entries(name)
+                for name in CompilationDatabase.files(filename, shards))
+
+        return diff(entries(previous), entries(current))
+
+    @staticmethod
+    def lookup(filename, source):
+        """ Returns the entries which compile the given source file.
+
+        :param filename:    the compilation database file name,
+        :param source:      the source file name (absolute path),
+        :return: list of compilation database entries. """
+
+        index = DatabaseIndex.open(filename)
+        if index is None:
+            for _ in DatabaseIndex.create(filename):
+                pass
+            index = DatabaseIndex.open(filename)
+        if index is None:
+            # the index could not be written, search in the database
+            return [entry for entry in CompilationDatabase.iter_entries(
+                filename) if entry_source(entry) == os.path.normpath(source)]
+        with contextlib.closing(index):
+            return index.lookup(source)
+
+
+class AtomicFileWriter(object):
+    """ Writes a file through a temporary file in the same directory, which
+    is renamed to the final name at the end. Readers see either the old or
+    the new content. (When the file name is a symbolic link, the target of
+    the link is replaced.) """
+
+    def __init__(self, filename):
+        self.filename = os.path.realpath(filename)
+        directory = os.path.dirname(self.filename)
+        handle, self.temporary = tempfile.mkstemp(prefix='.compile_commands-',
+                                                  dir=directory)
+        self.handle = os.fdopen(handle, 'w')
+
+    def commit(self):
+        self.handle.close()
+        # keep the permissions of the usual file creation
+        umask = os.umask(0)
+        os.umask(umask)
+        try:
+            os.chmod(self.temporary, 0o666 & ~umask)
+            os.rename(self.temporary, self.filename)
+        except BaseException:
+            os.unlink(self.temporary)
+            raise
+
+    def abort(self):
+        self.handle.close()
+        os.unlink(self.temporary)
+
+
+class DatabaseWriter(AtomicFileWriter):
+    """ Writes the compilation database entries one by one.
+
+    The output is the same as dumping the entries as a JSON array, but the
+    entries are not collected into memory. (Unless the entries are ordered:
+    then the serialized entries are kept till the end.) """
+
+    def __init__(self, filename, compact=False, ordered=False):
+        AtomicFileWriter.__init__(self, filename)
+        self.compact = compact
+        self.ordered = [] if ordered else None
+        self.separator = '[\n'
+        if compact:
+            self.encoder = json.JSONEncoder(sort_keys=True,
+                                            separators=(',', ':'))
+        else:
+            self.encoder = json.JSONEncoder(sort_keys=True, indent=4)
+
+    def write(self, entry):
+        content = self.encoder.encode(entry)
+        if not self.compact:
+            content = '    ' + content.replace('\n', '\n    ')
+        if self.ordered is None:
+            self._write(content)
+        else:
+            self.ordered.append((entry['directory'], entry['file'], content))
+
+    def commit(self):
+        try:
+            for _, _, content in sorted(self.ordered or []):
+                self._write(content)
+            self.handle.write('\n]' if self.separator != '[\n' else '[]')
+        except BaseException:
+            self.abort()
+            raise
+        AtomicFileWriter.commit(self)
+
+    def _write(self, content):
+        self.handle.write(self.separator)
+        self.handle.write(content)
+        self.separator = ',\n'
+
+
+class DatabaseIndex(object):
+    """ Binary sidecar file of a compilation database.
+
+    The file starts with a fixed size header: the size, the modification
+    time and the SHA1 digest of the database file it was made from, the
+    number of entries and the position of the source file index. The
+    entries are serialized with `marshal` (which is much faster to read
+    than JSON), each prefixed by its length. The source file index maps the
+    absolute source file names to the positions of the entries. (See the
+    `write_index_buckets` method for its layout.)
+
+    The index is valid while the size and the modification time of the
+    database are the same. When only the modification time differs, the
+    digest decides (and the header is updated). The file is memory mapped,
+    the entries are decoded on demand. """
+
+    def __init__(self, handle, view, header):
+        self.handle = handle
+        self.view = view
+        self.header = header
+
+    def close(self):
+        self.view.close()
+        self.handle.close()
+
+    def entries(self):
+        """ Generator of the compilation database entries. """
+
+        position = DATABASE_INDEX_HEADER.size
+        for _ in range(self.header.count):
+            entry, position = self._read(position)
+            yield entry
+
+    def lookup(self, source):
+        """ Returns the entries of the given (absolute) source file. """
+
+        source = os.path.normpath(source)
+        start = self.header.index
+        count, = DATABASE_INDEX_POSITION.unpack(
+            self.view[start:start + DATABASE_INDEX_POSITION.size])
+        # the position of the bucket and the next one (the end of it)
+        start += DATABASE_INDEX_POSITION.size * (1 + index_bucket(source,
+                                                                  count))
+        first, last = DATABASE_INDEX_RANGE.unpack(
+            self.view[start:start + DATABASE_INDEX_RANGE.size])
+        sources = marshal.loads(self.view[first:last])
+        return [self._read(position)[0]
+                for position in sources.get(source, [])]
+
+    def _read(self, position):
+        start = position + DATABASE_INDEX_RECORD.size
+        length, = DATABASE_INDEX_RECORD.unpack(self.view[position:start])
+        return marshal.loads(self.view[start:start + length]), start + length
+
+    @staticmethod
+    def open(filename):
+        """ Opens the index of the database, if it's valid.
+
+        :param filename:    the compilation database file name,
+        :return: DatabaseIndex object or None. """
+
+        index = filename + DATABASE_INDEX_SUFFIX
+        try:
+            stat = os.stat(filename)
+            handle = open(index, 'rb')
+        except (IOError, OSError):
+            return None
+        try:
+            view = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+            header = DatabaseIndexHeader._make(
+                DATABASE_INDEX_HEADER.unpack(
+                    view[:DATABASE_INDEX_HEADER.size]))
+        except (ValueError, struct.error, EnvironmentError):
+            handle.close()
+            return None
+        valid = header.magic == DATABASE_INDEX_MAGIC and \
+            (header.python_major, header.python_minor) == \
+            DATABASE_INDEX_PYTHON and header.size == stat.st_size
+        if valid and header.mtime != stat.st_mtime:
+            # the content might be the same (the file was touched)
+            with open(filename, 'rb') as database:
+                valid = file_digest(database) == header.digest
+            if valid:
+                header = header._replace(mtime=stat.st_mtime)
+                try:
+                    with open(index, 'r+b') as writer:
+                        writer.write(DATABASE_INDEX_HEADER.pack(*header))
+                except (IOError, OSError):
+                    logging.debug('can not update the index of %s', filename)
+        if not valid:
+            view.close()
+            handle.close()
+            return None
+        return DatabaseIndex(handle, view, header)
+
+    @staticmethod
+    def create(filename):
+        """ Parses the database and writes the index file next to it.
+
+        The index is written into a temporary file, which is renamed when
+        the whole database was read. (If the index can't be written, the
+        entries are still generated.)
+
+        :param filename:    the compilation database file name,
+        :return: stream of the compilation database entries. """
+
+        with io.open(filename, 'rb', buffering=0) as database:
+            stat = os.fstat(database.fileno())
+            # the digest is calculated while the entries are parsed
+            reader = DigestReader(database)
+            try:
+                handle, temporary = tempfile.mkstemp(
+                    prefix='.compile_commands-',
+                    dir=os.path.dirname(os.path.abspath(filename)))
+                writer = os.fdopen(handle, 'wb')
+            except (IOError, OSError):
+                logging.debug('can not write the index of %s', filename)
+                writer = None
+            try:
+                sources = dict()
+                count = 0
+                position = DATABASE_INDEX_HEADER.size
+                if writer:
+                    writer.write(b'\0' * position)
+                stream = io.TextIOWrapper(io.BufferedReader(reader),
+                                          encoding='utf-8')
+                for entry in json_array_items(stream):
+                    if writer:
+                        content = marshal.dumps(entry)
+                        writer.write(DATABASE_INDEX_RECORD.pack(len(content)))
+                        writer.write(content)
+                        sources.setdefault(entry_source(entry), []) \
+                            .append(position)
+                        position += DATABASE_INDEX_RECORD.size + len(content)
+                        count += 1
+                    yield entry
+                if writer:
+                    # the digest covers the content after the array too
+                    for _ in iter(lambda: reader.read(1 << 20), b''):
+                        pass
+                    write_index_buckets(writer, position, sources)
+                    writer.seek(0)
+                    writer.write(DATABASE_INDEX_HEADER.pack(
+                        DATABASE_INDEX_MAGIC, DATABASE_INDEX_PYTHON[0],
+                        DATABASE_INDEX_PYTHON[1], stat.st_size,
+                        stat.st_mtime, count, position,
+                        reader.digest.digest()))
+                    writer.close()
+                    os.rename(temporary, filename + DATABASE_INDEX_SUFFIX)
+                    writer = None
+            finally:
+                if writer:
+                    writer.close()
+                    os.unlink(temporary)
+
+
+def index_bucket(source, count):
+    """ Returns the bucket number of a source file in the index. """
+
+    if not isinstance(source, bytes):
+        source = source.encode('utf-8')
+    return (zlib.crc32(source) & 0xffffffff) % count
+
+
+def write_index_buckets(writer, position, sources):
+    """ Writes the source file index of the database index file.
+
+    The source files are distributed into buckets by their name, so a
+    lookup needs to decode only one bucket. It starts with the number of
+    the buckets and the positions of them (plus the end of the last one),
+    followed by the buckets. (Each is a marshalled dictionary.)
+
+    :param writer:      the index file, at the end of the entries,
+    :param position:    the current position of the writer,
+    :param sources:     dictionary of source file to entry positions. """
+
+    count = len(sources) // DATABASE_INDEX_BUCKET_SIZE + 1
+    buckets = [dict() for _ in range(count)]
+    for source, positions in sources.items():
+        buckets[index_bucket(source, count)][source] = positions
+    contents = [marshal.dumps(bucket) for bucket in buckets]
+
+    position += DATABASE_INDEX_POSITION.size * (count + 2)
+    positions = [count]
+    for content in contents:
+        positions.append(position)
+        position += len(content)
+    positions.append(position)
+    writer.write(b''.join(DATABASE_INDEX_POSITION.pack(value)
+                          for value in positions))
+    for content in contents:
+        writer.write(content)
+
+
+def shard_filename(filename, name):
+    """ Returns the file name of a shard of the given manifest. """
+
+    base, extension = os.path.splitext(filename)
+    return '{0}.{1}{2}'.format(base, name, extension or '.json')
+
+
+def read_manifest(filename):
+    """ Reads the shard manifest, or returns None for a plain compilation
+    database.
+
+    The manifest is a JSON object: the 'shards' attribute is the list of the
+    shards. Each shard has a 'name', a 'file' (relative to the manifest) and
+    the number of 'entries'.
+
+    :param filename:    a compilation database or a manifest file name,
+    :return: the manifest as dictionary or None. """
+
+    with open(filename, 'r') as handle:
+        content = handle.read(JSON_READ_SIZE).lstrip()
+        if not content.startswith('{'):
+            return None
+        handle.seek(0)
+        manifest = json.load(handle)
+    if not isinstance(manifest.get('shards'), list):
+        raise ValueError('{0} is not a manifest'.format(filename))
+    return manifest
+
+
+def entry_source(entry):
+    """ Returns the absolute source file name of a database entry. """
+
+    directory = os.path.normpath(entry['directory'])
+    return os.path.normpath(os.path.join(directory, entry['file']))
+
+
+def file_digest(handle):
+    """ Returns the SHA1 digest of the content of an open (binary) file. """
+
+    digest = hashlib.sha1()
+    for block in iter(lambda: handle.read(1 << 20), b''):
+        digest.update(block)
+    return digest.digest()
+
+
+class DigestReader(io.RawIOBase):
+    """ Binary stream, which calculates the SHA1 digest of the content that
+    was read through it. """
+
+    def __init__(self, handle):
+        io.RawIOBase.__init__(self)
+        self.handle = handle
+        self.digest = hashlib.sha1()
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        content = self.handle.read(len(buffer))
+        self.digest.update(content)
+        buffer[:len(content)] = content
+        return len(content)
+
+
+def json_array_items(handle, size=JSON_READ_SIZE):
+    """ Generator of the elements of a JSON array from a file.
+
+    The file is read and decoded piece by piece, so the elements are
+    available before the whole file is read. (And the memory use depends
+    on the size of the elements, not the size of the file.)
+
+    :param handle:  the file object to read,
+    :param size:    number of characters to read at once,
+    :return: stream of the decoded elements. """
+
+    decoder = json.JSONDecoder()
+    buffer, position, eof = '', 0, False
+    # the state tells what's expected next: the array start, the first
+    # element (or the array end), an element, or a separator.
+    state = '['
+    while True:
+        position = JSON_WHITESPACE.match(buffer, position).end()
+        end = None
+        if position < len(buffer):
+            if state == '[':
+                if buffer[position] != '[':
+                    raise ValueError('JSON array expected')
+                end, state = position + 1, 'first'
+            elif state == 'first' and buffer[position] == ']':
+                return
+            elif state in ('first', 'element'):
+                try:
+                    element, end = decoder.raw_decode(buffer, position)
+                    # the element might continue in the next piece (like a
+                    # number), unless a delimiter follows it
+                    if not eof and (end == len(buffer) or
+                                    buffer[end] not in ' \t\n\r,]'):
+                        end = None
+                except ValueError:
+                    if eof:
+                        raise
+                if end is not None:
+                    state = ','
+                    yield element
+            elif buffer[position] == ',':
+                end, state = position + 1, 'element'
+            elif buffer[position] == ']':
+                return
+            else:
+                raise ValueError('JSON array separator expected')
+        if end is not None:
+            position = end
+        elif eof:
+            raise ValueError('unexpected end of JSON array')
+        else:
+            # read more, at least as much as the buffered part
+            content = handle.read(max(size, len(buffer) - position))
+            buffer, position, eof = buffer[position:] + content, 0, \
+                not content
+
+
+def unique(compilations):
+    """ Filters out the duplicate compilations.
+
+    Only the fingerprints of the already seen compilations are kept in
+    memory, the compilations are passed through as they come.
+
+    :param compilations:    iterable of Compilation objects,
+    :return: generator of the unique Compilation objects. """
+
+    seen = set()
+    for compilation in compilations:
+        fingerprint = compilation.fingerprint()
+        if fingerprint not in seen:
+            seen.add(fingerprint)
+            yield compilation
+
+
+def source_position(arguments, is_source):
+    """ Returns the index of the source file in the compiler arguments.
+
+    The arguments of the flags (like the output file name of '-o') are not
+    taken as source file, even when those have the same name.
+
+    :param arguments:   list of compiler arguments (without the compiler),
+    :param is_source:   predicate which tells the argument is the source,
+    :return: the index of the source file, or None when it's not found. """
+
+    args = iter(enumerate(arguments))
+    for index, arg in args:
+        action = FLAG_ACTIONS.get(arg, False)
+        if arg == '-o':
+            next(args, None)
+        elif action:
+            for _ in range(action[1]):
+                next(args, None)
+        elif is_source(arg):
+            return index
+    return None
+
+
+def canonicalize(compilations):
+    """ Filters out the compilations which are duplicates by their canonical
+    paths.
+
+    The compilations are passed through with canonical paths. The number of
+    the filtered compilations (the analyzer runs saved) is logged at the end.
+
+    :param compilations:    iterable of Compilation objects,
+    :return: generator of the unique canonical Compilation objects. """
+
+    saved = 0
+    seen = set()
+    for compilation in compilations:
+        current = compilation.canonical()
+        fingerprint = current.fingerprint()
+        if fingerprint in seen:
+            saved += 1
+            continue
+        seen.add(fingerprint)
+        yield current
+    logging.info('canonical paths: %d duplicate compilations skipped', saved)
+
+
+def canonical_flags(flags, directory):
+    """ Makes the include paths of the compiler flags absolute and canonical.
+
+    :param flags:       list of compiler flags,
+    :param directory:   the working directory of the compilation,
+    :return: the list of the rewritten flags. """
+
+    def directory_path(path):
+        return real_path(os.path.join(directory, path))
+
+    def file_path(path):
+        return canonical_path(os.path.join(directory, path))
+
+    result = []
+    rewrite = None
+    for flag in flags:
+        if rewrite is not None:
+            result.append(rewrite(flag))
+            rewrite = None
+        elif flag in INCLUDE_DIRECTORY_FLAGS:
+            result.append(flag)
+            rewrite = directory_path
+        elif flag in INCLUDE_FILE_FLAGS:
+            result.append(flag)
+            rewrite = file_path
+        else:
+            prefix = next((candidate for candidate in INCLUDE_DIRECTORY_FLAGS
+                           if flag.startswith(candidate)), None)
+            result.append(flag if prefix is None else
+                          prefix + directory_path(flag[len(prefix):]))
+    return result
+
+
+def merge(previous, current):
+    """ Merges the new compilation database entries into the previous ones.
+
+    The entries are identified by their directory, source file and output
+    file. The new entries replace all the previous entries of the same key
+    (at the position of the first one), the rest of the new entries are
+    appended. This way the stale variants of a compilation do not pile up
+    during incremental builds. (The result equals to the previous entries,
+    when all the new entries were already present.)
+
+    :param previous:    list of compilation database entries,
+    :param current:     iterable of compilation database entries,
+    :return: the list of merged entries. """
+
+    def same(entries, others):
+        return len(entries) == len(others) and \
+            all(entry in others for entry in entries)
+
+    replacements = collections.OrderedDict()
+    for entry in current:
+        replacements.setdefault(entry_key(entry), []).append(entry)
+    keys = [entry_key(entry) for entry in previous]
+    # keep the previous order of the entries when those are not changed
+    replaced = collections.defaultdict(list)
+    for key, entry in zip(keys, previous):
+        if key in replacements:
+            replaced[key].append(entry)
+    for key, entries in replaced.items():
+        if same(replacements[key], entries):
+            del replacements[key]
+
+    result = []
+    for key, entry in zip(keys, previous):
+        if key not in replacements:
+            result.append(entry)
+        elif replacements[key] is not None:
+            result.extend(replacements[key])
+            replacements[key] = None
+    for entries in replacements.values():
+        result.extend(entries or [])
+    return result
+
+
+def entry_key(entry):
+    """ Returns the identity of a compilation database entry.
+
+    :param entry:   compilation database entry (dictionary),
+    :return: tuple of the directory, the source and the output file. (The
+    output file is None when it's not specified.) """
+
+    return _entry_key(entry, entry_arguments(entry))
+
+
+def _entry_key(entry, arguments):
+    def output_file():
+        for current, following in zip(arguments, arguments[1:]):
+            if current == '-o':
+                return following
+        return None
+
+    directory = os.path.normpath(entry['directory'])
+    output = entry.get('output', output_file())
+    return (directory,
+            entry_source(entry),
+            os.path.normpath(os.path.join(directory, output))
+            if output else None)
+
+
+def entry_arguments(entry):
+    """ Returns the command of a database entry as a list of arguments. """
+
+    return entry['arguments'] if 'arguments' in entry else \
+        shell_split(entry['command'])
+
+
+def entry_digest(entry):
+    """ Returns the identity and the digest of a compilation database entry.
+
+    The digest is taken from the normalized entry: the directory and the
+    source file name are normalized, the command is split into arguments.
+    This way the 'command' and 'arguments' forms of the same compilation
+    have the same digest.
+
+    :param entry:   compilation database entry (dictionary),
+    :return: tuple of the entry key and the SHA1 digest (hex string). """
+
+    arguments = entry_arguments(entry)
+    key = _entry_key(entry, arguments)
+    normalized = json.dumps([key[0], key[1], arguments])
+    return key, hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+
+
+def diff(previous, current):
+    """ Compares two sets of compilation database entries.
+
+    The translation units are identified by their directory, source file and
+    output file. A translation unit is changed when the digests of its
+    (normalized) entries are not the same. Only the digests are kept in
+    memory, therefore the entries can be streamed from the database files.
+
+    :param previous:    iterable of the old compilation database entries,
+    :param current:     iterable of the new compilation database entries,
+    :return: dictionary with the 'added', 'removed' and 'changed' lists of
+    translation units. (Each one has 'directory', 'file' and optionally
+    'output' attributes.) """
+
+    def digests(entries):
+        result = collections.defaultdict(list)
+        for entry in entries:
+            key, digest = entry_digest(entry)
+            result[key].append(digest)
+        return dict((key, sorted(values)) for key, values in result.items())
+
+    def units(keys):
+        ordered = sorted(keys, key=lambda key: (key[0], key[1], key[2] or ''))
+        return [translation_unit(key) for key in ordered]
+
+    old = digests(previous)
+    new = digests(current)
+    return {
+        'added': units(key for key in new if key not in old),
+        'removed': units(key for key in old if key not in new),
+        'changed': units(key for key in new
+                         if key in old and old[key] != new[key])
+    }
+
+
+def translation_unit(key):
+    """ Returns the printable form of an entry key. """
+
+    directory, source, output = key
+    result = {'directory': directory, 'file': source}
+    if output is not None:
+        result['output'] = output
+    return result
+
+
+def exec_filter(cc, cxx):
+    """ Creates the executable name filter for the interception library.
+
+    The library reports only those executions, which executable name is
+    matching the filter. The filter accepts the same executable names as
+    `Compilation._split_compiler` does. Therefore it does not change the
+    result, only reduces the number of reported executions.
+
+    :param cc:          user specified C compiler name
+    :param cxx:         user specified C++ compiler name
+    :return: POSIX extended regular expression as string. """
+
+    def escape(name):
+        """ Escape the special characters of extended regular expression. """
+
+        return re.sub(r'([.\[\]()*+?{}|^$\\])', r'\\\1', name)
+
+    patterns = [COMPILER_PATTERN_WRAPPER] + \
+        sorted(COMPILER_PATTERNS_CC, key=lambda pattern: pattern.pattern) + \
+        sorted(COMPILER_PATTERNS_CXX, key=lambda pattern: pattern.pattern) + \
+        sorted(AR_PATTERNS, key=lambda pattern: pattern.pattern)
+    names = [os.path.basename(cc), os.path.basename(cxx), 'ar']
+    return '|'.join(['(' + pattern.pattern + ')' for pattern in patterns] +
+                    ['(^' + escape(name) + '$)' for name in names])
+
+
+def entry_filter(include_paths=None, exclude_paths=None,
+                 include_patterns=None, exclude_patterns=None,
+                 exclude_kinds=None):
+    """ Creates a predicate to select the compilations by their source file
+    and kind.
+
+    A compilation is selected when its source file matches any of the
+    include rules (or no include rule was given), and it does not match
+    any of the exclude rules. The path globs are matched against the
+    absolute source file name (relative globs are taken relative to the
+    current directory), the regular expressions are searched in it. The
+    rules of the same type are merged into a single regular expression.
+
+    :param include_paths:       list of path globs to keep,
+    :param exclude_paths:       list of path globs to drop,
+    :param include_patterns:    list of regular expressions to keep,
+    :param exclude_patterns:    list of regular expressions to drop,
+    :param exclude_kinds:       list of compiler kinds ('c', 'c++', 'ar' or
+                                'ld') to drop,
+    :return: a function which takes a Compilation and returns True when it
+    shall be kept, or None when there are no rules given. (Raises re.error
+    for invalid regular expressions.) """
+
+    def globs(patterns):
+        return [fnmatch.translate(pattern if pattern.startswith('*') else
+                                  os.path.abspath(pattern))
+                for pattern in patterns or []]
+
+    def combined(patterns):
+        return re.compile('|'.join('(?:{0})'.format(pattern)
+                                   for pattern in patterns)) \
+            if patterns else None
+
+    includes = combined(globs(include_paths) + list(include_patterns or []))
+    excludes = combined(globs(exclude_paths) + list(exclude_patterns or []))
+    kinds = frozenset(exclude_kinds or [])
+    if includes is None and excludes is None and not kinds:
+        return None
+
+    def predicate(compilation):
+        return compilation.compiler not in kinds and \
+            (includes is None or includes.search(compilation.source)) and \
+            (excludes is None or not excludes.search(compilation.source))
+
+    return predicate
+
+
+def compiler_executable(command, cc, cxx):
+    """ Returns the compiler executable of a compiler call.
+
+    The compiler wrappers (like 'ccache' or 'distcc') are skipped the same
+    way as `Compilation._split_compiler` does.
+
+    :param command:     the command of a compiler call,
+    :param cc:          user specified C compiler name,
+    :param cxx:         user specified C++ compiler name,
+    :return: the compiler executable as it was in the command, or None
+    when it's not a compiler (or a wrapper without explicit compiler). """
+
+    for index, argument in enumerate(command):
+        executable = os.path.basename(argument)
+        kind = executable_kind(executable)
+        if kind == 'wrapper':
+            continue
+        elif kind in {'c', 'c++'} or \
+                executable in {os.path.basename(cc), os.path.basename(cxx)}:
+            return command[index]
+        return None
+    return None
+
+
+def executable_kind(executable):
+    """ Classify the executable name by the known name patterns.
+
+    :param executable:  the executable name (without directory)
+    :return: 'wrapper', 'c', 'c++', 'ar' or None """
+
+    try:
+        return EXECUTABLE_KINDS[executable]
+    except KeyError:
+        if COMPILER_PATTERN_WRAPPER.match(executable):
+            kind = 'wrapper'
+        elif COMPILER_PATTERN_CC.match(executable):
+            kind = 'c'
+        elif COMPILER_PATTERN_CXX.match(executable):
+            kind = 'c++'
+        elif AR_PATTERN.match(executable):
+            kind = 'ar'
+        else:
+            kind = None
+        if len(EXECUTABLE_KINDS) >= EXECUTABLE_KINDS_LIMIT:
+            EXECUTABLE_KINDS.clear()
+        EXECUTABLE_KINDS[executable] = kind
+        return kind
+
+
+# Source file extension to language map. (For C compiler.)
+SOURCE_LANGUAGES = {
+    '.c': 'c',
+    '.i': 'c-cpp-output',
+    '.ii': 'c++-cpp-output',
+    '.m': 'objective-c',
+    '.mi': 'objective-c-cpp-output',
+    '.mm': 'objective-c++',
+    '.mii': 'objective-c++-cpp-output',
+    '.C': 'c++',
+    '.cc': 'c++',
+    '.CC': 'c++',
+    '.cp': 'c++',
+    '.cpp': 'c++',
+    '.cxx': 'c++',
+    '.c++': 'c++',
+    '.C++': 'c++',
+    '.txx': 'c++'
+}
+
+# The extensions which are mapped differently for C++ compiler.
+SOURCE_LANGUAGES_CXX = dict(SOURCE_LANGUAGES, **{
+    '.c': 'c++',
+    '.i': 'c++-cpp-output'
+})
 
 
 def classify_source(filename, c_compiler=True):
@@ -312,24 +1394,6 @@ def classify_source(filename, c_compiler=True):
     :param c_compiler:  indicate that the compiler is a C compiler,
     :return: the language from file name extension. """
 
-    mapping = {
-        '.c': 'c' if c_compiler else 'c++',
-        '.i': 'c-cpp-output' if c_compiler else 'c++-cpp-output',
-        '.ii': 'c++-cpp-output',
-        '.m': 'objective-c',
-        '.mi': 'objective-c-cpp-output',
-        '.mm': 'objective-c++',
-        '.mii': 'objective-c++-cpp-output',
-        '.C': 'c++',
-        '.cc': 'c++',
-        '.CC': 'c++',
-        '.cp': 'c++',
-        '.cpp': 'c++',
-        '.cxx': 'c++',
-        '.c++': 'c++',
-        '.C++': 'c++',
-        '.txx': 'c++'
-    }
-
-    __, extension = os.path.splitext(os.path.basename(filename))
+    mapping = SOURCE_LANGUAGES if c_compiler else SOURCE_LANGUAGES_CXX
+    __, extension = os.path.splitext(filename)
     return mapping.get(extension)
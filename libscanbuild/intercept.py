@@ -14,33 +14,94 @@ The 'libear' library is capturing all child process creation and logging the
 relevant information about it into separate files in a specified directory.
 The parameter of this process is the output directory name, where the report
 files shall be placed. This parameter is passed as an environment variable.
+(In 'log' trace mode the records are appended to a single log file instead,
+in 'socket' trace mode the records are sent to a collector thread of this
+process, which classifies them while the build is running.)
+When the build profile is requested, the records carry timestamps and the
+processes report their termination too.
+
+The failed compilations are not part of the compilation database. The
+interception library reports the termination of the child processes (with
+reported execution) from the wait calls into a separate status log, the
+compiler wrappers report the exit status of the compiler directly.
 
 The module also implements compiler wrappers to intercept the compiler calls.
 
 The module implements the build command execution and the post-processing of
 the output files, which will condensates into a compilation database. """
 
+import binascii
+import bisect
+import collections
+import contextlib
+import hashlib
 import itertools
 import json
 import logging
+import multiprocessing
 import os
 import os.path
 import re
+import socket
+import struct
 import sys
+import tempfile
+import threading
 import uuid
+from multiprocessing.pool import ThreadPool
 
-from libear import build_libear, temporary_directory
+from libear import build_libear, cache_directory, find_executable, \
+    temporary_directory
 from libscanbuild import tempdir, command_entry_point, wrapper_entry_point, \
-    wrapper_environment, run_build, run_command, Execution
+    wrapper_environment, run_build, run_command, scandir, is_file, Execution, \
+    clear_file_system_caches
 from libscanbuild.arguments import intercept
-from libscanbuild.compilation import Compilation, CompilationDatabase
+from libscanbuild.compilation import Compilation, CompilationDatabase, \
+    compiler_executable, exec_filter, merge, unique
+from libscanbuild.profile import write_build_profile
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 __all__ = ['capture', 'intercept_build_main', 'intercept_build_wrapper']
 
 COMPILER_WRAPPER_CC = 'intercept-cc'
 COMPILER_WRAPPER_CXX = 'intercept-c++'
 TRACE_FILE_EXTENSION = '.json'  # same as in ear.c
+TRACE_LOG_FILE = 'exec_trace.log'
+TRACE_SOCKET_LOG_FILE = 'exec_trace.socket.log'
+TRACE_SOCKET_ENTRIES_FILE = 'exec_trace.socket.entries'
+TRACE_STATUS_FILE = 'exec_status.log'  # same as in ear.c
+TRACE_LOG_FILES = (TRACE_LOG_FILE, TRACE_SOCKET_LOG_FILE)
+TRACE_SOCKET_FILE = 'exec_trace.sock'
+TRACE_INDEX_FILE = 'exec_trace.index'
+TRACE_PIDS_FILE = 'exec_trace.pids'
+# Size of the process id table when the maximum process id is not known.
+TRACE_PIDS_DEFAULT = 1 << 22
+# Number of fingerprints the exec index can hold. (8 bytes each.)
+TRACE_INDEX_SLOTS = 1 << 17
+# the exec index slot flag of the successful executions (same as in ear.c)
+TRACE_INDEX_SUCCEEDED = 1 << 63
+# Number of trace files (or log lines) processed by a worker at once.
+TRACE_CHUNK_SIZE = 1024
+# Environment variable to override the compiler probe cache directory. (Set
+# it empty to disable the cache.)
+COMPILER_CACHE_DIR_KEY = 'INTERCEPT_BUILD_COMPILER_CACHE_DIR'
+COMPILER_CONFIG_FILE = 'compile_config.json'
+# Longest datagram the collector accepts. (It's bigger than the default
+# socket send buffer, so the senders fail first and fall back to files.)
+TRACE_DATAGRAM_MAX = 1 << 20
 WRAPPER_ONLY_PLATFORMS = frozenset({'win32', 'cygwin'})
+# The process failures of the build and the repeated executions which did not
+# fail. (Set in the worker processes by `set_exec_failures`, instead of
+# passing them with every task.)
+EXEC_FAILURES = dict()
+EXEC_RESCUED = set()
+# File name suffixes of the compilation database update journals and lock.
+DATABASE_JOURNAL_SUFFIX = '.journal'
+DATABASE_LOCK_SUFFIX = '.lock'
 
 
 @command_entry_point
@@ -48,19 +109,140 @@ def intercept_build_main():
     """ Entry point for 'intercept-build' command. """
 
     args = intercept()
-    exit_code, current = capture(args)
-
-    # To support incremental builds, it is desired to read elements from
-    # an existing compilation database from a previous run.
-    if args.append and os.path.isfile(args.cdb):
-        previous = CompilationDatabase.load(args.cdb)
-        entries = iter(set(itertools.chain(previous, current)))
-        CompilationDatabase.save(args.cdb, entries)
-    else:
-        CompilationDatabase.save(args.cdb, current)
+    with temporary_directory(prefix='intercept-', dir=tempdir()) as tmp_dir:
+        exit_code, current = capture(args, tmp_dir)
+        if args.entry_filter is not None:
+            current = (compilation for compilation in current
+                       if args.entry_filter(compilation))
+        # To support incremental builds, it is desired to read elements from
+        # an existing compilation database from a previous run.
+        if args.append:
+            append_compilations(args.cdb, current, args.compact, args.sorted)
+        elif args.shards:
+            shard_of = compilation_shard(os.getcwd(), args.shard_map)
+            CompilationDatabase.save_shards(args.cdb, current, shard_of,
+                                            args.compact, args.sorted)
+        else:
+            CompilationDatabase.save(args.cdb, current, args.compact,
+                                     args.sorted)
 
     return exit_code
 
+
+def append_compilations(filename, compilations, compact=False,
+                        ordered=False):
+    """ Merges the compilations into the compilation database.
+
+    Multiple 'intercept-build --append' might run at the same time against
+    the same output file. Each of them writes its own entries into a journal
+    file first (next to the output file), then takes the lock of the output
+    and merges all the pending journals into it. (A process might find its
+    journal already merged by another one.) The output file is replaced
+    atomically, readers see either the old or the new content.
+
+    :param filename:        the compilation database file name,
+    :param compilations:    iterable of Compilation objects,
+    :param compact:         write the output without indentation,
+    :param ordered:         write the output entries sorted. """
+
+    journal = '{0}.{1}-{2}{3}'.format(filename, os.getpid(), uuid.uuid4().hex,
+                                      DATABASE_JOURNAL_SUFFIX)
+    CompilationDatabase.save(journal, compilations, compact=True)
+
+    with database_lock(filename):
+        journals = pending_journals(filename)
+        if not journals:
+            logging.debug('entries were merged by another process')
+            return
+        previous = CompilationDatabase.load_entries(filename) \
+            if os.path.isfile(filename) else []
+        entries = previous
+        for name in journals:
+            entries = merge(entries, CompilationDatabase.load_entries(name))
+        if entries != previous or not os.path.isfile(filename):
+            CompilationDatabase.save_entries(filename, entries, compact,
+                                             ordered)
+        else:
+            logging.debug('compilation database is up to date')
+        for name in journals:
+            os.unlink(name)
+
+
+def compilation_shard(root, mapping_file=None):
+    """ Creates the function which tells the shard name of a compilation.
+
+    Without mapping the shard is the top level directory of the source file
+    (relative to the root directory). The mapping is a JSON object, which
+    maps the shard names to lists of directories (relative to the root, or
+    absolute). The shard of the longest matching directory is taken.
+
+    Source files outside of the root directory belong to the '_external'
+    shard, the ones directly in the root (or not matching any directory of
+    the mapping) belong to the '_other' shard.
+
+    :param root:            the root directory of the sources,
+    :param mapping_file:    the name of the mapping file (optional),
+    :return: function, which takes a Compilation and returns a name. """
+
+    def sanitize(name):
+        return re.sub(r'[^\w.+-]', '_', name)
+
+    prefixes = []
+    if mapping_file:
+        with open(mapping_file, 'r') as handle:
+            mapping = json.load(handle)
+        for name, directories in mapping.items():
+            for directory in directories:
+                path = os.path.normpath(os.path.join(root, directory))
+                prefixes.append((path + os.sep, sanitize(name)))
+        prefixes.sort(key=lambda prefix: len(prefix[0]), reverse=True)
+
+    def shard_of(compilation):
+        relative = os.path.relpath(compilation.source, root)
+        if relative.split(os.sep)[0] == os.pardir:
+            return '_external'
+        if mapping_file:
+            return next((name for path, name in prefixes
+                         if compilation.source.startswith(path)), '_other')
+        directory = relative.split(os.sep)[0] if os.sep in relative else None
+        return sanitize(directory) if directory else '_other'
+
+    return shard_of
+
+
+def pending_journals(filename):
+    """ Returns the journal files of the compilation database, in the order
+    of their creation. """
+
+    directory, prefix = os.path.split(os.path.abspath(filename))
+    # the journal names are '<cdb>.<pid>-<hex>.journal' (another database
+    # file name might start with the same prefix)
+    pattern = re.compile(r'{0}\.\d+-[0-9a-f]+{1}$'.format(
+        re.escape(prefix), re.escape(DATABASE_JOURNAL_SUFFIX)))
+    candidates = [os.path.join(directory, name)
+                  for name in os.listdir(directory)
+                  if pattern.match(name)]
+    return sorted(candidates, key=lambda name: (os.stat(name).st_mtime, name))
+
+
+@contextlib.contextmanager
+def database_lock(filename):
+    """ Holds an exclusive (advisory) lock of the compilation database.
+
+    The lock is taken on a separate file, because the database file itself
+    is replaced while the lock is held. On platforms without `fcntl` it does
+    not lock. """
+
+    if fcntl is None:
+        yield
+        return
+    with open(filename + DATABASE_LOCK_SUFFIX, 'a') as handle:
+        fcntl.flock(handle.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(handle.fileno(), fcntl.LOCK_UN)
+
 def parseDefine(str, define_re):
     str = str.lstrip('#define ')
     m = define_re.search(str)
@@ -106,44 +288,298 @@ def find_compiler_config(compiler, tmp_file_name, tmp_dir):
     logging.debug('Recognized config: %s' % compiler_conf)
     return compiler_conf
 
-def write_compiler_config(args, tmp_dir):
-    # Find C/C++ compilers default configuration
-    cc_conf = find_compiler_config(args.cc, 'a.c', tmp_dir)
-    cxx_conf = find_compiler_config(args.cxx, 'a.cpp', tmp_dir)
-    with open('compile_config.json', 'w') as handle:
-        json.dump({'cc':cc_conf, 'cxx':cxx_conf}, handle, sort_keys=True, indent=4)
+def write_compiler_config(args, compilers, tmp_dir):
+    """ Writes the default configuration of the compilers.
+
+    Beside the user specified C and C++ compilers, it probes the compilers
+    which were executed by the build. The probes run concurrently and the
+    results are cached between runs.
+
+    :param args:        the parsed and validated command line arguments,
+    :param compilers:   set of (executable, language) seen in the build,
+    :param tmp_dir:     directory for the probe input files. """
+
+    requested = [(args.cc, 'c'), (args.cxx, 'c++')]
+    seen = sorted(set(compilers) - set(requested))
+    candidates = requested + seen
+    cache_dir = cache_directory('compilers', COMPILER_CACHE_DIR_KEY)
+
+    def probe(candidate):
+        executable, language = candidate
+        return probe_compiler_config(executable, language, cache_dir, tmp_dir)
+
+    pool = ThreadPool(min(len(candidates), 8))
+    try:
+        configs = pool.map(probe, candidates)
+    finally:
+        pool.close()
+        pool.join()
+
+    content = {
+        'cc': configs[0],
+        'cxx': configs[1],
+        'compilers': [dict(config, compiler=executable, language=language)
+                      for (executable, language), config
+                      in zip(seen, configs[2:])]
+    }
+    with open(COMPILER_CONFIG_FILE, 'w') as handle:
+        json.dump(content, handle, sort_keys=True, indent=4)
+
+
+def probe_compiler_config(compiler, language, cache_dir, tmp_dir):
+    """ Returns the default configuration of a compiler.
+
+    The result is read from the cache when the cache has an entry for the
+    same compiler (resolved path, size and modification time).
+
+    :param compiler:    the compiler executable,
+    :param language:    the language to probe ('c' or 'c++'),
+    :param cache_dir:   the cache directory path (None disables the cache),
+    :param tmp_dir:     directory for the probe input files,
+    :return: the recognized compiler configuration. """
+
+    cache_file = None
+    executable = find_executable(compiler)
+    if cache_dir and executable:
+        cache_file = os.path.join(
+            cache_dir, compiler_cache_key(executable, language) + '.json')
+        try:
+            with open(cache_file, 'r') as handle:
+                logging.debug('Using cached config of %s', compiler)
+                return json.load(handle)
+        except (IOError, OSError, ValueError):
+            pass
+
+    work_dir = tempfile.mkdtemp(prefix='probe-', dir=tmp_dir)
+    source = 'a.cpp' if language == 'c++' else 'a.c'
+    try:
+        config = find_compiler_config(executable or compiler, source, work_dir)
+    except Exception:
+        logging.warning('Could not probe compiler: %s', compiler,
+                        exc_info=True)
+        return recognize_config([])
+
+    if cache_file:
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            # publish the entry by renaming, readers see complete files only
+            handle, temp_file = tempfile.mkstemp(prefix='.', dir=cache_dir)
+            with os.fdopen(handle, 'w') as writer:
+                json.dump(config, writer)
+            os.rename(temp_file, cache_file)
+        except (IOError, OSError):
+            logging.debug('Could not cache config of %s', compiler,
+                          exc_info=True)
+    return config
 
-def capture(args):
+
+def compiler_cache_key(executable, language):
+    """ Creates the cache entry name for the compiler probe.
+
+    :param executable:  the resolved path of the compiler,
+    :param language:    the language of the probe,
+    :return: the key as hexadecimal string. """
+
+    stat = os.stat(executable)
+    identity = [executable, str(stat.st_size), str(stat.st_mtime), language]
+    return hashlib.sha1('\0'.join(identity).encode('utf-8')).hexdigest()
+
+
+def capture(args, tmp_dir):
     """ Implementation of compilation database generation.
 
+    The build command runs before this method returns. The compilations are
+    read from the execution reports while the returned generator is being
+    consumed. (So, the trace directory shall exist till then.)
+
     :param args:    the parsed and validated command line arguments
-    :return:        the exit status of build process. """
+    :param tmp_dir: the directory for the execution reports
+    :return:        the exit status of build process and the generator of
+                    the unique compilations. """
 
-    with temporary_directory(prefix='intercept-', dir=tempdir()) as tmp_dir:
-        # run the build command
-        environment = setup_environment(args, tmp_dir)
-        write_compiler_config(args, tmp_dir)
+    # run the build command
+    environment = setup_environment(args, tmp_dir)
+    # the compilers of the build are added after the build
+    write_compiler_config(args, set(), tmp_dir)
+    trace_socket = environment.get('INTERCEPT_BUILD_TRACE_SOCKET')
+    with exec_trace_collector(trace_socket, tmp_dir, args.cc, args.cxx,
+                              bool(args.build_profile)):
         exit_code = run_build(args.build, env=environment)
-        # read the intercepted exec calls
-        calls = (parse_exec_trace(file) for file in exec_trace_files(tmp_dir))
-        current = compilations(calls, args.cc, args.cxx)
 
-        return exit_code, iter(set(current))
+    return exit_code, unique(captured_compilations(args, tmp_dir))
+
+
+def captured_compilations(args, tmp_dir):
+    """ Generates the compilations from the execution reports.
+
+    The process termination reports are read first (the interception
+    library writes those into a separate file), then the execution reports
+    are classified on chunks of reports in worker processes. The failures
+    are passed to the worker processes only once, when those are started.
+    The compilations, which were classified by the trace collector during
+    the build, are only checked against the failures. The compiler config
+    and the build profile are written when the generator is finished, or
+    closed. (The rest of the reports are processed for those then.) The
+    file system caches are cleared at the start and at the end, those are
+    valid only during this pass.
+
+    :param args:        the parsed and validated command line arguments,
+    :param tmp_dir:     the trace directory,
+    :return: generator of the compilations (might contain duplicates). """
+
+    def chunks():
+        return exec_trace_chunks(tmp_dir, TRACE_CHUNK_SIZE)
+
+    clear_file_system_caches()
+    use_wrapper = is_wrapper_used(args)
+    keep_records = bool(args.build_profile)
+    # the compiler wrappers report the exit status in the execution
+    # report itself, there are no termination reports then.
+    status_log = os.path.join(tmp_dir, TRACE_STATUS_FILE)
+    terminations = [] if not os.path.isfile(status_log) else \
+        list(read_exec_trace_log(status_log))
+    failures = exec_failures(terminations)
+    rescued = rescued_executions(os.path.join(tmp_dir, TRACE_INDEX_FILE))
+
+    tasks = ((chunk, args.cc, args.cxx, keep_records) for chunk in chunks())
+    records = terminations if keep_records else []
+    compilers = set()
+    results = process_exec_traces(process_exec_trace_chunk, tasks,
+                                  args.trace_jobs, set_exec_failures,
+                                  (failures, rescued))
+    try:
+        entries_file = os.path.join(tmp_dir, TRACE_SOCKET_ENTRIES_FILE)
+        if os.path.isfile(entries_file):
+            collected, executables = collected_compilations(
+                entries_file, failures, rescued)
+            compilers.update(executables)
+            for entry in collected:
+                yield entry
+        for entries, kept, executables in results:
+            records.extend(kept)
+            compilers.update(executables)
+            for entry in entries:
+                yield entry
+    finally:
+        try:
+            # the consumer might have stopped early (after a failure the
+            # results are exhausted)
+            for _, kept, executables in results:
+                records.extend(kept)
+                compilers.update(executables)
+            # the compiler wrappers report the user specified compilers only
+            write_compiler_config(args, set() if use_wrapper else compilers,
+                                  tmp_dir)
+            if args.build_profile:
+                write_build_profile(args.build_profile, records, args.cc,
+                                    args.cxx)
+        finally:
+            clear_file_system_caches()
+
+
+def process_exec_traces(function, tasks, jobs, initializer=None,
+                        initargs=()):
+    """ Runs the trace processing tasks, in parallel when it's worth.
+
+    :param function:    the task method (a module level function),
+    :param tasks:       iterable of the task method arguments,
+    :param jobs:        number of worker processes (None means CPU count),
+    :param initializer: method to call in every worker process before the
+                        tasks (or None),
+    :param initargs:    arguments of the initializer,
+    :return: generator of the task results (in arbitrary order). """
+
+    jobs = jobs or multiprocessing.cpu_count()
+    tasks = iter(tasks)
+    head = list(itertools.islice(tasks, 2))
+    # the process pool is not started for small builds
+    if jobs <= 1 or len(head) < 2:
+        if initializer is not None:
+            initializer(*initargs)
+        for task in itertools.chain(head, tasks):
+            yield function(task)
+        return
+
+    pool = multiprocessing.Pool(jobs, initializer, initargs)
+    try:
+        for result in pool.imap_unordered(function,
+                                          itertools.chain(head, tasks)):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def set_exec_failures(failures, rescued):
+    """ Sets the failures for the `process_exec_trace_chunk` calls.
+
+    This method runs in the worker processes, when those are started.
+
+    :param failures:    the failures returned by `exec_failures`,
+    :param rescued:     the result of `rescued_executions`. """
+
+    EXEC_FAILURES.clear()
+    EXEC_FAILURES.update(failures)
+    EXEC_RESCUED.clear()
+    EXEC_RESCUED.update(rescued)
+
 
+def process_exec_trace_chunk(task):
+    """ Reads and classifies a chunk of execution reports.
 
-def compilations(exec_calls, cc, cxx):
-    """ Needs to filter out commands which are not compiler calls. And those
-    compiler calls shall be compilation (not pre-processing or linking) calls.
-    Plus needs to find the source file name from the arguments.
+    This method runs in the worker processes.
 
-    :param exec_calls:  iterator of executions
-    :param cc:          user specified C compiler name
-    :param cxx:         user specified C++ compiler name
-    :return: stream of formatted compilation database entries """
+    :param task:    tuple of the chunk (from `exec_trace_chunks`), the C and
+                    C++ compiler names and the flag to keep all records,
+    :return: the result of `classify_exec_traces`. """
 
-    for call in exec_calls:
-        for entry in Compilation.from_call(call, cc, cxx):
-            yield entry
+    chunk, cc, cxx, keep_records = task
+    return classify_exec_traces(chunk_records(chunk), cc, cxx, EXEC_FAILURES,
+                                keep_records, EXEC_RESCUED)
+
+
+def classify_exec_traces(records, cc, cxx, failures, keep_records,
+                         rescued=frozenset(), check_source=True):
+    """ Turns the execution reports into compilation entries.
+
+    The failed executions are skipped, unless the same execution was
+    repeated without failure. The duplicate entries are removed from the
+    result.
+
+    :param records:         iterable of execution reports,
+    :param cc:              user specified C compiler name,
+    :param cxx:             user specified C++ compiler name,
+    :param failures:        the failures returned by `exec_failures`,
+    :param keep_records:    keep all execution reports,
+    :param rescued:         the result of `rescued_executions`,
+    :param check_source:    take only the compilations of existing sources,
+    :return: tuple of the list of compilations, the list of kept execution
+             reports and the set of executed compilers (executable and
+             language). """
+
+    entries = set()
+    kept = []
+    compilers = set()
+    for record in records:
+        if keep_records:
+            kept.append(record)
+        if 'cmd' not in record:
+            continue
+        if is_failed(record, failures) and record.get('exec') not in rescued:
+            continue
+        # the compiler is probed later, not the compiler wrapper
+        executable = compiler_executable(record['cmd'], cc, cxx)
+        if executable is not None and os.path.dirname(executable):
+            executable = os.path.normpath(
+                os.path.join(record['cwd'], executable))
+        for entry in Compilation.from_call(to_execution(record), cc, cxx,
+                                           check_source):
+            entries.add(entry)
+            if executable is not None and entry.compiler in {'c', 'c++'}:
+                compilers.add((executable, entry.compiler))
+    return list(entries), kept, compilers
 
 
 def setup_environment(args, destination):
@@ -158,10 +594,23 @@ def setup_environment(args, destination):
     :param destination: directory path for the execution trace files
     :return: a prepared set of environment variables. """
 
-    use_wrapper = args.override_compiler or is_preload_disabled(sys.platform)
+    use_wrapper = is_wrapper_used(args)
 
     environment = dict(os.environ)
     environment.update({'INTERCEPT_BUILD_TARGET_DIR': destination})
+    trace_mode = args.trace_mode
+    if trace_mode == 'socket':
+        trace_socket = os.path.join(destination, TRACE_SOCKET_FILE)
+        if not is_socket_supported(trace_socket):
+            logging.warning('trace socket is not available, use trace log.')
+            trace_mode = 'log'
+        else:
+            environment.update({'INTERCEPT_BUILD_TRACE_SOCKET': trace_socket})
+    if trace_mode == 'log':
+        trace_log = os.path.join(destination, TRACE_LOG_FILE)
+        environment.update({'INTERCEPT_BUILD_TRACE_LOG': trace_log})
+    if args.build_profile:
+        environment.update({'INTERCEPT_BUILD_PROFILE': '1'})
 
     if use_wrapper:
         environment.update(wrapper_environment(args))
@@ -171,6 +620,21 @@ def setup_environment(args, destination):
         })
     else:
         intercept_library = build_libear(args.cc, destination)
+        # the processes with reported execution are marked in this table
+        # (with their exec index slot), to report their termination only.
+        exec_pids = os.path.join(destination, TRACE_PIDS_FILE)
+        create_exec_index(exec_pids, max_process_id() // 2 + 1)
+        environment.update({'INTERCEPT_BUILD_EXEC_PIDS': exec_pids})
+        # report only those executions which could be compiler calls, and
+        # report the same command only once (the profile needs all processes
+        # to find the critical path)
+        if not args.build_profile:
+            exec_index = os.path.join(destination, TRACE_INDEX_FILE)
+            create_exec_index(exec_index, TRACE_INDEX_SLOTS)
+            environment.update({
+                'INTERCEPT_BUILD_EXEC_FILTER': exec_filter(args.cc, args.cxx),
+                'INTERCEPT_BUILD_EXEC_INDEX': exec_index
+            })
         if sys.platform == 'darwin':
             environment.update({
                 'DYLD_INSERT_LIBRARIES': intercept_library,
@@ -196,46 +660,437 @@ def intercept_build_wrapper(**kwargs):
     if not target_dir:
         logging.warning(message_prefix, 'missing target directory')
         return
-    # write current execution info to the pid file
+    trace_socket = os.getenv('INTERCEPT_BUILD_TRACE_SOCKET')
+    trace_log = os.getenv('INTERCEPT_BUILD_TRACE_LOG')
+    execution = kwargs['execution']
+    # the wrapper reports the start and the end of the compilation together
+    # (when those are comparable with the other timestamps)
+    extra = {
+        'ppid': os.getppid(),
+        'start': kwargs['start'],
+        'end': kwargs['end']
+    } if os.getenv('INTERCEPT_BUILD_PROFILE') and \
+        kwargs['start'] is not None else dict()
+    if kwargs['result']:
+        extra.update({'status': kwargs['result']})
+    # write current execution info to the pid file (or to the shared log)
     try:
-        target_file_name = str(uuid.uuid4()) + TRACE_FILE_EXTENSION
-        target_file = os.path.join(target_dir, target_file_name)
-        logging.debug('writing execution report to: %s', target_file)
-        write_exec_trace(target_file, kwargs['execution'])
-    except IOError:
+        if trace_socket and send_exec_trace(trace_socket, execution, extra):
+            logging.debug('execution report sent to: %s', trace_socket)
+        elif trace_log:
+            logging.debug('appending execution report to: %s', trace_log)
+            append_exec_trace(trace_log, execution, extra)
+        else:
+            target_file_name = str(uuid.uuid4()) + TRACE_FILE_EXTENSION
+            target_file = os.path.join(target_dir, target_file_name)
+            logging.debug('writing execution report to: %s', target_file)
+            write_exec_trace(target_file, execution, extra)
+    except (IOError, OSError):
         logging.warning(message_prefix, 'io problem')
 
 
-def write_exec_trace(filename, entry):
+def exec_trace_record(entry, extra=None):
+    """ Creates the execution report from the Execution object.
+
+    :param entry:       the Execution object,
+    :param extra:       additional attributes of the report (or None),
+    :return: the report as dictionary. """
+
+    call = {'pid': entry.pid, 'cwd': entry.cwd, 'cmd': entry.cmd}
+    if extra:
+        call.update(extra)
+    return call
+
+
+def write_exec_trace(filename, entry, extra=None):
     """ Write execution report file.
 
     This method shall be sync with the execution report writer in interception
     library. The entry in the file is a JSON objects.
 
     :param filename:    path to the output execution trace file,
-    :param entry:       the Execution object to append to that file. """
+    :param entry:       the Execution object to append to that file,
+    :param extra:       additional attributes of the report (or None). """
 
-    call = {'pid': entry.pid, 'cwd': entry.cwd, 'cmd': entry.cmd}
+    call = exec_trace_record(entry, extra)
     with open(filename, 'w') as handler:
         json.dump(call, handler)
 
 
-def parse_exec_trace(filename):
-    """ Parse execution report file.
+def append_exec_trace(filename, entry, extra=None):
+    """ Append execution report to the shared trace log.
 
-    Given filename points to a file which contains the basic report
-    generated by the interception library or compiler wrapper.
+    This method shall be sync with the log writer in interception library.
+    The entry is a single line JSON object, which is written by a single
+    `write` call, to not get mixed with concurrent writers.
 
-    :param filename: path to an execution trace file to read from,
+    :param filename:    path to the output execution trace log,
+    :param entry:       the Execution object to append to that file,
+    :param extra:       additional attributes of the report (or None). """
+
+    call = exec_trace_record(entry, extra)
+    record = (json.dumps(call) + '\n').encode('utf-8')
+    flags = os.O_WRONLY | os.O_APPEND | os.O_CREAT
+    handle = os.open(filename, flags, 0o666)
+    try:
+        os.write(handle, record)
+    finally:
+        os.close(handle)
+
+
+def send_exec_trace(filename, entry, extra=None):
+    """ Send execution report to the collector socket.
+
+    This method shall be sync with the socket writer in interception library.
+    The entry is a JSON object sent as a single datagram.
+
+    :param filename:    path to the collector Unix domain socket,
+    :param entry:       the Execution object to send,
+    :param extra:       additional attributes of the report (or None),
+    :return:            True if the report was delivered. """
+
+    call = exec_trace_record(entry, extra)
+    record = (json.dumps(call) + '\n').encode('utf-8')
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        # don't wait for the collector, fall back to files instead
+        client.setblocking(False)
+        return client.sendto(record, filename) == len(record)
+    except (IOError, OSError):
+        return False
+    finally:
+        client.close()
+
+
+@contextlib.contextmanager
+def exec_trace_collector(filename, directory, cc, cxx, keep_records):
+    """ Collects the execution reports sent to the given socket.
+
+    A background thread receives the datagrams while the build is running.
+    The reports are classified right away: the unique compilations are
+    written into the entries file (with the identity of the execution), the
+    repeated ones only with the identity of the execution. The failures are
+    only known when the build finished, those are filtered then. (See the
+    `collected_compilations` method.) When all reports are kept (for the
+    build profile), the reports are written into the trace log instead, and
+    processed after the build, the same way as the other trace files. When
+    the context exits, it drains the already sent reports and stops.
+
+    :param filename:        path to the socket to bind, or None to do nothing,
+    :param directory:       the trace directory,
+    :param cc:              user specified C compiler name,
+    :param cxx:             user specified C++ compiler name,
+    :param keep_records:    keep all execution reports. """
+
+    if not filename:
+        yield
+        return
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    server.bind(filename)
+    server.settimeout(0.1)
+    output = open(os.path.join(directory, TRACE_SOCKET_LOG_FILE
+                               if keep_records else TRACE_SOCKET_ENTRIES_FILE),
+                  'ab')
+    done = threading.Event()
+    seen = set()
+    compilers = set()
+
+    def write(item):
+        output.write((json.dumps(item) + '\n').encode('utf-8'))
+
+    def classify(line):
+        """ Writes the compilations of a report into the entries file. """
+
+        for record in parse_exec_trace_lines([line]):
+            # the source file might be generated later in the build
+            entries, _, executables = classify_exec_traces(
+                [record], cc, cxx, {}, False, check_source=False)
+            for compiler in executables - compilers:
+                compilers.add(compiler)
+                write({'compiler': list(compiler)})
+            identity = dict((key, record[key])
+                            for key in ('pid', 'ppid', 'start', 'exec')
+                            if key in record)
+            for entry in entries:
+                fingerprint = entry.fingerprint()
+                item = dict(identity, fingerprint=binascii.hexlify(
+                    fingerprint).decode('ascii'))
+                if fingerprint not in seen:
+                    seen.add(fingerprint)
+                    item['entry'] = {'compiler': entry.compiler,
+                                     'flags': entry.flags,
+                                     'source': entry.source,
+                                     'directory': entry.directory}
+                elif 'start' not in record and 'exec' not in record:
+                    # it can't fail then, like the first one
+                    continue
+                write(item)
+
+    def receive():
+        """ Receive datagrams till the build finished and nothing left. """
+
+        buffer = bytearray(TRACE_DATAGRAM_MAX)
+        while True:
+            try:
+                length = server.recv_into(buffer)
+            except socket.timeout:
+                if done.is_set():
+                    return
+                continue
+            except (IOError, OSError):
+                # senders don't block on this socket, their reports end up
+                # in the trace directory.
+                logging.warning('execution report collector failed',
+                                exc_info=True)
+                return
+            if not keep_records:
+                classify(bytes(buffer[:length]).decode('utf-8', 'replace'))
+                continue
+            # a report is a single line, the malformed ones are reported
+            # when the log is read
+            if length and buffer[length - 1:length] != b'\n':
+                buffer[length:length + 1] = b'\n'
+                length += 1
+            output.write(buffer[:length])
+
+    collector = threading.Thread(target=receive)
+    collector.daemon = True
+    collector.start()
+    try:
+        yield
+    finally:
+        done.set()
+        collector.join()
+        server.close()
+        output.close()
+
+
+def collected_compilations(filename, failures, rescued):
+    """ Reads the compilations of the entries file of the collector.
+
+    A compilation is kept when any of its executions did not fail, and its
+    source file exists. The file is read twice: first the repeated
+    executions are checked, then the compilations are generated.
+
+    :param filename:    path to the entries file,
+    :param failures:    the failures returned by `exec_failures`,
+    :param rescued:     the result of `rescued_executions`,
+    :return: tuple of the generator of the compilations and the set of
+             executed compilers (executable and language). """
+
+    def is_kept(item):
+        return not is_failed(item, failures) or item.get('exec') in rescued
+
+    compilers = set()
+    succeeded = set()
+    for item in read_exec_trace_log(filename):
+        if 'compiler' in item:
+            compilers.add(tuple(item['compiler']))
+        elif 'entry' not in item and is_kept(item):
+            succeeded.add(item['fingerprint'])
+
+    def compilations():
+        for item in read_exec_trace_log(filename):
+            if 'entry' in item and (item['fingerprint'] in succeeded or
+                                    is_kept(item)) and \
+                    is_file(item['entry']['source']):
+                yield Compilation(**item['entry'])
+
+    return compilations(), compilers
+
+
+def create_exec_index(filename, slots):
+    """ Creates the exec index file for the interception library.
+
+    The index is a zero filled file, which the interception library maps
+    into memory as a hash table of the already reported executions. This
+    way the same command (in the same directory) is reported only once.
+
+    :param filename:    path of the index file,
+    :param slots:       number of the hash table slots. """
+
+    with open(filename, 'wb') as handle:
+        handle.truncate(slots * 8)
+
+
+def max_process_id():
+    """ Returns the maximum process id of the system (or a guess of it). """
+
+    try:
+        with open('/proc/sys/kernel/pid_max', 'r') as handle:
+            return int(handle.read())
+    except (IOError, OSError, ValueError):
+        return TRACE_PIDS_DEFAULT
+
+
+def is_socket_supported(filename):
+    """ Check that the trace socket can be created with the given name. """
+
+    # the socket name length is limited by the 'sockaddr_un' structure.
+    return hasattr(socket, 'AF_UNIX') and len(filename) < 100
+
+
+def to_execution(record):
+    """ Creates an Execution object from an execution report.
+
+    :param record: the execution report as dictionary,
     :return: an Execution object. """
 
+    return Execution(
+        pid=record['pid'],
+        cwd=record['cwd'],
+        cmd=record['cmd'])
+
+
+def exec_failures(records):
+    """ Collects the process termination reports of the failed processes.
+
+    The interception library reports the terminated child processes from the
+    parent process. (Only the children with reported execution, or when that
+    is not known, only the failed ones.) The reports refer to the execution
+    identity too, when it's known.
+
+    :param records: iterable of execution reports,
+    :return: dictionary of (pid, ppid) and of execution identities to the
+             sorted list of termination times and exit statuses. (Only those
+             are listed, which have failed termination.) """
+
+    result = collections.defaultdict(list)
+    for record in records:
+        if 'cmd' not in record and 'status' in record:
+            termination = (record['end'], record['status'])
+            result[(record['pid'], record.get('ppid'))].append(termination)
+            if 'exec' in record:
+                result[record['exec']].append(termination)
+    return dict((key, sorted(value)) for key, value in result.items()
+                if any(status for _, status in value))
+
+
+def rescued_executions(filename):
+    """ Collects the executions which terminated successfully.
+
+    The interception library reports the repeated executions (same command
+    in the same directory) only once, but the successful termination of any
+    of them is flagged in the exec index. When the first one failed, but a
+    repeated one did not, the execution is kept.
+
+    :param filename:    path of the exec index file,
+    :return: set of the execution identities. """
+
+    try:
+        with open(filename, 'rb') as handle:
+            content = handle.read()
+    except (IOError, OSError):
+        return set()
+    count = len(content) // 8
+    values = struct.unpack('={0}Q'.format(count), content[:count * 8])
+    return set('{0:016x}'.format(value & ~TRACE_INDEX_SUCCEEDED)
+               for value in values if value & TRACE_INDEX_SUCCEEDED)
+
+
+def is_failed(record, failures):
+    """ Check the execution report was about a failed process.
+
+    An execution is considered failed, when the first termination of the
+    same process id (reported by the same parent process) after the
+    execution started is a failure. (Exec reports from the same process
+    before the termination are all failed, since exec does not change the
+    process id. A later process with the same id has its own termination.)
+    The spawned processes are reported by their parent before those were
+    started (without start time), those are failed when any termination of
+    the same execution identity is a failure.
+
+    :param record:      the execution report as dictionary,
+    :param failures:    the failures returned by `exec_failures`,
+    :return: True if the execution failed. """
+
+    if record.get('status'):
+        return True
+    if not failures:
+        return False
+    if 'start' not in record:
+        return 'exec' in record and record['exec'] in failures
+    terminations = failures.get((record['pid'], record.get('ppid')))
+    if not terminations:
+        return False
+    index = bisect.bisect_left(terminations, (record['start'],))
+    return index < len(terminations) and terminations[index][1] != 0
+
+
+def read_exec_trace_log(filename):
+    """ Read execution report log.
+
+    The log contains one JSON object per line, appended by the interception
+    library and the compiler wrappers. The file is read in a single pass.
+
+    :param filename: path to an execution trace log to read from,
+    :return: a generator of execution reports (dictionaries). """
+
     logging.debug(filename)
     with open(filename, 'r') as handler:
-        entry = json.load(handler)
-        return Execution(
-            pid=entry['pid'],
-            cwd=entry['cwd'],
-            cmd=entry['cmd'])
+        for record in parse_exec_trace_lines(handler):
+            yield record
+
+
+def parse_exec_trace_lines(lines):
+    """ Parse execution reports from the lines of the log.
+
+    :param lines:   iterable of lines, one JSON object per line,
+    :return: a generator of execution reports (dictionaries). """
+
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            logging.warning('malformed execution report: %s', line)
+            continue
+        yield record
+
+
+def chunk_records(chunk):
+    """ Generates the execution reports of a chunk.
+
+    :param chunk:   the chunk (from `exec_trace_chunks`),
+    :return: a generator of execution reports (dictionaries). """
+
+    kind, items = chunk
+    if kind == 'lines':
+        for record in parse_exec_trace_lines(items):
+            yield record
+    else:
+        for filename in items:
+            with open(filename, 'r') as handler:
+                yield json.load(handler)
+
+
+def exec_trace_chunks(directory, size):
+    """ Generates the execution reports of the trace directory in chunks.
+
+    :param directory:   path to directory which contains the trace files,
+    :param size:        maximum number of items in a chunk,
+    :return: a generator of ('files', file names) and ('lines', log lines)
+             tuples. """
+
+    def chunks(kind, iterable):
+        iterator = iter(iterable)
+        while True:
+            chunk = list(itertools.islice(iterator, size))
+            if not chunk:
+                return
+            yield kind, chunk
+
+    for chunk in chunks('files', exec_trace_files(directory)):
+        yield chunk
+
+    for name in TRACE_LOG_FILES:
+        trace_log = os.path.join(directory, name)
+        if os.path.isfile(trace_log):
+            with open(trace_log, 'r') as handler:
+                for chunk in chunks('lines', handler):
+                    yield chunk
 
 
 def exec_trace_files(directory):
@@ -244,11 +1099,28 @@ def exec_trace_files(directory):
     :param directory:   path to directory which contains the trace files.
     :return:            a generator of file names (absolute path). """
 
-    for root, _, files in os.walk(directory):
-        for candidate in files:
-            __, extension = os.path.splitext(candidate)
-            if extension == TRACE_FILE_EXTENSION:
-                yield os.path.join(root, candidate)
+    if scandir is None:
+        for root, _, files in os.walk(directory):
+            for candidate in files:
+                __, extension = os.path.splitext(candidate)
+                if extension == TRACE_FILE_EXTENSION:
+                    yield os.path.join(root, candidate)
+        return
+
+    # the directory entries carry the file type, no extra stat is needed
+    pending = [directory]
+    while pending:
+        for entry in scandir(pending.pop()):
+            if entry.is_dir(follow_symlinks=False):
+                pending.append(entry.path)
+            elif entry.name.endswith(TRACE_FILE_EXTENSION):
+                yield entry.path
+
+
+def is_wrapper_used(args):
+    """ Returns True if the compiler wrappers are used for interception. """
+
+    return args.override_compiler or is_preload_disabled(sys.platform)
 
 
 def is_preload_disabled(platform):
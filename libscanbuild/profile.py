@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+#                     The LLVM Compiler Infrastructure
+#
+# This file is distributed under the University of Illinois Open Source
+# License. See LICENSE.TXT for details.
+""" This module implements the build profile of the 'intercept-build' command.
+
+When profiling is enabled, the interception library (and the compiler
+wrappers) report the start and the end timestamps of the build processes.
+The execution reports are paired by process id into process instances, which
+are linked to their parent process. From these it calculates the duration of
+every compilation and the critical path of the build: the chain of nested
+and sequential processes which the build was waiting for. """
+
+import json
+import logging
+import os.path
+
+from libscanbuild import Execution
+from libscanbuild.compilation import Compilation
+
+__all__ = ['write_build_profile']
+
+NANOSECONDS = 1e9
+
+
+class Process(object):
+    """ Represents a single process instance of the build.
+
+    It starts with the exec (or spawn) call and lasts till the process
+    terminates. An exec chain (when the process replaces its program with
+    another one) does belong to the same instance. """
+
+    def __init__(self, pid, ppid, start):
+        self.pid = pid
+        self.ppid = ppid
+        self.start = start
+        self.end = None
+        self.calls = []
+        self.children = []
+
+    def is_alive(self, timestamp):
+        """ Returns True if the process was running at the given time. """
+
+        return self.start <= timestamp and \
+            (self.end is None or timestamp <= self.end)
+
+    def duration(self):
+        """ Returns the process run time in nanoseconds, or None when the
+        termination of the process was not reported. """
+
+        return None if self.end is None else self.end - self.start
+
+
+def write_build_profile(filename, records, cc, cxx):
+    """ Writes the build profile into the given file.
+
+    :param filename:    path of the output file,
+    :param records:     the execution reports (dictionaries) of the build,
+    :param cc:          user specified C compiler name,
+    :param cxx:         user specified C++ compiler name. """
+
+    profile = build_profile(records, cc, cxx)
+    with open(filename, 'w') as handle:
+        json.dump(profile, handle, sort_keys=True, indent=4)
+    logging.debug('build profile written to: %s', filename)
+
+    for entry in profile['compilations'][:10]:
+        logging.info('%.3fs %s', entry['duration'], entry['file'])
+
+
+def build_profile(records, cc, cxx):
+    """ Creates the build profile from the execution reports.
+
+    :param records:     the execution reports (dictionaries) of the build,
+    :param cc:          user specified C compiler name,
+    :param cxx:         user specified C++ compiler name,
+    :return: the profile as dictionary (durations are in seconds). """
+
+    instances = processes(records)
+    roots = link_processes(instances)
+
+    starts = [process.start for process in instances]
+    ends = [process.end for process in instances if process.end is not None]
+    origin = min(starts) if starts else 0
+    wall_time = (max(ends) - origin) if ends else 0
+
+    return {
+        'wall_time': wall_time / NANOSECONDS,
+        'processes': len(instances),
+        'compilations': compilation_times(instances, cc, cxx),
+        'critical_path': [{
+            'pid': process.pid,
+            'command': process.calls[-1].cmd,
+            'start': (process.start - origin) / NANOSECONDS,
+            'duration': process.duration() / NANOSECONDS
+        } for process in critical_path(roots)]
+    }
+
+
+def processes(records):
+    """ Pairs the execution reports into process instances.
+
+    The start reports has 'start' and 'cmd' attributes, the termination
+    reports has 'end' attribute. (The compiler wrappers write both into a
+    single report.) Reports about process which start was not captured
+    (like the build command itself) are ignored.
+
+    :param records:     iterable of execution reports,
+    :return: list of Process objects, in the order of their start. """
+
+    def timestamp(record):
+        return record['start'] if 'start' in record else record['end']
+
+    result = []
+    running = dict()
+    valid = (record for record in records
+             if 'pid' in record and ('start' in record or 'end' in record))
+    for record in sorted(valid, key=timestamp):
+        pid = record['pid']
+        current = running.get(pid)
+        if 'start' in record:
+            if current is None:
+                current = Process(pid, record.get('ppid'), record['start'])
+                running[pid] = current
+                result.append(current)
+            current.calls.append(
+                Execution(pid=pid, cwd=record['cwd'], cmd=record['cmd']))
+        if 'end' in record and current is not None:
+            current.end = record['end']
+            del running[pid]
+    return result
+
+
+def link_processes(instances):
+    """ Links the process instances to their parent.
+
+    The parent is the process instance with the parent process id, which was
+    running when the child process was started.
+
+    :param instances:   list of Process objects in the order of their start,
+    :return: list of Process objects which have no parent. """
+
+    by_pid = dict()
+    roots = []
+    for process in instances:
+        candidates = by_pid.get(process.ppid, [])
+        parent = next((candidate for candidate in reversed(candidates)
+                       if candidate.is_alive(process.start)), None)
+        if parent is None:
+            roots.append(process)
+        else:
+            parent.children.append(process)
+        by_pid.setdefault(process.pid, []).append(process)
+    return roots
+
+
+def compilation_times(instances, cc, cxx):
+    """ Collects the duration of the compilations.
+
+    :param instances:   list of Process objects,
+    :param cc:          user specified C compiler name,
+    :param cxx:         user specified C++ compiler name,
+    :return: list of compilations, the slowest is the first. """
+
+    result = []
+    for process in instances:
+        if process.end is None:
+            continue
+        for call in process.calls:
+            for compilation in Compilation.from_call(call, cc, cxx):
+                if compilation.compiler not in {'c', 'c++'}:
+                    continue
+                result.append({
+                    'directory': compilation.directory,
+                    'file': os.path.relpath(compilation.source,
+                                            compilation.directory),
+                    'duration': process.duration() / NANOSECONDS
+                })
+    result.sort(key=lambda entry: entry['duration'], reverse=True)
+    return result
+
+
+def critical_path(roots):
+    """ Finds the chain of processes which the build was waiting for.
+
+    It starts from the latest finished root process. Before a process is
+    taken, the latest sibling process which finished before it was started
+    (its predecessor) is taken. After a process is taken, its latest
+    finished child process is taken the same way. So the path goes through
+    the nested and through the sequential processes too.
+
+    :param roots:       list of Process objects without parent,
+    :return: list of Process objects (in the order of their start). """
+
+    def latest(candidates, limit):
+        finished = [process for process in candidates
+                    if process.end is not None and
+                    (limit is None or
+                     (process.end <= limit and process.start < limit))]
+        return max(finished, key=lambda process: process.end) \
+            if finished else None
+
+    result = []
+    # the work list (in reversed order) has processes to take, and sibling
+    # processes with a time limit to find the latest one from
+    pending = [(roots, None)]
+    while pending:
+        item = pending.pop()
+        if isinstance(item, Process):
+            result.append(item)
+            continue
+        candidates, limit = item
+        current = latest(candidates, limit)
+        if current is not None:
+            pending.append((current.children, current.end))
+            pending.append(current)
+            pending.append((candidates, current.start))
+    return result
@@ -16,10 +16,10 @@ import shutil
 import itertools
 import plistlib
 import glob
-import json
 import logging
 import datetime
 from libscanbuild.clang import get_version
+from libscanbuild.compilation import CompilationDatabase
 
 __all__ = ['document']
 
@@ -38,10 +38,12 @@ def document(args):
 
     if html_reports_available and result:
         use_cdb = os.path.exists(args.cdb)
+        databases = CompilationDatabase.files(args.cdb, args.shards) \
+            if use_cdb else []
 
         logging.debug('generate index.html file')
         # common prefix for source files to have sorter path
-        prefix = commonprefix_from(args.cdb) if use_cdb else os.getcwd()
+        prefix = commonprefix_from(databases) if use_cdb else os.getcwd()
         # assemble the cover from multiple fragments
         fragments = []
         try:
@@ -53,8 +55,8 @@ def document(args):
             assemble_cover(args, prefix, fragments)
             # copy additional files to the report
             copy_resource_files(args.output)
-            if use_cdb:
-                shutil.copy(args.cdb, args.output)
+            for database in databases:
+                shutil.copy(database, args.output)
         finally:
             for fragment in fragments:
                 os.remove(fragment)
@@ -503,11 +505,13 @@ def comment(name, opts=dict()):
     return '<!-- {0}{1} -->{2}'.format(name, attributes, os.linesep)
 
 
-def commonprefix_from(filename):
-    """ Create file prefix from a compilation database entries. """
+def commonprefix_from(filenames):
+    """ Create file prefix from a compilation database entries.
 
-    with open(filename, 'r') as handle:
-        return commonprefix(item['file'] for item in json.load(handle))
+    :param filenames: list of compilation database file names """
+
+    return commonprefix(item['file'] for filename in filenames
+                        for item in CompilationDatabase.iter_entries(filename))
 
 
 def commonprefix(files):
@@ -1,7 +1,40 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from setuptools import setup
+import os
+from setuptools import setup, Command
+
+
+class PrebuildLibear(Command):
+    """ Builds the interception library into the cache directory.
+
+    Run it at install time to save the library build on the first
+    'intercept-build' or 'scan-build' run. """
+
+    description = 'prebuild the interception library into its cache'
+    user_options = [
+        ('compiler=', 'c', 'compiler to build the library with'),
+        ('cache-dir=', 'd', 'cache directory (default: per user cache)'),
+    ]
+
+    def initialize_options(self):
+        self.compiler = None
+        self.cache_dir = None
+
+    def finalize_options(self):
+        if self.compiler is None:
+            self.compiler = os.getenv('CC', 'cc')
+
+    def run(self):
+        import libear
+        cache_dir = self.cache_dir or libear.cache_directory()
+        if not cache_dir:
+            raise SystemExit('interception library cache is disabled')
+        library = libear.build_cached_libear(self.compiler, cache_dir)
+        if not library:
+            raise SystemExit('could not build the interception library')
+        self.announce('interception library: ' + library, level=2)
+
 
 setup(
     name='scan-build',
@@ -14,6 +47,7 @@ setup(
     description='static code analyzer wrapper for Clang.',
     long_description=open('README.rst').read(),
     zip_safe=False,
+    cmdclass={'prebuild_libear': PrebuildLibear},
     packages=['libscanbuild', 'libear'],
     package_data={'libscanbuild': ['resources/*'],
                   'libear': ['config.h.in', 'ear.c']},
@@ -44,30 +44,7 @@ true;
 EOF
 chmod +x ${build_file}
 
+# the failed compilations are not recorded
 cat >> "${root_dir}/expected.json" << EOF
-[
-{
-  "command": "cc -c -o src/broken.o -Dver=1 src/broken.c",
-  "directory": "${root_dir}",
-  "file": "src/broken.c"
-}
-,
-{
-  "command": "c++ -c -o src/broken.o -Dver=2 src/broken.c",
-  "directory": "${root_dir}",
-  "file": "src/broken.c"
-}
-,
-{
-  "command": "cc -c -o broken.o -Dver=3 broken.c",
-  "directory": "${root_dir}/src",
-  "file": "broken.c"
-}
-,
-{
-  "command": "c++ -c -o broken.o -Dver=4 broken.c",
-  "directory": "${root_dir}/src",
-  "file": "broken.c"
-}
-]
+[]
 EOF
@@ -8,6 +8,19 @@
 #
 # RUN: cd %T/successful_build; %{intercept-build} --cdb preload.json ./run.sh
 # RUN: cd %T/successful_build; cdb_diff preload.json expected.json
+#
+# the execution records can be appended to a single trace log or sent to
+# the collector socket as well
+#
+# RUN: cd %T/successful_build; %{intercept-build} --cdb log.json --trace-mode log ./run.sh
+# RUN: cd %T/successful_build; cdb_diff log.json expected.json
+# RUN: cd %T/successful_build; %{intercept-build} --cdb socket.json --trace-mode socket ./run.sh
+# RUN: cd %T/successful_build; cdb_diff socket.json expected.json
+#
+# the build profile does not change the compilation database
+#
+# RUN: cd %T/successful_build; %{intercept-build} --cdb profile.json --build-profile profile.out.json ./run.sh
+# RUN: cd %T/successful_build; cdb_diff profile.json expected.json
 
 set -o errexit
 set -o nounset
@@ -223,6 +223,21 @@ class AnalyzerTest(unittest.TestCase):
         self.assertEqual(['-DNDEBUG', '-UNDEBUG'], test(['-DNDEBUG']))
         self.assertEqual(['-DSomething', '-UNDEBUG'], test(['-DSomething']))
 
+    def test_exclude(self):
+        with libear.temporary_directory() as tmp_dir:
+            excluded = os.path.join(tmp_dir, 'excluded')
+            os.mkdir(excluded)
+            os.symlink(excluded, os.path.join(tmp_dir, 'link'))
+
+            def test(source):
+                spy = Spy()
+                opts = {'source': source, 'excludes': [excluded]}
+                return sut.exclude(opts, spy.call)
+
+            self.assertIsNone(test(os.path.join(excluded, 'test.c')))
+            self.assertIsNone(test(os.path.join(tmp_dir, 'link', 'test.c')))
+            self.assertEqual(0, test(os.path.join(tmp_dir, 't.c')))
+
     def test_set_language_fall_through(self):
         def language(expected, input):
             spy = Spy()
@@ -6,7 +6,12 @@
 #
 # RUN: %{python} %s
 
+import libear
 import libscanbuild.compilation as sut
+import io
+import json
+import os.path
+import re
 import unittest
 
 
@@ -75,6 +80,28 @@ class CompilerTest(unittest.TestCase):
         self.assert_c_compiler(['ccache', 'cc'])
         self.assert_cxx_compiler(['ccache', 'c++'])
 
+    def test_executable_kind_matches_patterns(self):
+        def expected(executable):
+            families = [('c', sut.COMPILER_PATTERNS_CC),
+                        ('c++', sut.COMPILER_PATTERNS_CXX),
+                        ('ar', sut.AR_PATTERNS)]
+            if sut.COMPILER_PATTERN_WRAPPER.match(executable):
+                return 'wrapper'
+            for kind, patterns in families:
+                if any(pattern.match(executable) for pattern in patterns):
+                    return kind
+            return None
+
+        for executable in ['cc', 'mpicc', 'gcc-4.9', 'clang-3.6', 'gxlc',
+                           'c++', 'CC', 'g++', 'clang++-3.5.1', 'mpiCC',
+                           'xlc++', 'ar', 'arm-none-eabi-ar', 'ccache', '',
+                           'sh', 'ld', 'gcc-ar-x', 'ccc', 'gcc-4.9.1.2']:
+            self.assertEqual(expected(executable),
+                             sut.executable_kind(executable))
+            # the second call is answered from the memo
+            self.assertEqual(expected(executable),
+                             sut.executable_kind(executable))
+
     def test_non_compiler_call(self):
         self.assert_not_compiler([])
         self.assert_not_compiler([''])
@@ -176,6 +203,387 @@ class SplitTest(unittest.TestCase):
         filtered(['-MMD', '-MF', 'something'])
 
 
+class ExecFilterTest(unittest.TestCase):
+
+    def assert_same_as_split(self, executable, cc='nope', cxx='nope++'):
+        pattern = re.compile(sut.exec_filter(cc, cxx))
+        expected = sut.Compilation._split_compiler([executable], cc, cxx)
+        self.assertEqual(expected is not None,
+                         pattern.search(executable) is not None)
+
+    def test_compilers_are_accepted(self):
+        for executable in ['cc', 'icc', 'mpicc', 'gcc', 'gcc-4.9',
+                           'armv7_neno-linux-gnueabi-gcc', 'clang-3.6',
+                           'xlc', 'gxlc', 'c++', 'CC', 'g++', 'clang++',
+                           'clang++-3.5.1', 'mpic++', 'xlC', 'gxlc++',
+                           'distcc', 'ccache', 'ar', 'arm-none-eabi-ar']:
+            self.assert_same_as_split(executable)
+
+    def test_non_compilers_are_rejected(self):
+        for executable in ['', 'sh', 'make', 'sed', 'python', 'ld', 'as',
+                           'gcc-ar-x', 'clang-tidy', 'ccc', 'cc1', 'cc1plus',
+                           'xcc', 'gcc-4.9.1.2']:
+            self.assert_same_as_split(executable)
+
+    def test_specific_compilers_are_accepted(self):
+        self.assert_same_as_split('my.cc', cc='/opt/bin/my.cc')
+        self.assert_same_as_split('myxcc', cc='/opt/bin/my.cc')
+        self.assert_same_as_split('my++', cxx='my++')
+
+
+class EntryFilterTest(unittest.TestCase):
+
+    compilations = [
+        sut.Compilation('c', [], '/src/main.c', '/src'),
+        sut.Compilation('c++', [], '/src/lib/a.cpp', '/src'),
+        sut.Compilation('c', [], '/src/third_party/z.c', '/src'),
+        sut.Compilation('c', [], '/build/gen/parser.c', '/build'),
+        sut.Compilation('ar', [], '/src/lib/liba.a', '/src')]
+
+    def selected(self, **kwargs):
+        predicate = sut.entry_filter(**kwargs)
+        return [compilation.source for compilation in self.compilations
+                if predicate(compilation)]
+
+    def test_no_rules(self):
+        self.assertIsNone(sut.entry_filter())
+        self.assertIsNone(sut.entry_filter([], [], [], [], []))
+
+    def test_paths(self):
+        self.assertEqual(
+            ['/src/main.c', '/src/lib/a.cpp', '/src/lib/liba.a'],
+            self.selected(include_paths=['/src/*'],
+                          exclude_paths=['/src/third_party/*']))
+        self.assertEqual(
+            ['/src/main.c', '/src/third_party/z.c', '/build/gen/parser.c'],
+            self.selected(include_paths=['*.c']))
+
+    def test_patterns(self):
+        self.assertEqual(
+            ['/src/main.c', '/src/lib/a.cpp', '/src/lib/liba.a'],
+            self.selected(exclude_patterns=['/third_party/', '^/build/']))
+        self.assertEqual(
+            ['/src/lib/a.cpp', '/build/gen/parser.c'],
+            self.selected(include_patterns=[r'\.cpp$'],
+                          include_paths=['/build/*']))
+        self.assertRaises(re.error, sut.entry_filter,
+                          include_patterns=['('])
+
+    def test_kinds(self):
+        self.assertEqual(
+            ['/src/lib/a.cpp'],
+            self.selected(exclude_kinds=['c', 'ar']))
+
+
+class DatabaseTest(unittest.TestCase):
+
+    def test_unique(self):
+        one = sut.Compilation('c', ['-O2'], 'a.c', '/tmp')
+        two = sut.Compilation('c', ['-O3'], 'a.c', '/tmp')
+        three = sut.Compilation('c', ['-O2'], '/tmp/a.c', '/tmp')
+        result = list(sut.unique(iter([one, two, three, two])))
+        self.assertEqual([one, two], result)
+
+    def test_from_db_multiple_sources(self):
+        with libear.temporary_directory() as tmp_dir:
+            for source in ['a.c', 'b.c']:
+                with open(os.path.join(tmp_dir, source), 'w') as handle:
+                    handle.write('')
+            entry = {'directory': tmp_dir, 'file': 'b.c',
+                     'arguments': ['cc', '-c', '-O2', 'a.c', 'b.c']}
+            result = sut.Compilation.from_db(entry)
+            self.assertEqual(os.path.join(tmp_dir, 'b.c'), result.source)
+            self.assertEqual(['-O2'], result.flags)
+            entry = {'directory': tmp_dir, 'file': 'c.c',
+                     'arguments': ['cc', '-c', '-O2', 'c.c']}
+            self.assertIsNone(sut.Compilation.from_db(entry))
+
+    def test_from_db_trusted(self):
+        entry = {'directory': '/src', 'file': 'a.c',
+                 'command': 'ccache g++ -c -O2 -o a.o ./a.c'}
+        result = sut.Compilation.from_db(entry, trusted=True)
+        self.assertEqual('c++', result.compiler)
+        self.assertEqual('/src/a.c', result.source)
+        self.assertEqual(['-c', '-O2', '-o', 'a.o'], result.flags)
+        entry = {'directory': '/src', 'file': 'a.c',
+                 'arguments': ['cc', '-c', 'a.c', '-o', 'a.c.o', '-MF', 'a.c']}
+        result = sut.Compilation.from_db(entry, trusted=True)
+        self.assertEqual(['-c', '-o', 'a.c.o', '-MF', 'a.c'], result.flags)
+        entry = {'directory': '/src', 'file': 'a.c',
+                 'arguments': ['/opt/bin/unknown', '-c', 'a.c']}
+        self.assertIsNone(sut.Compilation.from_db(entry, trusted=True))
+        entry = sut.Compilation('ld', ['main.o', '-o', 'a.out'], 'a.out',
+                                '/src').to_db()
+        self.assertIsNone(sut.Compilation.from_db(entry, trusted=True))
+        entry = {'directory': '/src', 'file': 'a.o',
+                 'arguments': ['ar', 'rcs', 'lib.a', 'a.o']}
+        self.assertIsNone(sut.Compilation.from_db(entry, trusted=True))
+
+    def test_index(self):
+        entries = [sut.Compilation('c', ['-O2'], 'a.c', '/src'),
+                   sut.Compilation('c', ['-O3'], 'a.c', '/src'),
+                   sut.Compilation('c++', [], 'b.cpp', '/src')]
+        with libear.temporary_directory() as tmp_dir:
+            output = os.path.join(tmp_dir, 'compile_commands.json')
+            index = output + sut.DATABASE_INDEX_SUFFIX
+            sut.CompilationDatabase.save(output, iter(entries))
+            expected = sut.CompilationDatabase.load_entries(output)
+
+            def load():
+                return list(sut.CompilationDatabase.iter_entries(output, True))
+
+            self.assertEqual(expected, load())
+            self.assertTrue(os.path.isfile(index))
+            opened = sut.DatabaseIndex.open(output)
+            self.assertIsNotNone(opened)
+            with open(output, 'rb') as handle:
+                self.assertEqual(sut.file_digest(handle),
+                                 opened.header.digest)
+            opened.close()
+            # the index is still valid when the database was only touched
+            os.utime(output, (0, 0))
+            opened = sut.DatabaseIndex.open(output)
+            self.assertIsNotNone(opened)
+            opened.close()
+            self.assertEqual(expected, load())
+            self.assertEqual(expected[:2], sut.CompilationDatabase.lookup(
+                output, '/src/a.c'))
+            self.assertEqual([], sut.CompilationDatabase.lookup(
+                output, '/src/c.c'))
+            # the index is rebuilt when the database changed
+            sut.CompilationDatabase.save(output, iter(entries[1:]))
+            self.assertIsNone(sut.DatabaseIndex.open(output))
+            self.assertEqual(expected[1:], load())
+
+    def test_index_utf8(self):
+        with libear.temporary_directory() as tmp_dir:
+            output = os.path.join(tmp_dir, 'compile_commands.json')
+            entry = {'directory': '/src', 'file': u'\u00e1.c',
+                     'arguments': ['cc', '-c', u'\u00e1.c']}
+            with io.open(output, 'w', encoding='utf-8') as handle:
+                handle.write(json.dumps([entry], ensure_ascii=False))
+            # the database is read as UTF-8 regardless of the locale
+            loaded = list(sut.CompilationDatabase.iter_entries(output, True))
+            self.assertEqual([entry], loaded)
+            opened = sut.DatabaseIndex.open(output)
+            self.assertIsNotNone(opened)
+            opened.close()
+            self.assertEqual([entry], list(
+                sut.CompilationDatabase.iter_entries(output, True)))
+
+    def test_shards(self):
+        entries = [sut.Compilation('c', [], 'a/x.c', '/src'),
+                   sut.Compilation('c', [], 'b/y.c', '/src'),
+                   sut.Compilation('c', ['-O2'], 'a/z.c', '/src')]
+        with libear.temporary_directory() as tmp_dir:
+            manifest = os.path.join(tmp_dir, 'compile_commands.json')
+            sut.CompilationDatabase.save_shards(
+                manifest, iter(entries),
+                lambda entry: os.path.relpath(entry.source, '/src')[0])
+
+            shard_a = os.path.join(tmp_dir, 'compile_commands.a.json')
+            shard_b = os.path.join(tmp_dir, 'compile_commands.b.json')
+            self.assertEqual([shard_a, shard_b],
+                             sut.CompilationDatabase.files(manifest))
+            self.assertEqual([shard_b],
+                             sut.CompilationDatabase.files(manifest, ['b']))
+            self.assertRaises(ValueError, sut.CompilationDatabase.files,
+                              manifest, ['c'])
+            self.assertEqual([entries[0].to_db(), entries[2].to_db()],
+                             sut.CompilationDatabase.load_entries(shard_a))
+            self.assertEqual([shard_a],
+                             sut.CompilationDatabase.files(shard_a))
+            self.assertRaises(ValueError, sut.CompilationDatabase.files,
+                              shard_a, ['a'])
+
+    def test_entry_key(self):
+        self.assertEqual(
+            ('/src', '/src/a.c', '/src/obj/a.o'),
+            sut.entry_key({'directory': '/src/', 'file': 'a.c',
+                           'arguments': ['cc', '-c', '-o', 'obj/a.o', 'a.c']}))
+        self.assertEqual(
+            ('/src', '/src/a.c', None),
+            sut.entry_key({'directory': '/src', 'file': '/src/a.c',
+                           'command': 'cc -c a.c'}))
+        self.assertEqual(
+            ('/src', '/src/a.c', '/out/a.o'),
+            sut.entry_key({'directory': '/src', 'file': 'a.c',
+                           'command': 'cc -c a.c', 'output': '/out/a.o'}))
+
+    def test_merge(self):
+        def entry(source, flag, output=None):
+            return {'directory': '/src', 'file': source,
+                    'arguments': ['cc', '-c', flag, source] +
+                    (['-o', output] if output else [])}
+
+        previous = [entry('a.c', '-O1'), entry('b.c', '-O1', 'b.o'),
+                    entry('c.c', '-O1'), entry('a.c', '-O0')]
+        self.assertEqual(previous, sut.merge(previous, []))
+        self.assertEqual(previous, sut.merge(previous, previous[1:3]))
+        self.assertEqual(previous, sut.merge(previous, reversed(previous)))
+        self.assertEqual(
+            [entry('a.c', '-O2'), entry('b.c', '-O1', 'b.o'),
+             entry('c.c', '-O1'), entry('b.c', '-O2'), entry('d.c', '-O2')],
+            sut.merge(previous, [entry('a.c', '-O2'), entry('b.c', '-O2'),
+                                 entry('d.c', '-O2')]))
+
+    def test_canonical_flags(self):
+        with libear.temporary_directory() as tmp_dir:
+            real = os.path.realpath(tmp_dir)
+            flags = ['-O2', '-I', 'inc', '-Iinc/../src', '-isystem', '/usr',
+                     '-iquote.', '-include', 'config.h', '-DX=inc']
+            self.assertEqual(
+                ['-O2', '-I', os.path.join(real, 'inc'),
+                 '-I' + os.path.join(real, 'src'), '-isystem', '/usr',
+                 '-iquote' + real, '-include', os.path.join(real, 'config.h'),
+                 '-DX=inc'],
+                sut.canonical_flags(flags, tmp_dir))
+
+    def test_canonicalize(self):
+        with libear.temporary_directory() as tmp_dir:
+            real = os.path.realpath(tmp_dir)
+            os.mkdir(os.path.join(tmp_dir, 'src'))
+            os.symlink(os.path.join(tmp_dir, 'src'),
+                       os.path.join(tmp_dir, 'link'))
+            link = os.path.join(tmp_dir, 'link')
+            src = os.path.join(tmp_dir, 'src')
+            compilations = [
+                sut.Compilation('c', ['-I', 'inc'], 'a.c', src),
+                sut.Compilation('c', ['-I', 'inc'], 'a.c', link),
+                sut.Compilation('c', ['-I', os.path.join(src, 'inc')],
+                                os.path.join(link, 'a.c'), link + '/'),
+                sut.Compilation('c', ['-I', 'inc'], 'b.c', link)]
+            result = list(sut.canonicalize(iter(compilations)))
+            self.assertEqual(2, len(result))
+            self.assertEqual(os.path.join(real, 'src', 'a.c'),
+                             result[0].source)
+            self.assertEqual(os.path.join(real, 'src'), result[0].directory)
+            self.assertEqual(['-I', os.path.join(real, 'src', 'inc')],
+                             result[0].flags)
+            self.assertEqual(os.path.join(real, 'src', 'b.c'),
+                             result[1].source)
+
+    def test_diff(self):
+        def entry(source, flag, output=None):
+            return {'directory': '/src', 'file': source,
+                    'arguments': ['cc', '-c', flag, source] +
+                    (['-o', output] if output else [])}
+
+        previous = [entry('a.c', '-O1'), entry('b.c', '-O1', 'b.o'),
+                    entry('c.c', '-O1')]
+        self.assertEqual({'added': [], 'removed': [], 'changed': []},
+                         sut.diff(previous, reversed(previous)))
+        # the command form equals to the arguments form
+        same = {'directory': '/src/', 'file': './a.c',
+                'command': 'cc -c -O1 a.c'}
+        self.assertEqual({'added': [], 'removed': [], 'changed': []},
+                         sut.diff(previous, [same] + previous[1:]))
+        current = [entry('a.c', '-O2'), entry('b.c', '-O1', 'b.o'),
+                   entry('d.c', '-O1')]
+        self.assertEqual({
+            'added': [{'directory': '/src', 'file': '/src/d.c'}],
+            'removed': [{'directory': '/src', 'file': '/src/c.c'}],
+            'changed': [{'directory': '/src', 'file': '/src/a.c'}]
+        }, sut.diff(previous, current))
+        self.assertEqual({
+            'added': [],
+            'removed': [{'directory': '/src', 'file': '/src/b.c',
+                         'output': '/src/b.o'}],
+            'changed': []
+        }, sut.diff(previous, previous[::2]))
+
+    def test_diff_files(self):
+        entries = [sut.Compilation('c', ['-O2'], 'a.c', '/tmp'),
+                   sut.Compilation('c', ['-O2'], 'b.c', '/tmp')]
+        with libear.temporary_directory() as tmp_dir:
+            old = os.path.join(tmp_dir, 'old.json')
+            new = os.path.join(tmp_dir, 'new.json')
+            sut.CompilationDatabase.save(old, iter(entries))
+            sut.CompilationDatabase.save(new, iter(entries[1:]))
+            self.assertEqual({
+                'added': [],
+                'removed': [{'directory': '/tmp', 'file': '/tmp/a.c'}],
+                'changed': []
+            }, sut.CompilationDatabase.diff(old, new))
+
+    def test_save_through_symlink(self):
+        entries = [sut.Compilation('c', ['-O2'], 'a.c', '/tmp')]
+        with libear.temporary_directory() as tmp_dir:
+            os.mkdir(os.path.join(tmp_dir, 'build'))
+            target = os.path.join(tmp_dir, 'build', 'compile_commands.json')
+            link = os.path.join(tmp_dir, 'compile_commands.json')
+            os.symlink(os.path.join('build', 'compile_commands.json'), link)
+            for _ in range(2):
+                sut.CompilationDatabase.save(link, iter(entries))
+                self.assertTrue(os.path.islink(link))
+                self.assertEqual([entries[0].to_db()],
+                                 sut.CompilationDatabase.load_entries(target))
+
+    def test_save_is_json_array(self):
+        entries = [sut.Compilation('c', ['-DNAME="value"'], 'a.c', '/tmp'),
+                   sut.Compilation('c++', [], 'b.cpp', '/tmp')]
+        with libear.temporary_directory() as tmp_dir:
+            output = os.path.join(tmp_dir, 'compile_commands.json')
+            for count in range(len(entries) + 1):
+                current = entries[:count]
+                sut.CompilationDatabase.save(output, iter(current))
+                with open(output, 'r') as handle:
+                    content = handle.read()
+                expected = [entry.to_db() for entry in current]
+                self.assertEqual(
+                    json.dumps(expected, sort_keys=True, indent=4), content)
+
+    def test_save_compact_and_ordered(self):
+        entries = [sut.Compilation('c++', [], 'b.cpp', '/tmp'),
+                   sut.Compilation('c', ['-O2'], 'a.c', '/tmp'),
+                   sut.Compilation('c', ['-O1'], 'a.c', '/tmp')]
+        with libear.temporary_directory() as tmp_dir:
+            output = os.path.join(tmp_dir, 'compile_commands.json')
+
+            def save(current):
+                sut.CompilationDatabase.save(output, iter(current),
+                                             compact=True, ordered=True)
+                with open(output, 'r') as handle:
+                    return handle.read()
+
+            content = save(entries)
+            self.assertEqual(content, save(reversed(entries)))
+            self.assertEqual(len(entries) + 2, len(content.splitlines()))
+            self.assertEqual(
+                [entries[2].to_db(), entries[1].to_db(), entries[0].to_db()],
+                json.loads(content))
+            self.assertEqual([], json.loads(save([])))
+
+
+class JsonArrayItemsTest(unittest.TestCase):
+
+    def assert_items(self, content):
+        expected = json.loads(content)
+        for size in [1, 2, 3, 7, 4096]:
+            result = sut.json_array_items(io.StringIO(content), size)
+            self.assertEqual(expected, list(result))
+
+    def assert_invalid(self, content):
+        for size in [1, 3, 4096]:
+            result = sut.json_array_items(io.StringIO(content), size)
+            self.assertRaises(ValueError, list, result)
+
+    def test_valid_arrays(self):
+        self.assert_items(u'[]')
+        self.assert_items(u' \n[ ]\n')
+        self.assert_items(u'[1, 22 ,333]')
+        self.assert_items(u'[{"a": [1, {"b": "],"}]}, "x", null, 1.5]')
+        self.assert_items(u'[\n    {\n        "file": "a\\"].c"\n    }\n]\n')
+
+    def test_invalid_arrays(self):
+        self.assert_invalid(u'')
+        self.assert_invalid(u'{}')
+        self.assert_invalid(u'[1 2]')
+        self.assert_invalid(u'[1,')
+        self.assert_invalid(u'[1,]')
+        self.assert_invalid(u'[{"a":')
+
+
 class SourceClassifierTest(unittest.TestCase):
 
     def assert_non_source(self, filename):
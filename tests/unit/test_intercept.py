@@ -6,17 +6,33 @@
 #
 # RUN: %{python} %s
 
+import argparse
+import json
 import os
 import os.path
+import struct
 import unittest
 
 import libear
 import libscanbuild.intercept as sut
-from libscanbuild import Execution
+from libscanbuild import Execution, DIRECTORY_LISTINGS
+from libscanbuild.compilation import Compilation, CompilationDatabase
 
 IS_WINDOWS = os.getenv('windows')
 
 
+def exec_trace_records(directory):
+    # the reports are read the same way as `captured_compilations` does
+    return [record
+            for chunk in sut.exec_trace_chunks(directory, 2)
+            for record in sut.chunk_records(chunk)]
+
+
+def exec_traces(directory):
+    return [sut.to_execution(record)
+            for record in exec_trace_records(directory) if 'cmd' in record]
+
+
 class InterceptUtilTest(unittest.TestCase):
 
     def test_read_write_exec_trace(self):
@@ -25,10 +41,356 @@ class InterceptUtilTest(unittest.TestCase):
             cwd='/path/to/here',
             cmd=['cc', '-c', 'this.c'])
         with libear.temporary_directory() as tmp_dir:
-            temp_file = os.path.join(tmp_dir, 'single_report.cmd')
+            temp_file = os.path.join(tmp_dir, 'single_report.json')
             sut.write_exec_trace(temp_file, input_one)
-            result = sut.parse_exec_trace(temp_file)
-            self.assertEqual(input_one, result)
+            self.assertEqual([input_one], exec_traces(tmp_dir))
+
+    def test_read_write_exec_trace_log(self):
+        input_one = Execution(
+            pid=123,
+            cwd='/path/to/here',
+            cmd=['cc', '-c', 'this.c'])
+        input_two = Execution(
+            pid=456,
+            cwd='/path/to/there',
+            cmd=['c++', '-c', 'that.cpp'])
+        with libear.temporary_directory() as tmp_dir:
+            temp_file = os.path.join(tmp_dir, sut.TRACE_LOG_FILE)
+            sut.append_exec_trace(temp_file, input_one)
+            sut.append_exec_trace(temp_file, input_two)
+            self.assertEqual([input_one, input_two], exec_traces(tmp_dir))
+
+    def test_exec_traces_reads_files_and_log(self):
+        input_one = Execution(
+            pid=123,
+            cwd='/path/to/here',
+            cmd=['cc', '-c', 'this.c'])
+        input_two = Execution(
+            pid=456,
+            cwd='/path/to/there',
+            cmd=['c++', '-c', 'that.cpp'])
+        with libear.temporary_directory() as tmp_dir:
+            sut.write_exec_trace(os.path.join(tmp_dir, 'one.json'), input_one)
+            sut.append_exec_trace(os.path.join(tmp_dir, sut.TRACE_LOG_FILE),
+                                  input_two)
+            self.assertEqual([input_one, input_two], exec_traces(tmp_dir))
+
+    @unittest.skipIf(IS_WINDOWS, 'this code is not running on windows')
+    def test_exec_trace_collector(self):
+        with libear.temporary_directory() as tmp_dir:
+            source = os.path.join(tmp_dir, 'this.c')
+            open(source, 'w').close()
+            execution = Execution(
+                pid=123,
+                cwd=tmp_dir,
+                cmd=['cc', '-c', 'this.c'])
+            socket_file = os.path.join(tmp_dir, sut.TRACE_SOCKET_FILE)
+            with sut.exec_trace_collector(socket_file, tmp_dir, 'cc', 'c++',
+                                          True):
+                self.assertTrue(sut.send_exec_trace(socket_file, execution))
+            self.assertEqual([execution], exec_traces(tmp_dir))
+
+    @unittest.skipIf(IS_WINDOWS, 'this code is not running on windows')
+    def test_exec_trace_collector_classifies(self):
+        with libear.temporary_directory() as tmp_dir:
+            for name in ['a.c', 'b.c']:
+                open(os.path.join(tmp_dir, name), 'w').close()
+            socket_file = os.path.join(tmp_dir, sut.TRACE_SOCKET_FILE)
+            entries_file = os.path.join(tmp_dir,
+                                        sut.TRACE_SOCKET_ENTRIES_FILE)
+            with sut.exec_trace_collector(socket_file, tmp_dir, 'cc', 'c++',
+                                          False):
+                for pid, source in [(10, 'a.c'), (11, 'b.c'), (12, 'a.c')]:
+                    execution = Execution(pid=pid, cwd=tmp_dir,
+                                          cmd=['cc', '-c', source])
+                    self.assertTrue(sut.send_exec_trace(
+                        socket_file, execution, {'ppid': 1, 'start': pid}))
+                self.assertTrue(sut.send_exec_trace(
+                    socket_file,
+                    Execution(pid=13, cwd=tmp_dir, cmd=['ls']),
+                    {'ppid': 1, 'start': 13}))
+                # the source files are checked after the build
+                for pid, source in [(14, 'c.c'), (15, 'd.c')]:
+                    self.assertTrue(sut.send_exec_trace(
+                        socket_file,
+                        Execution(pid=pid, cwd=tmp_dir,
+                                  cmd=['cc', '-c', source]),
+                        {'ppid': 1, 'start': pid}))
+                open(os.path.join(tmp_dir, 'c.c'), 'w').close()
+            self.assertFalse(os.path.exists(
+                os.path.join(tmp_dir, sut.TRACE_SOCKET_LOG_FILE)))
+            # the unique compilations and the repeated execution
+            self.assertEqual(
+                5, len([item for item in sut.read_exec_trace_log(entries_file)
+                        if 'fingerprint' in item]))
+
+            def status(pid, value):
+                return {'pid': pid, 'ppid': 1, 'end': pid + 0.5,
+                        'status': value}
+
+            for terminations, expected in [
+                    ([], ['a.c', 'b.c', 'c.c']),
+                    ([status(10, 1), status(11, 1)], ['a.c', 'c.c']),
+                    ([status(10, 1), status(12, 1)], ['b.c', 'c.c'])]:
+                failures = sut.exec_failures(terminations)
+                compilations, compilers = sut.collected_compilations(
+                    entries_file, failures, set())
+                self.assertEqual({('cc', 'c')}, compilers)
+                self.assertEqual(
+                    [os.path.join(tmp_dir, name) for name in expected],
+                    sorted(entry.source for entry in compilations))
+
+    def test_exec_trace_collector_disabled(self):
+        with libear.temporary_directory() as tmp_dir:
+            with sut.exec_trace_collector(None, tmp_dir, 'cc', 'c++', False):
+                pass
+            self.assertEqual([], os.listdir(tmp_dir))
+
+    def test_exec_traces_skips_exit_reports(self):
+        input_one = Execution(
+            pid=123,
+            cwd='/path/to/here',
+            cmd=['cc', '-c', 'this.c'])
+        with libear.temporary_directory() as tmp_dir:
+            temp_file = os.path.join(tmp_dir, sut.TRACE_LOG_FILE)
+            sut.append_exec_trace(temp_file, input_one, {'start': 1})
+            with open(temp_file, 'a') as handle:
+                handle.write('{ "pid": 123, "ppid": 1, "end": 2 }\n')
+            records = exec_trace_records(tmp_dir)
+            self.assertEqual(2, len(records))
+            self.assertEqual(1, records[0]['start'])
+            self.assertEqual([input_one], exec_traces(tmp_dir))
+
+    def test_process_exec_traces(self):
+        with libear.temporary_directory() as tmp_dir:
+            for name in ['a.c', 'b.c', 'c.c', 'd.c']:
+                open(os.path.join(tmp_dir, name), 'w').close()
+            sut.write_exec_trace(
+                os.path.join(tmp_dir, 'one.json'),
+                Execution(pid=1, cwd=tmp_dir, cmd=['cc', '-c', 'a.c']))
+            sut.write_exec_trace(
+                os.path.join(tmp_dir, 'two.json'),
+                Execution(pid=2, cwd=tmp_dir, cmd=['cc', '-c', 'b.c']))
+            trace_log = os.path.join(tmp_dir, sut.TRACE_LOG_FILE)
+            sut.append_exec_trace(
+                trace_log,
+                Execution(pid=3, cwd=tmp_dir, cmd=['cc', '-c', 'a.c']))
+            sut.append_exec_trace(
+                trace_log,
+                Execution(pid=4, cwd=tmp_dir, cmd=['cc', '-c', 'c.c']),
+                {'status': 1})
+            sut.append_exec_trace(
+                trace_log,
+                Execution(pid=5, cwd=tmp_dir, cmd=['cc', '-c', 'd.c']),
+                {'ppid': 1, 'start': 1})
+            with open(os.path.join(tmp_dir, sut.TRACE_STATUS_FILE), 'w') as \
+                    handle:
+                handle.write('{"pid": 5, "ppid": 1, "end": 2, "status": 1}\n')
+
+            # the failed compilation is not reported, the duplicates are
+            # removed only in the same chunk
+            expected = set(os.path.join(tmp_dir, name)
+                           for name in ['a.c', 'b.c'])
+            for jobs in [1, 2]:
+                failures = sut.exec_failures(sut.read_exec_trace_log(
+                    os.path.join(tmp_dir, sut.TRACE_STATUS_FILE)))
+                tasks = ((chunk, 'cc', 'c++', False)
+                         for chunk in sut.exec_trace_chunks(tmp_dir, 1))
+                entries = []
+                for current, records, compilers in sut.process_exec_traces(
+                        sut.process_exec_trace_chunk, tasks, jobs,
+                        sut.set_exec_failures, (failures, set())):
+                    entries.extend(current)
+                    self.assertEqual([], records)
+                    self.assertTrue(compilers <= {('cc', 'c')})
+                self.assertEqual(3, len(entries))
+                self.assertEqual(expected,
+                                 set(entry.source for entry in entries))
+
+    def test_classify_exec_traces_compilers(self):
+        with libear.temporary_directory() as tmp_dir:
+            open(os.path.join(tmp_dir, 'a.c'), 'w').close()
+            records = [
+                {'pid': 1, 'cwd': tmp_dir, 'cmd': ['ccache', 'gcc', '-c',
+                                                   'a.c']},
+                {'pid': 2, 'cwd': tmp_dir, 'cmd': ['distcc', '-c', 'a.c']},
+                {'pid': 3, 'cwd': tmp_dir, 'cmd': ['ccache', './bin/g++',
+                                                   '-c', 'a.c']}]
+            entries, _, compilers = sut.classify_exec_traces(
+                records, 'cc', 'c++', dict(), False)
+            self.assertEqual(2, len(entries))
+            self.assertEqual(
+                {('gcc', 'c'),
+                 (os.path.join(tmp_dir, 'bin', 'g++'), 'c++')},
+                compilers)
+
+    @unittest.skipIf(IS_WINDOWS, 'this code is not running on windows')
+    def test_probe_compiler_config_cached(self):
+        with libear.temporary_directory() as tmp_dir:
+            compiler = os.path.join(tmp_dir, 'fake-cc')
+            counter = os.path.join(tmp_dir, 'counter')
+            with open(compiler, 'w') as handle:
+                handle.write('#!/usr/bin/env sh\n'
+                             'echo run >> {0}\n'
+                             'echo "#define __fake__ 1"\n'.format(counter))
+            os.chmod(compiler, 0o755)
+            cache_dir = os.path.join(tmp_dir, 'cache')
+            for _ in range(2):
+                result = sut.probe_compiler_config(compiler, 'c', cache_dir,
+                                                   tmp_dir)
+                self.assertEqual([{'name': '__fake__', 'value': '1'}],
+                                 result['defines'])
+            with open(counter, 'r') as handle:
+                self.assertEqual(1, len(handle.readlines()))
+
+    @unittest.skipIf(IS_WINDOWS, 'this code is not running on windows')
+    def test_captured_compilations_closed(self):
+        with libear.temporary_directory() as tmp_dir:
+            compiler = os.path.join(tmp_dir, 'fake-cc')
+            with open(compiler, 'w') as handle:
+                handle.write('#!/usr/bin/env sh\n'
+                             'echo "#define __fake__ 1"\n')
+            os.chmod(compiler, 0o755)
+            trace_dir = os.path.join(tmp_dir, 'trace')
+            os.mkdir(trace_dir)
+            for pid, name in [(10, 'a.c'), (11, 'b.c')]:
+                open(os.path.join(tmp_dir, name), 'w').close()
+                sut.append_exec_trace(
+                    os.path.join(trace_dir, sut.TRACE_LOG_FILE),
+                    Execution(pid=pid, cwd=tmp_dir,
+                              cmd=[compiler, '-c', name]),
+                    {'ppid': 1, 'start': pid})
+            profile = os.path.join(tmp_dir, 'profile.json')
+            args = argparse.Namespace(cc=compiler, cxx=compiler,
+                                      build_profile=profile, trace_jobs=1,
+                                      override_compiler=False)
+            current = os.getcwd()
+            cache = os.environ.get(sut.COMPILER_CACHE_DIR_KEY)
+            os.environ[sut.COMPILER_CACHE_DIR_KEY] = ''
+            os.chdir(tmp_dir)
+            try:
+                # the consumer stops after the first compilation
+                compilations = sut.captured_compilations(args, trace_dir)
+                self.assertIsNotNone(next(compilations))
+                compilations.close()
+            finally:
+                os.chdir(current)
+                if cache is None:
+                    del os.environ[sut.COMPILER_CACHE_DIR_KEY]
+                else:
+                    os.environ[sut.COMPILER_CACHE_DIR_KEY] = cache
+            self.assertTrue(os.path.isfile(
+                os.path.join(tmp_dir, sut.COMPILER_CONFIG_FILE)))
+            with open(profile, 'r') as handle:
+                self.assertEqual(2, json.load(handle)['processes'])
+            # the file system caches are valid only during the pass
+            self.assertEqual({}, DIRECTORY_LISTINGS)
+
+    def test_create_exec_index(self):
+        with libear.temporary_directory() as tmp_dir:
+            index = os.path.join(tmp_dir, sut.TRACE_INDEX_FILE)
+            sut.create_exec_index(index, 16)
+            self.assertEqual(128, os.path.getsize(index))
+            with open(index, 'rb') as handle:
+                self.assertFalse(any(bytearray(handle.read())))
+
+    def test_failed_executions(self):
+        records = [
+            {'pid': 10, 'ppid': 1, 'start': 1, 'cwd': '/', 'cmd': ['sh']},
+            {'pid': 10, 'ppid': 1, 'start': 2, 'cwd': '/', 'cmd': ['cc']},
+            {'pid': 10, 'ppid': 1, 'end': 3, 'status': 1},
+            {'pid': 10, 'ppid': 1, 'start': 4, 'cwd': '/', 'cmd': ['cc']},
+            {'pid': 10, 'ppid': 2, 'start': 1, 'cwd': '/', 'cmd': ['cc']},
+            {'pid': 11, 'ppid': 1, 'start': 1, 'cwd': '/', 'cmd': ['cc']},
+            {'pid': 12, 'ppid': 1, 'cwd': '/', 'cmd': ['cc'], 'status': 2},
+            # the process id is reused by the same parent
+            {'pid': 13, 'ppid': 1, 'start': 1, 'cwd': '/', 'cmd': ['cc']},
+            {'pid': 13, 'ppid': 1, 'end': 2, 'status': 0},
+            {'pid': 13, 'ppid': 1, 'start': 5, 'cwd': '/', 'cmd': ['cc']},
+            {'pid': 13, 'ppid': 1, 'end': 6, 'status': 1},
+            {'pid': 13, 'ppid': 1, 'start': 7, 'cwd': '/', 'cmd': ['cc']},
+            {'pid': 13, 'ppid': 1, 'end': 8, 'status': 0},
+        ]
+        failures = sut.exec_failures(records)
+        result = [sut.is_failed(record, failures) for record in records
+                  if 'cmd' in record]
+        self.assertEqual([True, True, False, False, False, True,
+                          False, True, False], result)
+
+    def test_failed_spawn_executions(self):
+        # the spawned processes are reported without start time
+        records = [
+            {'pid': 1, 'ppid': 0, 'exec': 'ab', 'cwd': '/', 'cmd': ['cc']},
+            {'pid': 1, 'ppid': 0, 'exec': 'cd', 'cwd': '/', 'cmd': ['cc']},
+            {'pid': 1, 'ppid': 0, 'cwd': '/', 'cmd': ['cc']},
+            {'pid': 10, 'ppid': 1, 'end': 3, 'status': 1, 'exec': 'ab'},
+            {'pid': 11, 'ppid': 1, 'end': 4, 'status': 0, 'exec': 'cd'},
+            {'pid': 1, 'ppid': 0, 'end': 5, 'status': 1},
+        ]
+        failures = sut.exec_failures(records)
+        result = [sut.is_failed(record, failures) for record in records
+                  if 'cmd' in record]
+        self.assertEqual([True, False, False], result)
+
+    def test_rescued_executions(self):
+        with libear.temporary_directory() as tmp_dir:
+            open(os.path.join(tmp_dir, 'a.c'), 'w').close()
+            index = os.path.join(tmp_dir, sut.TRACE_INDEX_FILE)
+            first = {'pid': 10, 'ppid': 1, 'start': 1,
+                     'exec': '00000000000000ab', 'cwd': tmp_dir,
+                     'cmd': ['cc', '-c', 'a.c']}
+            failures = sut.exec_failures(
+                [{'pid': 10, 'ppid': 1, 'end': 2, 'status': 1}])
+            # the repeated execution terminated successfully or not
+            for flag, expected in [(0, 0), (sut.TRACE_INDEX_SUCCEEDED, 1)]:
+                with open(index, 'wb') as handle:
+                    handle.write(struct.pack('=3Q', 0, 0xab | flag, 0xcd))
+                rescued = sut.rescued_executions(index)
+                entries, _, _ = sut.classify_exec_traces(
+                    [first], 'cc', 'c++', failures, False, rescued)
+                self.assertEqual(expected, len(entries))
+            self.assertEqual(set(), sut.rescued_executions(
+                os.path.join(tmp_dir, 'missing')))
+
+    def test_append_compilations(self):
+        def compilation(source, flag):
+            return Compilation('c', [flag], source, '/src')
+
+        with libear.temporary_directory() as tmp_dir:
+            output = os.path.join(tmp_dir, 'compile_commands.json')
+            sut.append_compilations(output, [compilation('a.c', '-O1')])
+            # a journal of another process, which was not merged yet
+            pending = output + '.1-ab12' + sut.DATABASE_JOURNAL_SUFFIX
+            CompilationDatabase.save(pending, [compilation('b.c', '-O1')])
+            # a journal of another database with the same prefix
+            other = output + '.sub.2-cd34' + sut.DATABASE_JOURNAL_SUFFIX
+            CompilationDatabase.save(other, [compilation('c.c', '-O1')])
+            sut.append_compilations(output, [compilation('a.c', '-O2')])
+
+            expected = [compilation('a.c', '-O2').to_db(),
+                        compilation('b.c', '-O1').to_db()]
+            self.assertEqual(expected,
+                             CompilationDatabase.load_entries(output))
+            self.assertEqual([], sut.pending_journals(output))
+            self.assertEqual([other], sut.pending_journals(output + '.sub'))
+
+    def test_compilation_shard(self):
+        def compilation(source):
+            return Compilation('c', [], source, '/src')
+
+        shard_of = sut.compilation_shard('/src')
+        self.assertEqual('lib', shard_of(compilation('lib/a/b.c')))
+        self.assertEqual('_other', shard_of(compilation('main.c')))
+        self.assertEqual('_external', shard_of(compilation('/usr/src/a.c')))
+
+        with libear.temporary_directory() as tmp_dir:
+            mapping = os.path.join(tmp_dir, 'shards.json')
+            with open(mapping, 'w') as handle:
+                handle.write('{"core": ["lib"], "net": ["lib/net"]}')
+            shard_of = sut.compilation_shard('/src', mapping)
+            self.assertEqual('core', shard_of(compilation('lib/a/b.c')))
+            self.assertEqual('net', shard_of(compilation('lib/net/b.c')))
+            self.assertEqual('_other', shard_of(compilation('libnet/b.c')))
 
     @unittest.skipIf(IS_WINDOWS, 'this code is not running on windows')
     def test_sip(self):
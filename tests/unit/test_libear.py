@@ -8,8 +8,11 @@
 
 import libear as sut
 import unittest
+import os
 import os.path
 
+IS_WINDOWS = os.getenv('windows')
+
 
 class TemporaryDirectoryTest(unittest.TestCase):
     def test_creates_directory(self):
@@ -32,5 +35,38 @@ class TemporaryDirectoryTest(unittest.TestCase):
             self.assertFalse(os.path.exists(dir_name))
 
 
+@unittest.skipIf(IS_WINDOWS, 'this code is not running on windows')
+class CacheTest(unittest.TestCase):
+    def test_cache_key_depends_on_compiler(self):
+        src_dir = os.path.dirname(os.path.realpath(sut.__file__))
+        self.assertEqual(sut.cache_key('cc', src_dir),
+                         sut.cache_key('cc', src_dir))
+        self.assertNotEqual(sut.cache_key('cc', src_dir),
+                            sut.cache_key('clang', src_dir))
+
+    def test_cache_directory_disabled(self):
+        saved = os.environ.get(sut.CACHE_DIR_KEY)
+        try:
+            os.environ[sut.CACHE_DIR_KEY] = ''
+            self.assertIsNone(sut.cache_directory())
+            os.environ[sut.CACHE_DIR_KEY] = '/path/to/cache'
+            self.assertEqual('/path/to/cache', sut.cache_directory())
+        finally:
+            if saved is None:
+                del os.environ[sut.CACHE_DIR_KEY]
+            else:
+                os.environ[sut.CACHE_DIR_KEY] = saved
+
+    def test_library_is_reused(self):
+        with sut.temporary_directory() as cache_dir:
+            first = sut.build_cached_libear('cc', cache_dir)
+            self.assertIsNotNone(first)
+            self.assertTrue(os.path.isfile(first))
+            modified = os.stat(first).st_mtime
+            second = sut.build_cached_libear('cc', cache_dir)
+            self.assertEqual(first, second)
+            self.assertEqual(modified, os.stat(second).st_mtime)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -6,8 +6,14 @@
 #
 # RUN: %{python} %s
 
+import libear
 import libscanbuild as sut
 import unittest
+import os
+import os.path
+import random
+import shlex
+import sys
 
 
 class ShellSplitTest(unittest.TestCase):
@@ -36,5 +42,107 @@ class ShellSplitTest(unittest.TestCase):
                          sut.shell_split('clang -c file.c -Dv=\(word\)'))
 
 
+class ShellTokensTest(unittest.TestCase):
+
+    def assert_same_as_shlex(self, string):
+        try:
+            expected = shlex.split(string)
+        except ValueError:
+            self.assertRaises(ValueError, sut.shell_tokens, string)
+        else:
+            self.assertEqual(expected, sut.shell_tokens(string))
+
+    def test_quoting(self):
+        for string in ['', ' ', 'a  b\tc\nd', '"a b" c', "'a \\\" b'",
+                       'a"b c"d', '"a\\"b"', '"a\\\\" b', '"a\\b"', "''",
+                       'a\\ b', 'a\\', '"a', "a'b", '-DX="\\"v v\\""']:
+            self.assert_same_as_shlex(string)
+
+    def test_random_strings(self):
+        generator = random.Random(0)
+        alphabet = ['a', 'b', ' ', '\t', '\n', '\r', '\'', '"', '\\', '$',
+                    '#', '*', '\x0b']
+        for _ in range(20000):
+            length = generator.randint(0, 16)
+            self.assert_same_as_shlex(
+                ''.join(generator.choice(alphabet) for _ in range(length)))
+
+
+class FileSystemCacheTest(unittest.TestCase):
+
+    def test_is_file(self):
+        with libear.temporary_directory() as tmp_dir:
+            source = os.path.join(tmp_dir, 'source.c')
+            with open(source, 'w') as handle:
+                handle.write('')
+            os.mkdir(os.path.join(tmp_dir, 'subdir'))
+            os.symlink(source, os.path.join(tmp_dir, 'link.c'))
+            os.symlink('missing.c', os.path.join(tmp_dir, 'broken.c'))
+
+            self.assertTrue(sut.is_file(source))
+            self.assertTrue(sut.is_file(os.path.join(tmp_dir, 'link.c')))
+            self.assertFalse(sut.is_file(os.path.join(tmp_dir, 'broken.c')))
+            self.assertFalse(sut.is_file(os.path.join(tmp_dir, 'subdir')))
+            self.assertFalse(sut.is_file(os.path.join(tmp_dir, 'missing.c')))
+            self.assertFalse(
+                sut.is_file(os.path.join(tmp_dir, 'missing', 'source.c')))
+            self.assertIn(tmp_dir, sut.DIRECTORY_LISTINGS)
+            # names which are not in the listing are checked one by one,
+            # and those results are not cached
+            late = os.path.join(tmp_dir, 'late.c')
+            self.assertFalse(sut.is_file(late))
+            with open(late, 'w') as handle:
+                handle.write('')
+            self.assertTrue(sut.is_file(late))
+            self.assertNotIn('late.c', sut.DIRECTORY_LISTINGS[tmp_dir])
+
+    def test_clear_file_system_caches(self):
+        with libear.temporary_directory() as tmp_dir:
+            source = os.path.join(tmp_dir, 'source.c')
+            with open(source, 'w') as handle:
+                handle.write('')
+            self.assertTrue(sut.is_file(source))
+            sut.real_path(source)
+            sut.clear_file_system_caches()
+            self.assertEqual({}, sut.DIRECTORY_LISTINGS)
+            self.assertEqual({}, sut.REAL_PATHS)
+            os.unlink(source)
+            self.assertFalse(sut.is_file(source))
+
+    def test_real_path(self):
+        with libear.temporary_directory() as tmp_dir:
+            os.mkdir(os.path.join(tmp_dir, 'real'))
+            os.symlink(os.path.join(tmp_dir, 'real'),
+                       os.path.join(tmp_dir, 'link'))
+            self.assertEqual(
+                os.path.realpath(os.path.join(tmp_dir, 'real', 'a.c')),
+                sut.real_path(os.path.join(tmp_dir, 'link', 'a.c')))
+
+    def test_canonical_path(self):
+        with libear.temporary_directory() as tmp_dir:
+            real = os.path.realpath(tmp_dir)
+            os.mkdir(os.path.join(tmp_dir, 'real'))
+            os.symlink(os.path.join(tmp_dir, 'real'),
+                       os.path.join(tmp_dir, 'link'))
+            os.symlink('a.c', os.path.join(tmp_dir, 'real', 'b.c'))
+            self.assertEqual(
+                os.path.join(real, 'real', 'a.c'),
+                sut.canonical_path(os.path.join(tmp_dir, 'link', 'a.c')))
+            # symbolic link to the file itself is not resolved
+            self.assertEqual(
+                os.path.join(real, 'real', 'b.c'),
+                sut.canonical_path(os.path.join(tmp_dir, 'link', 'b.c')))
+
+
 if __name__ == '__main__':
     unittest.main()
+
+
+class MonotonicTest(unittest.TestCase):
+
+    @unittest.skipIf(not sys.platform.startswith('linux'), 'linux only')
+    def test_monotonic(self):
+        first = sut.monotonic()
+        second = sut.monotonic()
+        self.assertIsNotNone(first)
+        self.assertTrue(first <= second)
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+#                     The LLVM Compiler Infrastructure
+#
+# This file is distributed under the University of Illinois Open Source
+# License. See LICENSE.TXT for details.
+#
+# RUN: %{python} %s
+
+import json
+import os
+import os.path
+import unittest
+
+import libear
+import libscanbuild.profile as sut
+
+MS = 1000000
+
+
+def start(pid, ppid, time, cwd, cmd):
+    return {'pid': pid, 'ppid': ppid, 'start': time * MS, 'cwd': cwd,
+            'cmd': cmd}
+
+
+def end(pid, ppid, time):
+    return {'pid': pid, 'ppid': ppid, 'end': time * MS}
+
+
+class ProcessesTest(unittest.TestCase):
+
+    def test_exec_chain_is_one_process(self):
+        records = [
+            end(10, 1, 50),
+            start(10, 1, 0, '/tmp', ['sh', '-c', 'cc -c a.c']),
+            start(10, 1, 5, '/tmp', ['cc', '-c', 'a.c']),
+        ]
+        result = sut.processes(records)
+        self.assertEqual(1, len(result))
+        self.assertEqual(0, result[0].start)
+        self.assertEqual(50 * MS, result[0].end)
+        self.assertEqual(['cc', '-c', 'a.c'], result[0].calls[-1].cmd)
+
+    def test_reused_pid_is_new_process(self):
+        records = [
+            start(10, 1, 0, '/tmp', ['true']),
+            end(10, 1, 5),
+            start(10, 1, 10, '/tmp', ['false']),
+            end(10, 1, 15),
+        ]
+        result = sut.processes(records)
+        self.assertEqual(2, len(result))
+        self.assertEqual(5 * MS, result[0].duration())
+        self.assertEqual(5 * MS, result[1].duration())
+
+    def test_not_started_process_is_ignored(self):
+        records = [end(1, 0, 100)]
+        self.assertEqual([], sut.processes(records))
+
+    def test_parent_link(self):
+        records = [
+            start(10, 1, 0, '/tmp', ['make']),
+            start(11, 10, 10, '/tmp', ['cc', '-c', 'a.c']),
+            end(11, 10, 20),
+            start(12, 10, 30, '/tmp', ['cc', '-c', 'b.c']),
+            end(12, 10, 90),
+            end(10, 1, 100),
+        ]
+        instances = sut.processes(records)
+        roots = sut.link_processes(instances)
+        self.assertEqual(1, len(roots))
+        self.assertEqual([11, 12], [child.pid for child in roots[0].children])
+        path = sut.critical_path(roots)
+        self.assertEqual([10, 11, 12], [process.pid for process in path])
+
+    def test_critical_path(self):
+        records = [
+            start(10, 1, 0, '/tmp', ['make']),
+            # parallel jobs, the first one is sequential with the last
+            start(11, 10, 10, '/tmp', ['cc', '-c', 'a.c']),
+            start(12, 10, 10, '/tmp', ['sh', '-c', 'cc -c b.c']),
+            start(13, 12, 15, '/tmp', ['cc', '-c', 'b.c']),
+            end(13, 12, 25),
+            end(12, 10, 30),
+            end(11, 10, 40),
+            start(14, 10, 50, '/tmp', ['ld', '-o', 'a.out']),
+            end(14, 10, 90),
+            end(10, 1, 100),
+        ]
+        roots = sut.link_processes(sut.processes(records))
+        path = sut.critical_path(roots)
+        self.assertEqual([10, 11, 14], [process.pid for process in path])
+
+
+class ProfileTest(unittest.TestCase):
+
+    def test_write_build_profile(self):
+        with libear.temporary_directory() as tmp_dir:
+            for name in ['a.c', 'b.c', 'a.o', 'b.o']:
+                open(os.path.join(tmp_dir, name), 'w').close()
+            records = [
+                start(10, 1, 0, tmp_dir, ['make']),
+                start(11, 10, 10, tmp_dir, ['cc', '-c', 'a.c']),
+                end(11, 10, 20),
+                start(12, 10, 30, tmp_dir, ['cc', '-c', 'b.c']),
+                end(12, 10, 90),
+                # the link step is not a compilation
+                start(13, 10, 91, tmp_dir, ['cc', 'a.o', 'b.o', '-o', 'a']),
+                end(13, 10, 95),
+                end(10, 1, 100),
+            ]
+            output = os.path.join(tmp_dir, 'profile.json')
+            sut.write_build_profile(output, records, 'cc', 'c++')
+            with open(output, 'r') as handle:
+                result = json.load(handle)
+
+            self.assertAlmostEqual(0.1, result['wall_time'])
+            self.assertEqual(4, result['processes'])
+            self.assertEqual(['b.c', 'a.c'],
+                             [entry['file']
+                              for entry in result['compilations']])
+            self.assertAlmostEqual(0.06, result['compilations'][0]['duration'])
+            self.assertEqual([['make'], ['cc', '-c', 'a.c'],
+                              ['cc', '-c', 'b.c'],
+                              ['cc', 'a.o', 'b.o', '-o', 'a']],
+                             [entry['command']
+                              for entry in result['critical_path']])